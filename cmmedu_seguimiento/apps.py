@@ -19,9 +19,13 @@ class CMMEduSeguimiento(AppConfig):
         PluginSettings.CONFIG: {
             ProjectType.CMS: {
                 SettingsType.COMMON: {
-                    PluginSettings.RELATIVE_PATH: "settings.common"}},
+                    PluginSettings.RELATIVE_PATH: "settings.common"},
+                SettingsType.TEST: {
+                    PluginSettings.RELATIVE_PATH: "settings.test"}},
             ProjectType.LMS: {
                 SettingsType.COMMON: {
-                    PluginSettings.RELATIVE_PATH: "settings.common"}},
+                    PluginSettings.RELATIVE_PATH: "settings.common"},
+                SettingsType.TEST: {
+                    PluginSettings.RELATIVE_PATH: "settings.test"}},
         },
     }
\ No newline at end of file
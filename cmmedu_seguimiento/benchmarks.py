@@ -0,0 +1,311 @@
+"""
+Benchmarks of the report pipeline on synthetic courses.
+
+They are not run with the tests. To run them, set the scenarios to benchmark
+(see `BENCHMARK_SCENARIOS`) and, optionally, the file where the results are
+written as JSON, e.g.:
+
+    CMMEDU_SEGUIMIENTO_BENCHMARK=small,medium \\
+    CMMEDU_SEGUIMIENTO_BENCHMARK_OUTPUT=/tmp/benchmark.json \\
+    pytest cmmedu_seguimiento/benchmarks.py
+"""
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.test import Client, override_settings
+from django.urls import reverse
+from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
+from xmodule.modulestore.tests.factories import CourseFactory, ItemFactory
+from common.djangoapps.student.models import CourseEnrollment, UserProfile
+from common.djangoapps.student.tests.factories import UserFactory
+from capa.tests.response_xml_factory import StringResponseXMLFactory
+from lms.djangoapps.courseware.models import StudentModule
+from lms.djangoapps.instructor_task.models import InstructorTask
+import json
+import logging
+import os
+import pkg_resources
+from pytz import UTC
+import random
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from .models import JsonReportStore
+from .profiling import ReportMetrics
+from .utils import build_blocks_data, get_course_root, iter_student_modules, list_problem_responses, load_content_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+# problems: problem blocks of the course, split evenly across `chapters`
+# students: enrolled students, of which a `response_rate` fraction has
+# answered each problem with a state of about `state_size` bytes
+BENCHMARK_SCENARIOS = {
+    'small': {'chapters': 1, 'problems': 10, 'students': 10, 'response_rate': 1.0, 'state_size': 100},
+    'medium': {'chapters': 5, 'problems': 100, 'students': 1000, 'response_rate': 0.5, 'state_size': 1000},
+    'large': {'chapters': 20, 'problems': 1000, 'students': 10000, 'response_rate': 0.1, 'state_size': 1000},
+    'xlarge': {'chapters': 20, 'problems': 1000, 'students': 50000, 'response_rate': 0.02, 'state_size': 10000},
+}
+
+BENCHMARK_ENV = 'CMMEDU_SEGUIMIENTO_BENCHMARK'
+
+BENCHMARK_OUTPUT_ENV = 'CMMEDU_SEGUIMIENTO_BENCHMARK_OUTPUT'
+
+BULK_CREATE_BATCH_SIZE = 5000
+
+# Requests measured on every report endpoint
+ENDPOINT_REPEAT = 20
+
+ENDPOINT_NAMES = ('cmmedu_seguimiento_make_report', 'cmmedu_seguimiento_get_report')
+
+# Compression codecs and levels compared on the report of every scenario
+BENCHMARK_COMPRESSIONS = [
+    ('none', None), ('gz', 1), ('gz', 6), ('gz', 9), ('bz2', 9), ('xz', 1), ('xz', 6), ('zstd', 3),
+]
+
+
+@unittest.skipUnless(os.environ.get(BENCHMARK_ENV), 'Set {} to run the benchmarks.'.format(BENCHMARK_ENV))
+class BenchmarkCMMEduSeguimiento(ModuleStoreTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        super(BenchmarkCMMEduSeguimiento, self).setUp()
+        self.storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_dir)
+        self.user_staff = UserFactory(username='benchmark_staff', password='12345', is_staff=True)
+        self.auth_client = Client()
+        self.auth_client.login(username='benchmark_staff', password='12345')
+
+
+    def create_course(self, name, chapters, problems, students, response_rate, state_size):
+        """
+        Create a course with `problems` problem blocks across `chapters`
+        chapters, enroll `students` students and store their responses.
+        Users, enrollments and student modules are bulk created.
+        """
+        course = CourseFactory.create(org='benchmark', course=name, run='2020', display_name='Benchmark ' + name)
+        items = []
+        with self.store.bulk_operations(course.id, emit_signals=False):
+            for chapter_index in range(chapters):
+                chapter = ItemFactory.create(parent_location=course.location, category='chapter')
+                sequential = ItemFactory.create(parent_location=chapter.location, category='sequential')
+                chapter_problems = problems // chapters + (1 if chapter_index < problems % chapters else 0)
+                items += [
+                    ItemFactory.create(
+                        parent_location=sequential.location,
+                        category='problem',
+                        data=StringResponseXMLFactory().build_xml(answer='foo'),
+                    )
+                    for _ in range(chapter_problems)
+                ]
+
+        user_model = get_user_model()
+        username_prefix = 'benchmark_{}_'.format(name)
+        user_model.objects.bulk_create(
+            [
+                user_model(username=username_prefix + str(index), email='{}{}@example.com'.format(username_prefix, index))
+                for index in range(students)
+            ],
+            batch_size=BULK_CREATE_BATCH_SIZE
+        )
+        users = list(user_model.objects.filter(username__startswith=username_prefix))
+        UserProfile.objects.bulk_create(
+            [UserProfile(user=user, name=user.username) for user in users],
+            batch_size=BULK_CREATE_BATCH_SIZE
+        )
+        CourseEnrollment.objects.bulk_create(
+            [CourseEnrollment(user=user, course_id=course.id, mode='audit', is_active=True) for user in users],
+            batch_size=BULK_CREATE_BATCH_SIZE
+        )
+
+        rng = random.Random(0)
+        padding = 'x' * state_size
+        student_modules = []
+        for item in items:
+            answer_id = '{}_2_1'.format(item.location.html_id())
+            state = json.dumps({
+                'seed': 1,
+                'attempts': 1,
+                'done': True,
+                'student_answers': {answer_id: padding},
+                'correct_map': {answer_id: {'correctness': 'incorrect', 'npoints': None}},
+            })
+            for user in users:
+                if rng.random() < response_rate:
+                    student_modules.append(StudentModule(
+                        module_type='problem',
+                        module_state_key=item.location,
+                        student=user,
+                        course_id=course.id,
+                        state=state,
+                        grade=0,
+                        max_grade=1,
+                    ))
+            if len(student_modules) >= BULK_CREATE_BATCH_SIZE:
+                StudentModule.objects.bulk_create(student_modules)
+                student_modules = []
+        StudentModule.objects.bulk_create(student_modules)
+        return course, items
+
+
+    def measure(self, function, *args, **kwargs):
+        """
+        Call `function` and return its result and a dict with its wall time,
+        database queries and time, and the peak memory it allocated.
+        """
+        metrics = ReportMetrics()
+        tracemalloc.start()
+        try:
+            with metrics.track():
+                result = function(*args, **kwargs)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return result, {
+            'wall_time': round(metrics.wall_time, 3),
+            'db_queries': metrics.db_queries,
+            'db_time': round(metrics.db_time, 3),
+            'peak_memory_kb': peak_memory // 1024,
+        }
+
+
+    def add_throughput(self, measurement, **counts):
+        """
+        Add to `measurement` the number per second of every count given.
+        """
+        for name, count in counts.items():
+            measurement[name] = count
+            measurement[name + '_per_second'] = round(count / measurement['wall_time'], 1) if measurement['wall_time'] else None
+        return measurement
+
+
+    def compare_compressions(self, course_id):
+        """
+        Store the first section of the blocks data of the course with every
+        codec of `BENCHMARK_COMPRESSIONS` available, and return the size and
+        time of each.
+        """
+        results = []
+        for compression, level in BENCHMARK_COMPRESSIONS:
+            config = {'STORAGE_TYPE': 'localfs', 'ROOT_PATH': self.storage_dir, 'COMPRESSION': compression, 'COMPRESSION_LEVEL': level}
+            with self.settings(GRADES_DOWNLOAD=config):
+                try:
+                    JsonReportStore.from_config('GRADES_DOWNLOAD')
+                except ImproperlyConfigured:
+                    continue
+                # The content snapshot is stored once per codec, outside the measurement
+                load_content_snapshot(self.user_staff.id, course_id, get_course_root(course_id))
+                reports, measurement = self.measure(
+                    build_blocks_data, self.user_staff.id, course_id, get_course_root(course_id), datetime.now(UTC), section_indexes=[1]
+                )
+            measurement.update({'compression': compression, 'level': level, 'archive_bytes': sum(report['size'] for report in reports)})
+            results.append(measurement)
+        return results
+
+
+    def request_report(self, course_id):
+        """
+        Request a report of `course_id`, run eagerly, and return its task.
+        """
+        response = self.auth_client.post(
+            reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_report'),
+            content_type="application/json",
+            data=json.dumps({'course_key': str(course_id)}),
+        )
+        self.assertEqual(response.json()['status'], 1)
+        return InstructorTask.objects.get(task_id=response.json()['task_id'])
+
+
+    def measure_endpoints(self, course_id):
+        """
+        Return the mean latency and database queries of a request to every
+        endpoint of `ENDPOINT_NAMES` for `course_id`, once the existence check
+        of the course is cached. No report task is submitted.
+        """
+        data = json.dumps({'course_key': str(course_id)})
+        results = {}
+        with mock.patch('cmmedu_seguimiento.views.submit_task_make_report', return_value=mock.Mock(task_id='task_id')):
+            for name in ENDPOINT_NAMES:
+                self.auth_client.post(reverse('cmmedu_seguimiento:' + name), content_type="application/json", data=data)
+                _, measurement = self.measure(lambda: [
+                    self.auth_client.post(reverse('cmmedu_seguimiento:' + name), content_type="application/json", data=data)
+                    for _ in range(ENDPOINT_REPEAT)
+                ])
+                results[name] = {
+                    'mean_latency': round(measurement['wall_time'] / ENDPOINT_REPEAT, 4),
+                    'db_queries_per_request': measurement['db_queries'] / ENDPOINT_REPEAT,
+                }
+        return results
+
+
+    def run_scenario(self, name, scenario):
+        """
+        Benchmark `list_problem_responses`, `iter_student_modules`,
+        `build_blocks_data`, `make_report` and the report endpoints on a
+        course built after `scenario`. Responses are read one block at a time, as reports read
+        them, so no step holds the responses of the whole course.
+        """
+        course, items = self.create_course(name, **scenario)
+        responses = StudentModule.objects.filter(course_id=course.id).count()
+        results = {}
+
+        _, results['list_problem_responses'] = self.measure(
+            lambda: sum(len(list_problem_responses(course.id, item.location)) for item in items)
+        )
+        self.add_throughput(results['list_problem_responses'], blocks=len(items), responses=responses)
+
+        _, results['iter_student_modules'] = self.measure(
+            lambda: sum(1 for item in items for _ in iter_student_modules(course.id, item.location))
+        )
+        self.add_throughput(results['iter_student_modules'], blocks=len(items), responses=responses)
+        results['compression'] = self.compare_compressions(course.id)
+
+        reports, results['build_blocks_data'] = self.measure(
+            build_blocks_data, self.user_staff.id, course.id, get_course_root(course.id), datetime.now(UTC)
+        )
+        self.add_throughput(
+            results['build_blocks_data'],
+            blocks=sum(report['blocks'] for report in reports),
+            responses=sum(report['responses'] for report in reports)
+        )
+
+        task, results['make_report'] = self.measure(self.request_report, course.id)
+        self.assertEqual(task.task_state, 'SUCCESS')
+        self.add_throughput(results['make_report'], blocks=len(items), responses=responses)
+        results['endpoints'] = self.measure_endpoints(course.id)
+        return results
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_benchmark_report(self):
+        """
+        Run the scenarios given in the environment and write their results.
+        """
+        names = [name.strip() for name in os.environ[BENCHMARK_ENV].split(',') if name.strip()]
+        for name in names:
+            self.assertIn(name, BENCHMARK_SCENARIOS)
+        try:
+            version = pkg_resources.get_distribution('cmmedu_seguimiento').version
+        except pkg_resources.DistributionNotFound:
+            version = None
+        output = {
+            'version': version,
+            'timestamp': datetime.now(UTC).isoformat(),
+            'scenarios': {},
+        }
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': self.storage_dir}):
+            for name in names:
+                logger.info("Running report benchmark %s.", name)
+                output['scenarios'][name] = {
+                    'parameters': BENCHMARK_SCENARIOS[name],
+                    'results': self.run_scenario(name, BENCHMARK_SCENARIOS[name]),
+                }
+
+        output_path = os.environ.get(BENCHMARK_OUTPUT_ENV, 'cmmedu_seguimiento_benchmark.json')
+        with open(output_path, 'w') as output_file:
+            json.dump(output, output_file, indent=4)
+        logger.info("Report benchmark results written to %s.", output_path)
@@ -0,0 +1,42 @@
+"""
+Request the reports of the courses with activity since their last report.
+
+Meant to run from cron at the start of the off-peak window, as the
+`task_schedule_stale_reports` Celery beat task does, e.g.:
+
+    ./manage.py lms schedule_cmmedu_seguimiento_reports --username staff --window 14400
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from ...tasks import schedule_stale_reports
+
+
+class Command(BaseCommand):
+    help = 'Request the reports of the courses with activity since their last successful report.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help='User who requests the reports (CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME by default).')
+        parser.add_argument('--window', type=int, help='Seconds over which the report tasks are staggered.')
+        parser.add_argument('--concurrency', type=int, help='Maximum number of report tasks running at once.')
+        parser.add_argument('--lookback', type=int, help='Seconds of activity that are checked.')
+        parser.add_argument('--dry-run', action='store_true', help='List the courses without requesting their reports.')
+
+    def handle(self, *args, **options):
+        username = options['username'] or settings.CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME
+        if not username:
+            raise CommandError('Give --username or set CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME.')
+        if not get_user_model().objects.filter(username=username).exists():
+            raise CommandError('User {} does not exist.'.format(username))
+        course_keys, batch = schedule_stale_reports(
+            username=username,
+            window=options['window'],
+            concurrency=options['concurrency'],
+            lookback=options['lookback'],
+            dry_run=options['dry_run'],
+        )
+        for course_key in course_keys:
+            self.stdout.write(str(course_key))
+        if batch is not None:
+            self.stdout.write('Batch {} of {} reports.'.format(batch['id'], len(batch['courses'])))
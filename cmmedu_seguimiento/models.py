@@ -1,18 +1,53 @@
 from boto.exception import BotoServerError
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import timedelta, datetime
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
+import gzip
 import hashlib
 import io
 import json
 import logging
 from openedx.core.storage import get_storage
+import os
 import os.path
+import re
 from six import text_type
 import tarfile
+import tempfile
+import threading
+
+from .profiling import ReportMetrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
+# Archive extension and tarfile mode of every compression codec. zstd has no
+# tarfile mode, the tar stream is compressed with `zstandard` instead.
+REPORT_COMPRESSIONS = {
+    'gz': ('tar.gz', 'w:gz'),
+    'bz2': ('tar.bz2', 'w:bz2'),
+    'xz': ('tar.xz', 'w:xz'),
+    'zstd': ('tar.zst', 'w|'),
+    'none': ('tar', 'w'),
+}
+
+# Placeholder of the responses of an item while they are streamed
+STREAMED_RESPONSES_MARKER = '\u0000cmmedu-seguimiento-responses\u0000'
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+JSONL_REPORT_FORMAT = 'cmmedu-seguimiento-compact'
+
+JSONL_REPORT_VERSION = 1
+
 
 class JsonReportEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -26,20 +61,27 @@ class JsonReportEncoder(json.JSONEncoder):
 class JsonReportStore(object):
     """
     Simple abstraction layer that can fetch and store JSON files for reports
-    download. Should probably refactor later to create a ReportFile object that
-    can simply be appended to for the sake of memory efficiency, rather than
-    passing in the whole dataset. Doing that for now just because it's simpler.
+    download. Large lists should be written through a `JsonReportFile` (see
+    `open_json`), which can simply be appended to for the sake of memory
+    efficiency, rather than passing in the whole dataset.
     """
     @classmethod
     def from_config(cls, config_name):
         """
         Return one of the ReportStore subclasses depending on django
         configuration. Look at subclasses for expected configuration.
+
+        The `COMPRESSION` (see `REPORT_COMPRESSIONS`) and `COMPRESSION_LEVEL`
+        of the archives can be set in the configuration, and default to
+        `CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION` and
+        `CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION_LEVEL`.
         """
         # Convert old configuration parameters to those expected by
         # DjangoStorageReportStore for backward compatibility
         config = getattr(settings, config_name, {})
         storage_type = config.get('STORAGE_TYPE', '').lower()
+        compression = config.get('COMPRESSION', settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION)
+        compression_level = config.get('COMPRESSION_LEVEL', settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION_LEVEL)
         if storage_type == 's3':
             return DjangoStorageJsonReportStore(
                 storage_class='storages.backends.s3boto.S3BotoStorage',
@@ -48,8 +90,11 @@ class JsonReportStore(object):
                     'location': config['ROOT_PATH'],
                     'custom_domain': config.get("CUSTOM_DOMAIN", None),
                     'querystring_expire': 300,
-                    'gzip': True,
+                    # Archives are already compressed
+                    'gzip': compression == 'none',
                 },
+                compression=compression,
+                compression_level=compression_level,
             )
         elif storage_type == 'localfs':
             return DjangoStorageJsonReportStore(
@@ -57,6 +102,8 @@ class JsonReportStore(object):
                 storage_kwargs={
                     'location': config['ROOT_PATH'],
                 },
+                compression=compression,
+                compression_level=compression_level,
             )
         return DjangoStorageJsonReportStore.from_config(config_name)
 
@@ -65,11 +112,21 @@ class JsonReportStore(object):
 class DjangoStorageJsonReportStore(JsonReportStore):
     """
     ReportStore implementation that delegates to django's storage api.
+
+    Archives are compressed with `compression` (one of `REPORT_COMPRESSIONS`)
+    at `compression_level`, the codec default if None.
     """
-    def __init__(self, storage_class=None, storage_kwargs=None):
+    def __init__(self, storage_class=None, storage_kwargs=None, compression='gz', compression_level=None):
         if storage_kwargs is None:
             storage_kwargs = {}
+        if compression not in REPORT_COMPRESSIONS:
+            raise ImproperlyConfigured("Unknown report compression: {}".format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImproperlyConfigured("The zstd report compression requires the zstandard package.")
         self.storage = get_storage(storage_class, **storage_kwargs)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.archive_extension = REPORT_COMPRESSIONS[compression][0]
 
     @classmethod
     def from_config(cls, config_name):
@@ -86,34 +143,227 @@ class DjangoStorageJsonReportStore(JsonReportStore):
 
         Reference the setting name when calling `.from_config`.
         """
+        config = getattr(settings, config_name)
         return cls(
-            getattr(settings, config_name).get('STORAGE_CLASS'),
-            getattr(settings, config_name).get('STORAGE_KWARGS'),
+            config.get('STORAGE_CLASS'),
+            config.get('STORAGE_KWARGS'),
+            config.get('COMPRESSION', settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION),
+            config.get('COMPRESSION_LEVEL', settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION_LEVEL),
         )
 
     def store(self, course_id, filename, buff_contents):
         """
-        Store the `buff_contents` (raw bytes) in a `.tar.gz` archive named `filename`
-        and save it in a directory based on `course_id`.
+        Store the `buff_contents` (raw bytes) in an archive named `filename`
+        and save it in a directory based on `course_id`. Returns the same
+        description of the stored file as `store_file`.
+        """
+        return self.store_file(course_id, filename, io.BytesIO(buff_contents), len(buff_contents))
+
+    def store_file(self, course_id, filename, contents, size, metrics=None, member_extension='json'):
+        """
+        Store `size` bytes read from the file object `contents` in an archive
+        named `filename` and save it in a directory based on `course_id`.
+        The file inside the archive is named after the archive, with
+        `member_extension` as extension.
+
+        Returns a dict with the `name` the storage gave to the file (which
+        differs from `filename` if a file with that name already existed), and
+        the `size` in bytes and SHA-256 `checksum` of the archive. The time
+        spent compressing and uploading is recorded in `metrics` if given.
+        """
+        archive = self.compress_file(filename, contents, size, metrics, member_extension)
+        return self.save_archive(course_id, filename, archive, metrics)
+
+    def compress_file(self, filename, contents, size, metrics=None, member_extension='json'):
         """
-        path = self.path_to(course_id, filename)
-        tar_buffer = io.BytesIO()
-        with tarfile.open(fileobj=tar_buffer, mode='w:gz') as tar:
-            tarinfo = tarfile.TarInfo(name=f"{filename}.json".replace(".tar.gz", ""))
-            tarinfo.size = len(buff_contents)
-            tar.addfile(tarinfo, io.BytesIO(buff_contents))
-        tar_buffer.seek(0)
-        tar_content = ContentFile(tar_buffer.getvalue())
-        self.storage.save(path, tar_content)
+        Compress `size` bytes read from `contents` into a tar archive. The
+        archive is written into a spooled temporary file, that `save_archive`
+        hands to the storage as is, so it is never copied in memory.
 
+        Returns the archive file, its size and its SHA-256 checksum. This does
+        not use the database nor the storage, so it can run on another thread.
+        """
+        if metrics is None:
+            metrics = ReportMetrics()
+        extension, mode = REPORT_COMPRESSIONS[self.compression]
+        options = {}
+        if self.compression_level is not None:
+            if self.compression == 'xz':
+                options['preset'] = self.compression_level
+            elif self.compression in ('gz', 'bz2'):
+                options['compresslevel'] = self.compression_level
+        tar_buffer = tempfile.SpooledTemporaryFile(max_size=settings.CMMEDU_SEGUIMIENTO_REPORT_SPOOL_MAX_SIZE)
+        with metrics.phase('compression'):
+            member_name = filename[:-len(extension) - 1] if filename.endswith('.' + extension) else filename
+            tarinfo = tarfile.TarInfo(name=f"{member_name}.{member_extension}")
+            tarinfo.size = size
+            if self.compression == 'zstd':
+                level = self.compression_level if self.compression_level is not None else 3
+                writer = zstandard.ZstdCompressor(level=level).stream_writer(tar_buffer, closefd=False)
+                with tarfile.open(fileobj=writer, mode=mode) as tar:
+                    tar.addfile(tarinfo, contents)
+                writer.close()
+            else:
+                with tarfile.open(fileobj=tar_buffer, mode=mode, **options) as tar:
+                    tar.addfile(tarinfo, contents)
+            archive_size = tar_buffer.tell()
+            tar_buffer.seek(0)
+            checksum = hashlib.sha256()
+            for chunk in iter(lambda: tar_buffer.read(io.DEFAULT_BUFFER_SIZE), b''):
+                checksum.update(chunk)
+            tar_buffer.seek(0)
+        return tar_buffer, archive_size, checksum.hexdigest()
 
-    def store_json(self, course_id, filename, data):
+    def save_archive(self, course_id, filename, archive, metrics=None):
+        """
+        Save an archive returned by `compress_file` as `filename` and close
+        it. Returns the same description of the stored file as `store_file`.
+        """
+        if metrics is None:
+            metrics = ReportMetrics()
+        tar_buffer, archive_size, checksum = archive
+        with tar_buffer:
+            with metrics.phase('upload'):
+                name = self.storage.save(self.path_to(course_id, filename), File(tar_buffer, name=filename))
+        return {
+            'name': os.path.basename(name),
+            'size': archive_size,
+            'checksum': checksum,
+        }
+
+    def store_json(self, course_id, filename, data, metrics=None, report_format='classic'):
         """
         Given a course_id, filename, and data (a Python dict or list),
         write the data to the storage backend in JSON format inside a `.tar.gz` file.
+        Lists are serialized item by item through a `JsonReportFile` (or a
+        `JsonLinesReportFile` if `report_format` is `jsonl`). Returns the same
+        description of the stored file as `store_file`, plus the number of
+        `items` of a list.
+        """
+        if isinstance(data, list):
+            with self.open_json(course_id, filename, metrics, report_format) as report_file:
+                for item in data:
+                    report_file.append(item)
+            return report_file.describe()
+        json_data = json.dumps(data, ensure_ascii=False, indent=4, cls=JsonReportEncoder).encode('utf-8')
+        return self.store_file(course_id, filename, io.BytesIO(json_data), len(json_data), metrics)
+
+    def open_json(self, course_id, filename, metrics=None, report_format='classic', uploader=None, previous_archives=None):
+        """
+        Return an empty `JsonReportFile`, or `JsonLinesReportFile` if
+        `report_format` is `jsonl`, that will be stored as `filename` in the
+        directory of `course_id` when it is closed. If a `ReportUploader` is
+        given, the file is stored in the background, and if one of
+        `previous_archives` has the same contents, it is reused instead (see
+        `JsonReportFile`).
+        """
+        if report_format == 'jsonl':
+            return JsonLinesReportFile(self, course_id, filename, metrics, uploader, previous_archives)
+        return JsonReportFile(self, course_id, filename, metrics, uploader, previous_archives)
+
+    def store_raw(self, course_id, filename, contents):
+        """
+        Save the file object `contents` as is, named `filename`. Returns the
+        name the storage gave to the file.
+        """
+        return os.path.basename(self.storage.save(self.path_to(course_id, filename), File(contents, name=filename)))
+
+    def store_manifest(self, course_id, filename, data):
+        """
+        Write `data` as a plain (uncompressed) JSON file named `filename`.
+        Returns the name the storage gave to the file.
         """
         json_data = json.dumps(data, ensure_ascii=False, indent=4, cls=JsonReportEncoder)
-        self.store(course_id, filename, json_data.encode('utf-8'))
+        return os.path.basename(self.storage.save(self.path_to(course_id, filename), ContentFile(json_data.encode('utf-8'))))
+
+    def read_manifest(self, course_id, filename):
+        """
+        Return the contents of a JSON file written by `store_manifest`.
+        """
+        with self.storage.open(self.path_to(course_id, filename)) as manifest_file:
+            return json.loads(manifest_file.read().decode('utf-8'))
+
+    def exists(self, course_id, filename):
+        """
+        Return whether a file named `filename` is stored for the course.
+        """
+        return self.storage.exists(self.path_to(course_id, filename))
+
+    def delete(self, course_id, filename):
+        """
+        Delete the file named `filename` of the course, if it exists.
+        """
+        self.storage.delete(self.path_to(course_id, filename))
+
+    def read_range(self, course_id, filename, offset, length):
+        """
+        Return `length` bytes of a stored file, starting at `offset`, with
+        the ranged read of the storage backend. The files of the S3 storages
+        download whole on their first read, so only those bytes are fetched
+        with a ranged GET of the S3 object (boto3) or key (boto) of the opened
+        file; files of other storages, like the local filesystem, are read
+        from `offset`.
+        """
+        byte_range = 'bytes={}-{}'.format(offset, offset + length - 1)
+        with self.storage.open(self.path_to(course_id, filename)) as stored_file:
+            if hasattr(stored_file, 'obj'):
+                return stored_file.obj.get(Range=byte_range)['Body'].read()
+            if hasattr(stored_file, 'key'):
+                return stored_file.key.get_contents_as_string(headers={'Range': byte_range})
+            stored_file.seek(offset)
+            return stored_file.read(length)
+
+    def read_chunks(self, course_id, filename, chunk_ranges):
+        """
+        Return the chunks of a `ReportIndexFile` stored as `filename` found at
+        `chunk_ranges`, a list of `(offset, length)` pairs of its index.
+        """
+        return [
+            json.loads(gzip.decompress(self.read_range(course_id, filename, offset, length)).decode('utf-8'))
+            for offset, length in chunk_ranges
+        ]
+
+    @contextmanager
+    def open_archived_json(self, course_id, filename):
+        """
+        Open the JSON file in the archive named `filename`, whatever its
+        compression, as a binary stream. Yields the stream and whether the
+        file is in the JSON Lines format (see `JsonLinesReportFile`).
+        """
+        with self.storage.open(self.path_to(course_id, filename)) as archive:
+            is_zstd = archive.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+            archive.seek(0)
+            if is_zstd:
+                if zstandard is None:
+                    raise ImproperlyConfigured("Reading zstd reports requires the zstandard package.")
+                archive = zstandard.ZstdDecompressor().stream_reader(archive)
+            with tarfile.open(fileobj=archive, mode='r|*') as tar:
+                member = tar.next()
+                yield tar.extractfile(member), member.name.endswith('.' + JsonLinesReportFile.extension)
+
+    def read_json(self, course_id, filename):
+        """
+        Return the contents of a JSON report stored in the archive named
+        `filename`, whatever its compression. Lists stored in the JSON
+        Lines format are decoded back to the items that were appended to them.
+        """
+        with self.open_archived_json(course_id, filename) as (contents, is_json_lines):
+            if is_json_lines:
+                # Lines as bytes: a member of a streamed tar cannot be wrapped
+                # in a TextIOWrapper, which needs a seekable file
+                return list(iter_json_lines_items(contents))
+            return json.load(contents)
+
+    def iter_json(self, course_id, filename):
+        """
+        Yield the items of a JSON list stored in the archive named `filename`,
+        as `read_json` returns them, decoding one item at a time instead of
+        loading the whole list.
+        """
+        with self.open_archived_json(course_id, filename) as (contents, is_json_lines):
+            items = iter_json_lines_items(contents) if is_json_lines else iter_json_items(contents)
+            for item in items:
+                yield item
 
     def links_for(self, course_id):
         """
@@ -160,4 +410,568 @@ class DjangoStorageJsonReportStore(JsonReportStore):
         Return the full path to a given file for a given course.
         """
         hashed_course_id = hashlib.sha1(text_type(course_id).encode('utf-8')).hexdigest()
-        return os.path.join(hashed_course_id, filename)
\ No newline at end of file
+        return os.path.join(hashed_course_id, filename)
+
+
+class JsonReportFile(object):
+    """
+    JSON list that is written to a `JsonReportStore` one item at a time.
+
+    Every appended item is serialized right away into a spooled temporary file,
+    and the `responses` of an item given as an iterator are serialized one by
+    one, so the file itself holds no more than one item (or one response)
+    besides the temporary file. The memory of a report is only that small if
+    its items are produced as they are appended too, as `build_section_data`
+    does by streaming the rows of one block at a time. The output is the
+    same as `json.dumps(items, indent=4)`.
+    Closing the file compresses and stores it, and sets `name`, `archive_size`
+    and `checksum` to those of the stored archive; leaving the `with` block
+    because of an exception discards it instead. The time spent serializing,
+    compressing and uploading is recorded in `metrics` if given.
+
+    If a `ReportUploader` is given, closing the file only submits it to be
+    compressed and saved in the background, so the caller can go on
+    producing data meanwhile; `wait` (or `describe`) waits until it is
+    stored.
+
+    The SHA-256 of the uncompressed contents is kept as `content_hash`. If
+    `previous_archives` (a dict of archive descriptions by `content_hash`,
+    see `describe`) has a stored archive with the same contents, closing the
+    file takes that archive as is (as `reused_archive`) instead of
+    compressing and saving a copy.
+    """
+    extension = 'json'
+
+    def __init__(self, report_store, course_id, filename, metrics=None, uploader=None, previous_archives=None):
+        self.report_store = report_store
+        self.course_id = course_id
+        self.metrics = metrics if metrics is not None else ReportMetrics()
+        self.uploader = uploader
+        self.previous_archives = previous_archives
+        self._future = None
+        self.name = filename
+        self.item_count = 0
+        self.size = 0
+        self.archive_size = None
+        self.checksum = None
+        self.content_hash = None
+        self.reused = False
+        self.reused_archive = None
+        self.closed = False
+        self._content_hash = hashlib.sha256()
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=settings.CMMEDU_SEGUIMIENTO_REPORT_SPOOL_MAX_SIZE)
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _write(self, contents):
+        self._buffer.write(contents)
+        self._content_hash.update(contents)
+        self.size += len(contents)
+
+    def _write_header(self):
+        self._write(b'[')
+
+    def _write_footer(self):
+        self._write(b'\n]' if self.item_count else b']')
+
+    def append(self, item):
+        """
+        Serialize `item` and add it at the end of the list.
+
+        The `responses` of an item can be any iterable, not only a list: they
+        are then serialized one by one as they are read, and the time spent
+        producing them is included in the `serialization` phase.
+        """
+        block_type = item.get('block_type') if isinstance(item, dict) else None
+        with self.metrics.phase('serialization', block_type):
+            if self.item_count:
+                self._write(b',')
+            if isinstance(item, dict) and not isinstance(item.get('responses', []), (list, tuple)):
+                self._append_streamed_responses(item)
+            else:
+                self._write(self._indent(json.dumps(item, ensure_ascii=False, indent=4, cls=JsonReportEncoder)).encode('utf-8'))
+        self.item_count += 1
+
+    @staticmethod
+    def _indent(item_json, indent='    '):
+        # JSON strings never contain raw newlines, so indenting every line
+        # nests the item one level as json.dumps would do for the whole list
+        return ('\n' + item_json).replace('\n', '\n' + indent)
+
+    def _append_streamed_responses(self, item):
+        """
+        Write `item` as `append` does, reading its `responses` one at a time.
+        """
+        marker_json = json.dumps(STREAMED_RESPONSES_MARKER, ensure_ascii=False)
+        item_json = json.dumps(dict(item, responses=STREAMED_RESPONSES_MARKER), ensure_ascii=False, indent=4, cls=JsonReportEncoder)
+        prefix, suffix = self._indent(item_json).split(marker_json)
+        key_line = prefix[prefix.rindex('\n') + 1:]
+        key_indent = key_line[:len(key_line) - len(key_line.lstrip(' '))]
+        self._write((prefix + '[').encode('utf-8'))
+        count = 0
+        for response in item['responses']:
+            response_json = json.dumps(response, ensure_ascii=False, indent=4, cls=JsonReportEncoder)
+            self._write(((',' if count else '') + self._indent(response_json, key_indent + '    ')).encode('utf-8'))
+            count += 1
+        self._write((('\n' + key_indent + ']' if count else ']') + suffix).encode('utf-8'))
+
+    def close(self):
+        """
+        Terminate the list and store the file, or submit it to the uploader.
+        """
+        if self.closed:
+            return
+        self._finish()
+        previous = (self.previous_archives or {}).get(self.content_hash)
+        if previous is not None and self.report_store.exists(self.course_id, previous['name']):
+            self._buffer.close()
+            self.reused = True
+            self.reused_archive = previous
+            self._set_stored(previous)
+        elif self.uploader is not None:
+            self._deferred_metrics = ReportMetrics()
+            self._future = self.uploader.submit(self._store, self._deferred_metrics)
+        else:
+            self._set_stored(self._store(self.metrics))
+
+    def _finish(self):
+        self._write_footer()
+        self._buffer.seek(0)
+        self.closed = True
+        self.content_hash = self._content_hash.hexdigest()
+
+    def _store(self, metrics):
+        try:
+            return self.report_store.store_file(self.course_id, self.name, self._buffer, self.size, metrics, self.extension)
+        finally:
+            self._buffer.close()
+
+    def _set_stored(self, stored):
+        self.name = stored['name']
+        self.archive_size = stored['size']
+        self.checksum = stored['checksum']
+
+    def done(self):
+        """
+        Return whether `wait` would return right away.
+        """
+        return self._future is None or self._future.done()
+
+    def wait(self):
+        """
+        Wait until the file submitted to the uploader is stored, raising any
+        error of the upload.
+
+        Returns the `ReportMetrics` of the compression and upload, which are
+        also added to `metrics`, or None if the file was stored on close.
+        """
+        if self._future is None:
+            return None
+        future, self._future = self._future, None
+        self._set_stored(future.result())
+        self.metrics.merge(self._deferred_metrics)
+        return self._deferred_metrics
+
+    def describe(self):
+        """
+        Return the name, number of items, size, checksum and content hash of
+        the stored file, as listed in report manifests, and whether it is an
+        archive of a previous report that was `reused`.
+        """
+        self.wait()
+        return {
+            'name': self.name,
+            'items': self.item_count,
+            'size': self.archive_size,
+            'checksum': self.checksum,
+            'content_hash': self.content_hash,
+            'reused': self.reused,
+        }
+
+    def discard(self):
+        """
+        Drop the contents written so far without storing anything.
+        """
+        self._buffer.close()
+        self.closed = True
+
+
+class ReportUploader(object):
+    """
+    Bounded pool of threads that compress and save report files in the
+    background, while the caller produces the next ones.
+
+    At most `max_pending` files are being stored or waiting for a thread at
+    once: `submit` blocks while there are that many, so a slow storage slows
+    down the producer instead of piling up archives. Leaving the `with` block
+    waits for every file and raises the first error, if any.
+    """
+    def __init__(self, threads=1, max_pending=None):
+        if max_pending is None:
+            max_pending = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cmmedu-seguimiento-upload')
+        self._slots = threading.BoundedSemaphore(max(max_pending, threads))
+        self._futures = []
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Return an uploader with `CMMEDU_SEGUIMIENTO_UPLOAD_THREADS` threads and
+        up to `CMMEDU_SEGUIMIENTO_UPLOAD_QUEUE_SIZE` more files waiting.
+        """
+        threads = settings.CMMEDU_SEGUIMIENTO_UPLOAD_THREADS
+        return cls(threads, threads + settings.CMMEDU_SEGUIMIENTO_UPLOAD_QUEUE_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def submit(self, function, *args):
+        """
+        Run `function(*args)` on a thread of the pool, waiting for a free slot
+        first. Returns its `Future`.
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Wait for every file submitted so far, raising the first error.
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+
+class JsonLinesReportFile(JsonReportFile):
+    """
+    `JsonReportFile` written in a normalized JSON Lines format, smaller than
+    the JSON list.
+
+    Every line is a compact JSON array whose first element is its kind:
+
+        ["p", parent, name]: a path, the path number `parent` (or null) plus
+            `name`. Paths are numbered in order of appearance, from 0.
+        ["u", username]: a username, numbered the same way.
+        ["k", keys]: a list of dict keys, numbered the same way.
+        ["r", keys, values]: an item, the dict of the key list number `keys`
+            and `values`.
+        ["b", keys, values]: a block item, written as an "r" line except for
+            its `path`, which is a path number, and its `responses`, which
+            are runs of responses with the same keys, each one written as
+            [keys, columns] with one list of values per key (usernames as
+            username numbers).
+
+    The first line is a header with the `format` and its `version`. Reading it
+    back with `iter_json_lines_items` gives the same items as the JSON list.
+    """
+    extension = 'jsonl'
+
+    def __init__(self, report_store, course_id, filename, metrics=None, uploader=None, previous_archives=None):
+        self._paths = {}
+        self._usernames = {}
+        self._keys = {}
+        super(JsonLinesReportFile, self).__init__(report_store, course_id, filename, metrics, uploader, previous_archives)
+
+    def _write_line(self, line):
+        self._write(json.dumps(line, ensure_ascii=False, separators=(',', ':'), cls=JsonReportEncoder).encode('utf-8') + b'\n')
+
+    def _write_header(self):
+        self._write_line({'format': JSONL_REPORT_FORMAT, 'version': JSONL_REPORT_VERSION})
+
+    def _write_footer(self):
+        pass
+
+    def _index(self, table, key, line):
+        """
+        Return the number of `key` in `table`, writing `line` to add it if it
+        is not there yet.
+        """
+        if key not in table:
+            self._write_line(line)
+            table[key] = len(table)
+        return table[key]
+
+    def _path_index(self, path):
+        path = tuple(path)
+        if path not in self._paths:
+            parent = self._path_index(path[:-1]) if len(path) > 1 else None
+            self._index(self._paths, path, ['p', parent, path[-1]])
+        return self._paths[path]
+
+    def _keys_index(self, keys):
+        keys = tuple(keys)
+        return self._index(self._keys, keys, ['k', list(keys)])
+
+    def _encode_responses(self, responses):
+        runs = []
+        for response in responses:
+            keys = self._keys_index(response.keys())
+            if not runs or runs[-1][0] != keys:
+                runs.append([keys, [[] for _ in response]])
+            for column, (key, value) in zip(runs[-1][1], response.items()):
+                if key == 'username':
+                    value = self._index(self._usernames, value, ['u', value])
+                column.append(value)
+        return runs
+
+    def append(self, item):
+        """
+        Serialize `item` and add it at the end of the list.
+        """
+        block_type = item.get('block_type') if isinstance(item, dict) else None
+        with self.metrics.phase('serialization', block_type):
+            if isinstance(item, dict) and isinstance(item.get('path'), list):
+                values = []
+                for key, value in item.items():
+                    if key == 'path':
+                        value = self._path_index(value)
+                    elif key == 'responses':
+                        value = self._encode_responses(value)
+                    values.append(value)
+                self._write_line(['b', self._keys_index(item.keys()), values])
+            else:
+                self._write_line(['r', self._keys_index(item.keys()), list(item.values())])
+        self.item_count += 1
+
+
+def iter_json_lines_items(lines):
+    """
+    Yield the items of a report written by `JsonLinesReportFile`, given its
+    lines.
+    """
+    paths = []
+    usernames = []
+    keys = []
+    for line in lines:
+        record = json.loads(line)
+        if isinstance(record, dict):
+            continue
+        kind = record[0]
+        if kind == 'p':
+            _, parent, name = record
+            paths.append((paths[parent] if parent is not None else []) + [name])
+        elif kind == 'u':
+            usernames.append(record[1])
+        elif kind == 'k':
+            keys.append(record[1])
+        elif kind == 'r':
+            yield dict(zip(keys[record[1]], record[2]))
+        elif kind == 'b':
+            item = dict(zip(keys[record[1]], record[2]))
+            item['path'] = list(paths[item['path']])
+            if 'responses' in item:
+                responses = []
+                for run_keys, columns in item['responses']:
+                    run_keys = keys[run_keys]
+                    for row in zip(*columns):
+                        response = dict(zip(run_keys, row))
+                        if 'username' in response:
+                            response['username'] = usernames[response['username']]
+                        responses.append(response)
+                item['responses'] = responses
+            yield item
+
+
+JSON_WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_items(contents):
+    """
+    Yield the items of a JSON list read from the binary file `contents`, as
+    written by `JsonReportFile`, decoding every item as soon as it has been
+    read whole.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    opened = False
+    for chunk in iter(lambda: contents.read(io.DEFAULT_BUFFER_SIZE), b''):
+        buffer += text_decoder.decode(chunk)
+        position = 0
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if not opened or char == ',':
+                if not opened and char != '[':
+                    raise ValueError("The report is not a JSON list.")
+                opened = True
+                position += 1
+                continue
+            if char == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The item continues in the next chunk
+                break
+            if end == len(buffer):
+                # A number may continue in the next chunk
+                break
+            yield item
+            position = end
+        buffer = buffer[position:]
+
+
+class ReportIndexFile(object):
+    """
+    Index of the responses of a report section, stored next to its archive
+    so that the responses of one block or one student can be read without
+    downloading and decompressing the whole archive.
+
+    The responses are stored a second time, in a chunks file, since the
+    archive cannot be read from an offset: it is a tar of the whole section
+    as a single JSON list (the format that clients download), compressed as
+    one stream with any of the `REPORT_COMPRESSIONS`. Reports are only
+    indexed when they are requested with `index` (see `get_report_plan`),
+    which roughly doubles the storage of their sections.
+
+    The responses are written to a chunks file, in chunks of at most
+    `chunk_size` responses of a single block. Every chunk is a gzip member
+    holding one JSON line (`{"block_id": ..., "responses": [...]}`), so it can
+    be read and decompressed on its own, and the whole file is still a valid
+    `.jsonl.gz`. The index is a plain JSON file with the byte range of every
+    chunk, the chunks of every block and the chunks with responses of every
+    student (its posting list):
+
+        {
+            "chunks": [[offset, length], ...],
+            "blocks": {block_id: {"path": [...], "block_type": ..., "chunks": [0, 1]}},
+            "users": {username: [0, 3]}
+        }
+
+    Closing the index stores both files, or submits them to `uploader`, and
+    `describe` returns their names, as `JsonReportFile` does.
+    """
+    def __init__(self, report_store, course_id, chunks_name, index_name, chunk_size, metrics=None, uploader=None):
+        self.report_store = report_store
+        self.course_id = course_id
+        self.chunks_name = chunks_name
+        self.index_name = index_name
+        self.chunk_size = chunk_size
+        self.metrics = metrics if metrics is not None else ReportMetrics()
+        self.uploader = uploader
+        self._future = None
+        self.size = 0
+        self.index = {'chunks': [], 'blocks': {}, 'users': {}}
+        self.closed = False
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=settings.CMMEDU_SEGUIMIENTO_REPORT_SPOOL_MAX_SIZE)
+
+    def iter_block(self, block_id, path, block_type, responses):
+        """
+        Yield the `responses` of a block, adding them to the index as they
+        are read.
+        """
+        self.index['blocks'][block_id] = {'path': path, 'block_type': block_type, 'chunks': []}
+        chunk = []
+        for response in responses:
+            chunk.append(response)
+            if len(chunk) >= self.chunk_size:
+                self._write_chunk(block_id, chunk)
+                chunk = []
+            yield response
+        if chunk:
+            self._write_chunk(block_id, chunk)
+
+    def _write_chunk(self, block_id, responses):
+        with self.metrics.phase('index'):
+            line = json.dumps({'block_id': block_id, 'responses': responses}, ensure_ascii=False, cls=JsonReportEncoder)
+            data = gzip.compress(line.encode('utf-8') + b'\n', mtime=0)
+            chunk_number = len(self.index['chunks'])
+            self.index['chunks'].append([self.size, len(data)])
+            self.index['blocks'][block_id]['chunks'].append(chunk_number)
+            for username in set(response['username'] for response in responses):
+                self.index['users'].setdefault(username, []).append(chunk_number)
+            self._buffer.write(data)
+            self.size += len(data)
+
+    def close(self):
+        """
+        Store the chunks and the index, or submit them to the uploader.
+        """
+        if self.closed:
+            return
+        self._buffer.seek(0)
+        self.closed = True
+        if self.uploader is not None:
+            self._deferred_metrics = ReportMetrics()
+            self._future = self.uploader.submit(self._store, self._deferred_metrics)
+        else:
+            self._set_stored(self._store(self.metrics))
+
+    def _store(self, metrics):
+        try:
+            with metrics.phase('upload'):
+                chunks_name = self.report_store.storage.save(
+                    self.report_store.path_to(self.course_id, self.chunks_name),
+                    File(self._buffer, name=self.chunks_name)
+                )
+                index_name = self.report_store.store_manifest(self.course_id, self.index_name, self.index)
+            return os.path.basename(chunks_name), index_name
+        finally:
+            self._buffer.close()
+
+    def _set_stored(self, stored):
+        self.chunks_name, self.index_name = stored
+
+    def done(self):
+        """
+        Return whether `wait` would return right away.
+        """
+        return self._future is None or self._future.done()
+
+    def wait(self):
+        """
+        Wait until the files submitted to the uploader are stored, and return
+        the `ReportMetrics` of their upload, or None if they were stored on
+        close.
+        """
+        if self._future is None:
+            return None
+        future, self._future = self._future, None
+        self._set_stored(future.result())
+        self.metrics.merge(self._deferred_metrics)
+        return self._deferred_metrics
+
+    def describe(self):
+        """
+        Return the names of the stored chunks and index, the size of the
+        chunks file and its number of chunks, as listed in report manifests.
+        """
+        self.wait()
+        return {
+            'chunks': self.chunks_name,
+            'index': self.index_name,
+            'size': self.size,
+            'chunk_count': len(self.index['chunks']),
+        }
+
+    def discard(self):
+        """
+        Drop the index without storing anything.
+        """
+        self._buffer.close()
+        self.closed = True
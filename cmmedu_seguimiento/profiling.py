@@ -0,0 +1,154 @@
+from contextlib import contextmanager, ExitStack
+from django.db import connections
+import resource
+from time import time
+
+
+class ReportMetrics(object):
+    """
+    Instrumentation of a report task, or of one of its parts (a section, the
+    student profile, a subtask...).
+
+    `track` measures the wall time, the number and time of the database
+    queries (on every database alias) and how much the peak resident memory of
+    the process grew while the part ran (`rss_growth_kb`: 0 if the part stayed
+    below the peak reached before it, by this or by earlier tasks of the same
+    worker process). `phase` measures the calls and time of a named phase
+    (`get_item`, `generate_report_data`, `serialization`, `compression`,
+    `upload`...), both in total and per block type when one is given.
+    """
+    def __init__(self):
+        self.wall_time = 0.0
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.rss_growth_kb = 0
+        self.phases = {}
+        self.block_types = {}
+
+    def _record_query(self, execute, sql, params, many, context):
+        start = time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_time += time() - start
+
+    @contextmanager
+    def track(self):
+        """
+        Measure wall time, database queries and peak memory growth of the
+        block.
+        """
+        start = time()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(self._record_query))
+            try:
+                yield self
+            finally:
+                self.wall_time += time() - start
+                rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+                self.rss_growth_kb = max(self.rss_growth_kb, rss_growth)
+
+    @contextmanager
+    def phase(self, name, block_type=None):
+        """
+        Measure the time spent in the block as a call of the phase `name`.
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time() - start, block_type)
+
+    def add_phase_time(self, name, elapsed, block_type=None):
+        """
+        Record a call of the phase `name` that took `elapsed` seconds, for
+        phases that are not measured in a single block.
+        """
+        self._add_phase(self.phases, name, 1, elapsed)
+        if block_type is not None:
+            self._add_phase(self.block_types.setdefault(block_type, {}), name, 1, elapsed)
+
+    @staticmethod
+    def _add_phase(phases, name, calls, elapsed):
+        phase = phases.setdefault(name, {'calls': 0, 'time': 0.0})
+        phase['calls'] += calls
+        phase['time'] += elapsed
+
+    def merge(self, other):
+        """
+        Add the phases of `other`, the metrics of a part measured while this
+        one was being tracked, to these metrics.
+        """
+        for name, phase in other.phases.items():
+            self._add_phase(self.phases, name, phase['calls'], phase['time'])
+        for block_type, phases in other.block_types.items():
+            for name, phase in phases.items():
+                self._add_phase(self.block_types.setdefault(block_type, {}), name, phase['calls'], phase['time'])
+        self.rss_growth_kb = max(self.rss_growth_kb, other.rss_growth_kb)
+
+    def add(self, other):
+        """
+        Add all the metrics of `other`, the metrics of a part measured apart
+        (e.g. by another subtask), to these metrics.
+        """
+        self.merge(other)
+        self.wall_time += other.wall_time
+        self.db_queries += other.db_queries
+        self.db_time += other.db_time
+
+    def as_dict(self):
+        """
+        Return all the metrics as a JSON serializable dict.
+        """
+        return {
+            'wall_time': round(self.wall_time, 3),
+            'db_queries': self.db_queries,
+            'db_time': round(self.db_time, 3),
+            'rss_growth_kb': self.rss_growth_kb,
+            'phases': self._round_phases(self.phases),
+            'block_types': {
+                block_type: self._round_phases(phases)
+                for block_type, phases in self.block_types.items()
+            },
+        }
+
+    def summary(self):
+        """
+        Return the totals and the time per phase, small enough to be stored in
+        the output of an `InstructorTask`.
+        """
+        return {
+            'wall_time': round(self.wall_time, 1),
+            'db_queries': self.db_queries,
+            'db_time': round(self.db_time, 1),
+            'rss_growth_kb': self.rss_growth_kb,
+            'phases': {name: round(phase['time'], 1) for name, phase in self.phases.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Return the metrics serialized by `as_dict`.
+        """
+        metrics = cls()
+        metrics.wall_time = data['wall_time']
+        metrics.db_queries = data['db_queries']
+        metrics.db_time = data['db_time']
+        # Metrics stored before `rss_growth_kb` have no comparable field
+        metrics.rss_growth_kb = data.get('rss_growth_kb', 0)
+        metrics.phases = {name: dict(phase) for name, phase in data['phases'].items()}
+        metrics.block_types = {
+            block_type: {name: dict(phase) for name, phase in phases.items()}
+            for block_type, phases in data['block_types'].items()
+        }
+        return metrics
+
+    @staticmethod
+    def _round_phases(phases):
+        return {
+            name: {'calls': phase['calls'], 'time': round(phase['time'], 3)}
+            for name, phase in phases.items()
+        }
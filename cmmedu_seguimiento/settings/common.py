@@ -1,2 +1,35 @@
 def plugin_settings(settings):
-    settings.CMMEDU_SEGUIMIENTO_KEY = "test_key_cmmedu"
\ No newline at end of file
+    settings.CMMEDU_SEGUIMIENTO_KEY = "test_key_cmmedu"
+    settings.CMMEDU_SEGUIMIENTO_PREFETCH_CHUNK_SIZE = 2000
+    settings.CMMEDU_SEGUIMIENTO_REPORT_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+    settings.CMMEDU_SEGUIMIENTO_COURSE_EXISTS_CACHE_TIMEOUT = 60
+    settings.CMMEDU_SEGUIMIENTO_PROGRESS_INTERVAL = 5
+    settings.CMMEDU_SEGUIMIENTO_PROGRESS_TIMEOUT = 24 * 60 * 60
+    settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION = 'gz'
+    settings.CMMEDU_SEGUIMIENTO_REPORT_COMPRESSION_LEVEL = 6
+    settings.CMMEDU_SEGUIMIENTO_UPLOAD_THREADS = 2
+    settings.CMMEDU_SEGUIMIENTO_UPLOAD_QUEUE_SIZE = 2
+    settings.CMMEDU_SEGUIMIENTO_BATCH_CONCURRENCY = 4
+    settings.CMMEDU_SEGUIMIENTO_BATCH_POLL_INTERVAL = 30
+    settings.CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT = 7 * 24 * 60 * 60
+    settings.CMMEDU_SEGUIMIENTO_REPORT_INDEX = False
+    settings.CMMEDU_SEGUIMIENTO_INDEX_CHUNK_SIZE = 100
+    settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES = 0
+    settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_BYTES = 0
+    settings.CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE = 1000
+    settings.CMMEDU_SEGUIMIENTO_ORA_BATCH_SIZE = 500
+    settings.CMMEDU_SEGUIMIENTO_ORA_SPLIT_BY_BLOCK = False
+    settings.CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME = None
+    settings.CMMEDU_SEGUIMIENTO_SCHEDULE_FEATURES = {
+        'parallel': False, 'mode': 'full', 'compact': False, 'format': 'classic', 'profile': False,
+    }
+    settings.CMMEDU_SEGUIMIENTO_SCHEDULE_LOOKBACK = 7 * 24 * 60 * 60
+    settings.CMMEDU_SEGUIMIENTO_SCHEDULE_WINDOW = 4 * 60 * 60
+    settings.CMMEDU_SEGUIMIENTO_SCHEDULE_CONCURRENCY = 2
+    settings.CMMEDU_SEGUIMIENTO_ESTIMATE_RATES = {
+        'block': 0.01, 'response': 0.0005, 'byte': 0.00000002, 'profile_row': 0.001, 'ora_row': 0.005,
+    }
+    settings.CMMEDU_SEGUIMIENTO_ESTIMATE_WORKERS = 4
+    settings.CMMEDU_SEGUIMIENTO_WORK_PLAN_TIMEOUT = 10 * 60
+    settings.CMMEDU_SEGUIMIENTO_REPORT_DATABASE = 'read_replica'
+    settings.CMMEDU_SEGUIMIENTO_REPORT_DATABASE_LAG = 5 * 60
\ No newline at end of file
@@ -0,0 +1,6 @@
+def plugin_settings(settings):
+    # An empty database of its own, that tests use as a read replica
+    settings.DATABASES['report_replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'ATOMIC_REQUESTS': True,
+    }
\ No newline at end of file
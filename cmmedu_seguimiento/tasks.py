@@ -1,33 +1,545 @@
-from celery import task
+from celery import chord, task
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.states import FAILURE, READY_STATES, SUCCESS
+from common.djangoapps.student.models import CourseEnrollment
+from common.djangoapps.util.db import outer_atomic
+from datetime import datetime, timedelta
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext_noop
 from functools import partial
-from lms.djangoapps.instructor_task.api_helper import submit_task
+from lms.djangoapps.instructor_task.api_helper import (
+    _get_xmodule_instance_args,
+    _handle_instructor_task_failure,
+    _reserve_task,
+    AlreadyRunningError,
+    submit_task,
+)
+from lms.djangoapps.instructor_task.models import InstructorTask
+from lms.djangoapps.instructor_task.subtasks import initialize_subtask_info
 from lms.djangoapps.instructor_task.tasks_base import BaseInstructorTask
-from lms.djangoapps.instructor_task.tasks_helper.runner import run_main_task
+from lms.djangoapps.instructor_task.tasks_helper.runner import run_main_task, TaskProgress
+import logging
+from opaque_keys.edx.keys import CourseKey
+from pytz import UTC
+from time import time
+import traceback
+from uuid import uuid4
 
-from .utils import make_report
+from .profiling import ReportMetrics
+from .utils import (
+    build_blocks_data,
+    count_report_blocks,
+    get_batch_profile_fields,
+    get_course_root,
+    get_plan_output_mode,
+    get_profile_fields,
+    get_report_database,
+    get_report_batch,
+    get_report_metadata,
+    get_report_plan,
+    get_stale_course_keys,
+    get_work_plan_cache_key,
+    log_report_metrics,
+    make_report,
+    plan_report_files,
+    plan_report_work,
+    ReportCheckpoint,
+    ReportProgress,
+    REPORT_TASK_TYPE,
+    save_report_batch,
+    start_report_progress,
+    upload_ora_data,
+    upload_report_manifest,
+    upload_student_profile_data,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Times a report task that hits its soft time limit is retried, resuming from
+# its checkpoint (see `ReportCheckpoint`)
+REPORT_MAX_RETRIES = 3
+
+# Options of the subtasks of a parallel report, which are also acknowledged
+# once they finish and retried when they hit their soft time limit
+REPORT_SUBTASK_OPTIONS = {
+    'acks_late': True,
+    'autoretry_for': (SoftTimeLimitExceeded,),
+    'retry_kwargs': {'max_retries': REPORT_MAX_RETRIES},
+}
 
 
 def submit_task_make_report(request, course_key, features):
     """
     Submits a task to generate a CSV containing student profile info.
+    If `features['parallel']` is set, the report sections are generated by
+    parallel subtasks. `features['mode']` and `features['compact']` select an
+    incremental report, `features['format']` the format of its files and
+    `features['index']` whether it is indexed for queries (see
+    `get_report_plan`).
 
     Raises AlreadyRunningError if said CSV is already being updated.
     """
-    task_type = 'cmmedu_seguimiento_report'
-    task_class = task_make_report
     task_input = features
-    task_key = "CMMEDU-SEGUIMIENTO-REPORT-{}".format(str(course_key))
+    task_key = get_report_task_key(course_key)
 
-    return submit_task(request, task_type, task_class, course_key, task_input, task_key)
+    return submit_task(request, REPORT_TASK_TYPE, get_report_task_class(features), course_key, task_input, task_key)
 
 
-@task(base=BaseInstructorTask)
+def request_report_work_plan(course_key, features):
+    """
+    Return the work plan of a report of the course with the given features
+    (see `task_plan_report`), or None if it is not ready yet, after
+    requesting it unless it is already being computed.
+    """
+    cache_key = get_work_plan_cache_key(course_key, features)
+    work_plan = cache.get(cache_key)
+    # An empty work plan marks one being computed
+    if work_plan is None and cache.add(cache_key, {}, settings.CMMEDU_SEGUIMIENTO_WORK_PLAN_TIMEOUT):
+        task_plan_report.delay(str(course_key), features)
+        # Eager tasks have already stored it
+        work_plan = cache.get(cache_key)
+    return work_plan or None
+
+
+@task
+def task_plan_report(course_id, features):
+    """
+    Store in the cache, for `CMMEDU_SEGUIMIENTO_WORK_PLAN_TIMEOUT` seconds,
+    the output mode and the work plan that a report of the course with the
+    given features would follow (see `plan_report_work`), so that a dry run
+    of the report does not compute it in the request.
+    """
+    course_key = CourseKey.from_string(course_id)
+    cache_key = get_work_plan_cache_key(course_key, features)
+    try:
+        plan = get_report_plan(course_key, features['mode'], features['compact'], features['format'], features.get('index', False))
+        work = plan_report_work(features['user_id'], course_key, plan)
+    except Exception:
+        # Requested again by the next dry run
+        cache.delete(cache_key)
+        raise
+    cache.set(cache_key, {'mode': get_plan_output_mode(plan), 'plan': work}, settings.CMMEDU_SEGUIMIENTO_WORK_PLAN_TIMEOUT)
+
+
+def get_report_task_class(features):
+    """
+    Return the task that generates a report with the given features.
+    """
+    return task_make_report_parallel if features.get('parallel') else task_make_report
+
+
+def get_report_task_key(course_key):
+    """
+    Return the key that prevents two reports of a course from running at once.
+    """
+    return "CMMEDU-SEGUIMIENTO-REPORT-{}".format(str(course_key))
+
+
+def submit_batch_make_report(request, course_keys, features, concurrency=None):
+    """
+    Schedule a report task of every course of `course_keys` with the given
+    features, so that at most `concurrency` of them
+    (`CMMEDU_SEGUIMIENTO_BATCH_CONCURRENCY` by default) run at once. The
+    tasks of the batch share the site configuration, looked up only once,
+    and the users they read (see `iter_student_profiles`).
+
+    A course whose report is already running when its turn comes is left out
+    of the batch, with its error. Returns the batch (see
+    `task_schedule_batch_report`).
+    """
+    return create_batch_make_report(
+        course_keys, features, request.user, _get_xmodule_instance_args(request, None), concurrency
+    )
+
+
+def create_batch_make_report(course_keys, features, user, instance_args, concurrency=None, window=None, global_concurrency=False):
+    """
+    Create and schedule a batch of reports as `submit_batch_make_report`
+    does, requested by `user`. `instance_args` are the
+    `xmodule_instance_args` of every task, but for its `task_id`.
+
+    If `window` is given, the tasks start no sooner than spread evenly over
+    the next `window` seconds, in the order of `course_keys`. If
+    `global_concurrency` is set, `concurrency` counts every running report
+    task, not only those of the batch.
+    """
+    batch = {
+        'id': str(uuid4()),
+        'created': datetime.now(UTC).isoformat(),
+        'concurrency': concurrency or settings.CMMEDU_SEGUIMIENTO_BATCH_CONCURRENCY,
+        'global_concurrency': global_concurrency,
+        'features': features,
+        'user_id': user.pk,
+        'instance_args': instance_args,
+        'profile_fields': get_profile_fields(),
+        'courses': [
+            {'course_key': str(course_key), 'entry_id': None, 'task_id': None, 'submitted': False, 'error': None}
+            for course_key in course_keys
+        ],
+    }
+    if window:
+        start = datetime.now(UTC)
+        for index, course in enumerate(batch['courses']):
+            course['not_before'] = (start + timedelta(seconds=window * index / len(batch['courses']))).isoformat()
+    save_report_batch(batch)
+    logger.info("Created batch %s of %d reports.", batch['id'], len(batch['courses']))
+    task_schedule_batch_report.delay(batch['id'])
+    return batch
+
+
+@task
+def task_schedule_batch_report(batch_id):
+    """
+    Reserve and submit the tasks of a batch of reports that are due while
+    less than its concurrency are running, and check again in
+    `CMMEDU_SEGUIMIENTO_BATCH_POLL_INTERVAL` seconds until every course of
+    the batch has been submitted.
+
+    A task is only reserved when it is submitted, so if the batch expires
+    (or is evicted from the cache) the courses not submitted yet are left
+    out without an `InstructorTask` blocking their next report.
+    """
+    batch = get_report_batch(batch_id)
+    if batch is None:
+        logger.warning("Batch %s of reports has expired, its courses not submitted yet are left out.", batch_id)
+        return
+    user = get_user_model().objects.get(pk=batch['user_id'])
+    task_input = dict(batch['features'], batch_id=batch['id'])
+    task_class = get_report_task_class(batch['features'])
+    courses = batch['courses']
+    pending = [course for course in courses if not course['submitted']]
+    count_running = count_running_report_tasks if batch.get('global_concurrency') else count_running_batch_tasks
+    now = datetime.now(UTC)
+    while pending and is_batch_course_due(pending[0], now) and count_running(courses) < batch['concurrency']:
+        course = pending.pop(0)
+        course['submitted'] = True
+        course_key = CourseKey.from_string(course['course_key'])
+        try:
+            with outer_atomic():
+                entry = _reserve_task(course_key, REPORT_TASK_TYPE, get_report_task_key(course_key), task_input, user)
+        except AlreadyRunningError:
+            course['error'] = "Esta tarea ya está en progreso."
+            save_report_batch(batch)
+            continue
+        course.update({'entry_id': entry.id, 'task_id': entry.task_id})
+        save_report_batch(batch)
+        try:
+            task_class.apply_async([entry.id, dict(batch['instance_args'], task_id=entry.task_id)], task_id=entry.task_id)
+        except Exception as error:
+            _handle_instructor_task_failure(entry, error)
+    if pending:
+        task_schedule_batch_report.apply_async([batch_id], countdown=settings.CMMEDU_SEGUIMIENTO_BATCH_POLL_INTERVAL)
+    else:
+        logger.info("Submitted every report of batch %s.", batch_id)
+
+
+def is_batch_course_due(course, now):
+    """
+    Return whether the report task of a course of a batch can start at `now`.
+    """
+    return course.get('not_before') is None or datetime.fromisoformat(course['not_before']) <= now
+
+
+def count_running_batch_tasks(courses):
+    """
+    Return the number of submitted report tasks of a batch not finished yet.
+    """
+    entry_ids = [course['entry_id'] for course in courses if course['entry_id'] is not None]
+    return InstructorTask.objects.filter(pk__in=entry_ids).exclude(task_state__in=READY_STATES).count()
+
+
+def count_running_report_tasks(courses):
+    """
+    Return the number of report tasks not finished yet, of the batch of
+    `courses` or not. Tasks older than `CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT` are
+    left out, since they were lost.
+    """
+    return InstructorTask.objects.filter(
+        task_type=REPORT_TASK_TYPE,
+        created__gte=datetime.now(UTC) - timedelta(seconds=settings.CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT)
+    ).exclude(task_state__in=READY_STATES).count()
+
+
+def schedule_stale_reports(username=None, window=None, concurrency=None, lookback=None, dry_run=False):
+    """
+    Request the report of every course with student state, enrollment or ORA
+    activity since its last successful report (and within the last
+    `lookback` seconds), as a batch staggered over the next `window` seconds
+    with at most `concurrency` report tasks running at once, largest courses
+    first. The defaults are the `CMMEDU_SEGUIMIENTO_SCHEDULE_*` settings.
+
+    Returns the keys of the courses and the batch, which is None if there are
+    no courses or for a `dry_run`.
+    """
+    username = username or settings.CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME
+    user = get_user_model().objects.get(username=username)
+    if lookback is None:
+        lookback = settings.CMMEDU_SEGUIMIENTO_SCHEDULE_LOOKBACK
+    course_keys = get_stale_course_keys(datetime.now(UTC) - timedelta(seconds=lookback))
+    logger.info("Found %d courses with activity since their last report.", len(course_keys))
+    if dry_run or not course_keys:
+        return course_keys, None
+    features = dict(settings.CMMEDU_SEGUIMIENTO_SCHEDULE_FEATURES, user_id=user.pk)
+    batch = create_batch_make_report(
+        course_keys,
+        features,
+        user,
+        get_scheduled_instance_args(user, None),
+        concurrency or settings.CMMEDU_SEGUIMIENTO_SCHEDULE_CONCURRENCY,
+        window if window is not None else settings.CMMEDU_SEGUIMIENTO_SCHEDULE_WINDOW,
+        global_concurrency=True
+    )
+    return course_keys, batch
+
+
+def get_scheduled_instance_args(user, task_id):
+    """
+    Return the `xmodule_instance_args` of a report task requested by
+    `user` without a request.
+    """
+    return {
+        'xqueue_callback_url_prefix': '',
+        'request_info': {'username': user.username, 'user_id': user.id, 'ip': None, 'agent': None, 'host': None},
+        'task_id': task_id,
+    }
+
+
+@task
+def task_schedule_stale_reports():
+    """
+    Request the reports of the courses with activity since their last report
+    (see `schedule_stale_reports`). Meant to run periodically from Celery
+    beat, at the start of the off-peak window.
+    """
+    if not settings.CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME:
+        logger.warning("CMMEDU_SEGUIMIENTO_SCHEDULE_USERNAME is not set, no reports are scheduled.")
+        return
+    schedule_stale_reports()
+
+
+class ReportTask(BaseInstructorTask):
+    """
+    Base of the report tasks that resume from a checkpoint (see
+    `ReportCheckpoint`): the checkpoint of a task that fails for good is
+    removed, since no retry will resume from it.
+    """
+    abstract = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        entry_id = args[0]
+        try:
+            entry = InstructorTask.objects.get(pk=entry_id)
+            ReportCheckpoint(entry_id, entry.course_id).remove()
+        except Exception:
+            logger.warning("Could not remove the checkpoint of report task %s.", entry_id, exc_info=True)
+        super().on_failure(exc, task_id, args, kwargs, einfo)
+
+
+@task(
+    base=ReportTask,
+    acks_late=True,
+    autoretry_for=(SoftTimeLimitExceeded,),
+    retry_kwargs={'max_retries': REPORT_MAX_RETRIES}
+)
 def task_make_report(entry_id, xmodule_instance_args):
     """
     Compute student profile information for a course and upload the
     CSV to an S3 bucket for download.
+
+    The task is acknowledged once it finishes, so that it is delivered again
+    if its worker dies, and it is retried if it hits its soft time limit.
+    Either way, the retry resumes the report from its checkpoint.
     """
     action_name = ugettext_noop('generated')
     task_fn = partial(make_report, xmodule_instance_args)
-    return run_main_task(entry_id, task_fn, action_name)
\ No newline at end of file
+    return run_main_task(entry_id, task_fn, action_name)
+
+
+@task(base=BaseInstructorTask)
+def task_make_report_parallel(entry_id, xmodule_instance_args):
+    """
+    Same as `task_make_report`, but the student profile, the ORA data and
+    every section of the blocks data are generated by independent subtasks.
+
+    This task only queues the subtasks, so it is not retried. Each subtask
+    stores a single part of the report, so it needs no checkpoint: it is
+    retried as a whole, like `task_make_report` (see `REPORT_SUBTASK_OPTIONS`).
+    """
+    action_name = ugettext_noop('generated')
+    task_fn = partial(make_report_parallel, xmodule_instance_args)
+    return run_main_task(entry_id, task_fn, action_name)
+
+
+def make_report_parallel(_xmodule_instance_args, entry_id, course_id, task_input, action_name):
+    """
+    Split the report of `course_id` in one subtask for the student profile,
+    one for the ORA data and one per section (chapter), and run them as a
+    chord whose callback marks the `InstructorTask` as finished.
+
+    The subtasks are registered in the `InstructorTask`, so the instructor
+    task machinery leaves the final state to `task_finish_report`. A subtask
+    that fails marks the whole task as failed.
+    """
+    start_time = time()
+    start_date = datetime.now(UTC)
+    course_id_str = str(course_id)
+    timestamp = start_date.isoformat()
+
+    plan = get_report_plan(
+        course_id,
+        task_input.get('mode', 'full'),
+        task_input.get('compact', False),
+        task_input.get('format', 'classic'),
+        task_input.get('index', False)
+    )
+    plan_report_files(task_input["user_id"], course_id, plan)
+    if plan.get('estimate'):
+        section_blocks = [section['blocks'] for section in plan['estimate']['sections']]
+        section_seconds = {section['index']: section['seconds'] for section in plan['estimate']['sections']}
+    else:
+        section_blocks = count_report_blocks(task_input["user_id"], course_id, get_course_root(course_id), plan)
+        section_seconds = {}
+    n_sections = max(len(section_blocks), 1)
+    # The sections estimated to take longest are queued first
+    section_order = sorted(range(1, n_sections + 1), key=lambda index: -section_seconds.get(index, 0))
+    subtasks = [
+        task_make_report_student_profile.si(
+            entry_id, course_id_str, timestamp, plan, get_batch_profile_fields(task_input), task_input.get('batch_id')
+        ),
+        task_make_report_ora_data.si(entry_id, course_id_str, timestamp, plan, task_input.get('split_ora')),
+    ] + [
+        task_make_report_section.si(entry_id, course_id_str, task_input["user_id"], timestamp, index, plan)
+        for index in section_order
+    ]
+    parts = ['student_profile', 'ora_data'] + ['section_{}'.format(index) for index in range(1, n_sections + 1)]
+    start_report_progress(entry_id, parts, start_time, sum(section_blocks))
+    subtask_ids = [str(uuid4()) for _ in subtasks]
+    for subtask, subtask_id in zip(subtasks, subtask_ids):
+        subtask.set(task_id=subtask_id)
+
+    entry = InstructorTask.objects.get(pk=entry_id)
+    progress = initialize_subtask_info(entry, action_name, len(subtasks), subtask_ids)
+    logger.info("Queued %d report subtasks for course %s.", len(subtasks), course_id)
+
+    chord(subtasks)(task_finish_report.s(entry_id, course_id_str, timestamp, start_time, action_name, plan, section_order))
+    return progress
+
+
+@task(base=BaseInstructorTask, **REPORT_SUBTASK_OPTIONS)
+def task_make_report_student_profile(entry_id, course_id, timestamp, plan=None, profile_fields=None, batch_id=None):
+    """
+    Store the student profile of a parallel report.
+    """
+    progress = ReportProgress(entry_id, 'student_profile')
+    progress.set_stage('student_profile')
+    metrics = ReportMetrics()
+    with metrics.track():
+        report = upload_student_profile_data(
+            CourseKey.from_string(course_id), datetime.fromisoformat(timestamp), plan, metrics, profile_fields, batch_id
+        )
+    report['metrics'] = metrics.as_dict()
+    progress.add(bytes_uploaded=report['size'])
+    progress.set_stage('done')
+    return report
+
+
+@task(base=BaseInstructorTask, **REPORT_SUBTASK_OPTIONS)
+def task_make_report_ora_data(entry_id, course_id, timestamp, plan=None, split_by_block=None):
+    """
+    Store the ORA data of a parallel report.
+    """
+    progress = ReportProgress(entry_id, 'ora_data')
+    progress.set_stage('ora_data')
+    metrics = ReportMetrics()
+    with metrics.track():
+        report = upload_ora_data(
+            CourseKey.from_string(course_id), datetime.fromisoformat(timestamp), plan, metrics, split_by_block
+        )
+    report['metrics'] = metrics.as_dict()
+    progress.add(bytes_uploaded=report['size'])
+    progress.set_stage('done')
+    return report
+
+
+@task(base=BaseInstructorTask, **REPORT_SUBTASK_OPTIONS)
+def task_make_report_section(entry_id, course_id, user_id, timestamp, index, plan=None):
+    """
+    Store the `report_data_{index}` section of a parallel report.
+    """
+    course_key = CourseKey.from_string(course_id)
+    progress = ReportProgress(entry_id, 'section_{}'.format(index))
+    progress.set_stage('blocks_data')
+    sections = build_blocks_data(
+        user_id=user_id,
+        course_key=course_key,
+        usage_key_str=get_course_root(course_key),
+        start_date=datetime.fromisoformat(timestamp),
+        section_indexes=[index],
+        plan=plan,
+        progress=progress,
+        metrics=ReportMetrics()
+    )
+    progress.set_stage('done')
+    return sections
+
+
+@task
+def task_finish_report(results, entry_id, course_id, timestamp, start_time, action_name, plan=None, section_order=None):
+    """
+    Chord callback of a parallel report (see `finish_report_parallel`).
+
+    No retry or later task would mark the `InstructorTask` as finished, and
+    a task left in progress blocks every later report of the course, so if
+    finishing the report fails the task is marked as failed with the error.
+    """
+    try:
+        return finish_report_parallel(results, entry_id, course_id, timestamp, start_time, action_name, plan, section_order)
+    except Exception as error:
+        logger.exception("Could not finish the parallel report for course %s.", course_id)
+        entry = InstructorTask.objects.get(pk=entry_id)
+        entry.task_output = InstructorTask.create_output_for_failure(error, traceback.format_exc())
+        entry.task_state = FAILURE
+        entry.save_now()
+
+
+def finish_report_parallel(results, entry_id, course_id, timestamp, start_time, action_name, plan=None, section_order=None):
+    """
+    Store the manifest of a parallel report, given the `results` of its
+    subtasks, and the same `InstructorTask` output that `make_report`
+    returns, and mark it as successful. `section_order` is the index of the
+    section of every subtask after the first two, if they were not queued in
+    order.
+    """
+    course_key = CourseKey.from_string(course_id)
+    start_date = datetime.fromisoformat(timestamp)
+    student_profile_report, ora_report = results[:2]
+    section_results = results[2:]
+    if section_order:
+        section_results = [task_sections for _, task_sections in sorted(zip(section_order, section_results))]
+    sections = [section for task_sections in section_results for section in task_sections]
+
+    # Metrics of the whole report, adding up those of every file
+    metrics = ReportMetrics()
+    for report in [student_profile_report, ora_report] + sections:
+        if report.get('metrics'):
+            metrics.add(ReportMetrics.from_dict(report['metrics']))
+    log_report_metrics(course_key, metrics)
+
+    manifest_name = upload_report_manifest(course_key, start_date, plan, student_profile_report, ora_report, sections, metrics)
+    enrolled_students = CourseEnrollment.objects.users_enrolled_in(course_key).using(get_report_database())
+    task_progress = TaskProgress(action_name, enrolled_students.count(), start_time)
+
+    current_step = {'step': 'Report ready.'}
+    current_step.update(get_report_metadata(course_key, start_date, len(sections), plan, manifest_name))
+    current_step['metrics'] = metrics.summary()
+    progress = task_progress.update_task_state(extra_meta=current_step)
+
+    entry = InstructorTask.objects.get(pk=entry_id)
+    entry.task_output = InstructorTask.create_output_for_success(progress)
+    entry.task_state = SUCCESS
+    entry.save_now()
+    logger.info("Finished parallel report for course %s.", course_id)
+    return progress
@@ -1,18 +1,91 @@
-from django.test import Client
+from datetime import datetime, timedelta
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
 from xmodule.modulestore.tests.factories import CourseFactory, ItemFactory
+from common.djangoapps.student.models import anonymous_id_for_user, CourseEnrollment, UserProfile
 from common.djangoapps.student.tests.factories import UserFactory, CourseEnrollmentFactory
 from capa.tests.response_xml_factory import StringResponseXMLFactory
+from lms.djangoapps.course_blocks.api import get_course_blocks
+from lms.djangoapps.courseware.models import StudentModule
 from lms.djangoapps.courseware.tests.factories import StudentModuleFactory
+from lms.djangoapps.instructor_analytics.basic import enrolled_students_features
+from lms.djangoapps.instructor_task.models import InstructorTask
+from lms.djangoapps.instructor_task.tests.factories import InstructorTaskFactory
+import hashlib
+import json
+import logging
+from opaque_keys.edx.keys import CourseKey
+from openassessment.data import OraAggregateData
+from pytz import UTC
 from six.moves import range
+import shutil
+from submissions import api as sub_api
+import tarfile
+import tempfile
+from time import sleep, time
+from unittest import mock
+
+from .models import DjangoStorageJsonReportStore, JsonReportEncoder, JsonReportStore, ReportUploader
+from .tasks import REPORT_TASK_TYPE, schedule_stale_reports, task_schedule_batch_report
+from .utils import (
+    build_section_data,
+    course_exists,
+    get_batch_cache_key,
+    get_course_root,
+    get_estimate_calibration,
+    get_report_batch,
+    get_report_database,
+    get_report_plan,
+    iter_block_responses,
+    iter_ora_rows,
+    iter_student_modules,
+    iter_student_profiles,
+    list_problem_responses,
+    load_batch_students,
+    load_content_snapshot,
+    ReportProgress,
+    start_report_progress,
+    UserStateIterator,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 XBLOCK_COUNT = 10
 
 USER_COUNT = 5
 
+ENDPOINT_REPEAT = 5
+
+# Database queries allowed for a request to a report endpoint of an existing
+# course: session, user and permission lookups plus the task queries
+ENDPOINT_QUERY_BUDGET = 15
+
+SLOW_STORAGE_DELAY = 0.2
+
+
+class SlowFileSystemStorage(FileSystemStorage):
+    """
+    File system storage that takes `SLOW_STORAGE_DELAY` seconds to save every
+    file, like a remote storage would.
+    """
+    def _save(self, name, content):
+        sleep(SLOW_STORAGE_DELAY)
+        return super(SlowFileSystemStorage, self)._save(name, content)
+
+
 class TestCMMEduSeguimiento(ModuleStoreTestCase):
+    databases = '__all__'
 
     def setUp(self):
         super(TestCMMEduSeguimiento, self).setUp()
@@ -68,6 +141,22 @@ class TestCMMEduSeguimiento(ModuleStoreTestCase):
                 )
 
 
+    def make_report(self, **data):
+        """
+        Request a report of course1 and return its task.
+        """
+        data['course_key'] = str(self.course1.id)
+        response = self.auth_client.post(
+            reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_report'),
+            content_type="application/json",
+            data=json.dumps(data),
+        )
+        self.assertEqual(response.status_code, 200)
+        response_json = response.json()
+        self.assertEqual(response_json['status'], 1)
+        return InstructorTask.objects.get(task_id=response_json['task_id'])
+
+
     def test_endpoints_authentication(self):
         """
         Test that the endpoints require authentication.
@@ -129,6 +218,75 @@ class TestCMMEduSeguimiento(ModuleStoreTestCase):
         self.assertEqual(response_json['msg'], 'No hay tareas de reportes asociadas a este curso.')
 
 
+    def test_course_exists_cache(self):
+        """
+        Test that the course existence check is cached.
+        """
+        cache.clear()
+        self.assertTrue(course_exists(self.course1.id))
+        with self.assertNumQueries(0):
+            with mock.patch('cmmedu_seguimiento.utils.modulestore') as mocked_store:
+                self.assertTrue(course_exists(self.course1.id))
+        mocked_store.assert_not_called()
+        self.assertFalse(course_exists(CourseKey.from_string('course-v1:mss+999+2020')))
+
+
+    def test_endpoints_queries(self):
+        """
+        Test that the report endpoints run the same number of queries on every
+        request for an existing course, within `ENDPOINT_QUERY_BUDGET`, and
+        that they do not load the course from the modulestore once the
+        existence check is cached. Their latency is measured in `benchmarks`.
+        """
+        data = '{"course_key": "%s"}' % str(self.course1.id)
+        names = ('cmmedu_seguimiento_make_report', 'cmmedu_seguimiento_get_report')
+        with mock.patch('cmmedu_seguimiento.views.submit_task_make_report', return_value=mock.Mock(task_id='task_id')):
+            for name in names:
+                self.auth_client.post(reverse('cmmedu_seguimiento:' + name), content_type="application/json", data=data)
+            with mock.patch('cmmedu_seguimiento.utils.modulestore') as mocked_store:
+                for name in names:
+                    query_counts = []
+                    for _ in range(ENDPOINT_REPEAT):
+                        with CaptureQueriesContext(connection) as queries:
+                            response = self.auth_client.post(reverse('cmmedu_seguimiento:' + name), content_type="application/json", data=data)
+                        self.assertEqual(response.status_code, 200)
+                        query_counts.append(len(queries))
+                    self.assertEqual(len(set(query_counts)), 1, name)
+                    self.assertLessEqual(query_counts[0], ENDPOINT_QUERY_BUDGET, name)
+        mocked_store.assert_not_called()
+
+
+    @override_settings(CMMEDU_SEGUIMIENTO_PROGRESS_INTERVAL=0)
+    def test_get_report_progress(self):
+        """
+        Test that the progress of a running report is returned with an
+        estimate of the time left.
+        """
+        task = InstructorTaskFactory.create(
+            task_type=REPORT_TASK_TYPE,
+            course_id=self.course1.id,
+            task_state='PROGRESS'
+        )
+        start_report_progress(task.id, ['main'], time() - 10)
+        progress = ReportProgress(task.id)
+        progress.update(total_blocks=4, section='Capítulo 1')
+        progress.set_stage('blocks_data')
+        progress.add(blocks=1, responses=USER_COUNT)
+        response = self.auth_client.post(
+            reverse('cmmedu_seguimiento:cmmedu_seguimiento_get_report'),
+            content_type="application/json",
+            data='{"course_key": "%s"}' % str(self.course1.id),
+        )
+        response_json = response.json()
+        self.assertEqual(response_json['status'], 0)
+        self.assertEqual(response_json['progress']['stages'], ['blocks_data'])
+        self.assertEqual(response_json['progress']['sections'], ['Capítulo 1'])
+        self.assertEqual(response_json['progress']['blocks_done'], 1)
+        self.assertEqual(response_json['progress']['total_blocks'], 4)
+        self.assertEqual(response_json['progress']['responses'], USER_COUNT)
+        self.assertAlmostEqual(response_json['progress']['eta_seconds'], 30, delta=3)
+
+
     def test_task_create(self):
         """
         Test that a task is created when the course key is valid.
@@ -143,3 +301,856 @@ class TestCMMEduSeguimiento(ModuleStoreTestCase):
         self.assertEqual(response1_json['status'], 1)
         self.assertEqual(response1_json['msg'], 'Se ha iniciado la generación del reporte.')
         self.assertIn('task_id', response1_json)
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_task_create_parallel(self):
+        """
+        Test that a parallel report runs its subtasks and finishes with the
+        output that the get report endpoint expects, or fails if it cannot be
+        finished.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            task = self.make_report(parallel=True)
+            self.assertEqual(task.task_state, 'SUCCESS')
+            self.assertEqual(json.loads(task.task_output)['n_reports'], 1)
+
+            response2 = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_get_report'),
+                content_type="application/json",
+                data='{"course_key": "%s"}' % str(self.course1.id),
+            )
+            response2_json = response2.json()
+            self.assertEqual(response2_json['status'], 1)
+            self.assertIsNotNone(response2_json['output']['student_profile'])
+            self.assertIsNotNone(response2_json['output']['ora_data'])
+            self.assertEqual(list(response2_json['output']['blocks_data'].keys()), ['1'])
+
+            # A report that cannot be finished fails instead of staying in progress
+            with mock.patch('cmmedu_seguimiento.tasks.upload_report_manifest', side_effect=ValueError('Manifest error')):
+                task = self.make_report(parallel=True)
+            self.assertEqual(task.task_state, 'FAILURE')
+            self.assertEqual(json.loads(task.task_output)['message'], 'Manifest error')
+            response3 = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_report'),
+                content_type="application/json",
+                data='{"course_key": "%s"}' % str(self.course1.id),
+            )
+            self.assertEqual(response3.json()['status'], 1)
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_get_report_manifest(self):
+        """
+        Test that the get report endpoint lists the files of the report with
+        the details stored in its manifest.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            self.make_report()
+            response = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_get_report'),
+                content_type="application/json",
+                data='{"course_key": "%s"}' % str(self.course1.id),
+            )
+            response_json = response.json()
+            self.assertEqual(response_json['status'], 1)
+            sections = response_json['output']['sections']
+            self.assertEqual(len(sections), 1)
+            self.assertEqual(sections[0]['index'], 1)
+            self.assertEqual(sections[0]['blocks'], XBLOCK_COUNT - 1)
+            self.assertEqual(sections[0]['responses'], (XBLOCK_COUNT - 1) * USER_COUNT)
+            self.assertEqual(response_json['output']['blocks_data']['1'], sections[0]['url'])
+
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            with report_store.storage.open(report_store.path_to(self.course1.id, sections[0]['name'])) as archive:
+                contents = archive.read()
+            self.assertEqual(sections[0]['size'], len(contents))
+            self.assertEqual(sections[0]['checksum'], hashlib.sha256(contents).hexdigest())
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_report_metrics(self):
+        """
+        Test that the report records the metrics of its phases and, when asked
+        to, a cProfile dump.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            task_output = json.loads(self.make_report(profile=True).task_output)
+            self.assertGreater(task_output['metrics']['db_queries'], 0)
+            self.assertGreaterEqual(task_output['metrics']['rss_growth_kb'], 0)
+            for phase in ['student_profile', 'ora_data', 'section', 'serialization', 'compression', 'upload']:
+                self.assertIn(phase, task_output['metrics']['phases'])
+
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            manifest = report_store.read_manifest(self.course1.id, task_output['manifest'])
+            self.assertEqual(manifest['metrics']['phases']['section']['calls'], 1)
+            self.assertEqual(
+                manifest['metrics']['block_types']['problem']['generate_report_data']['calls'],
+                XBLOCK_COUNT - 1
+            )
+            self.assertIn('metrics', manifest['sections'][0])
+            self.assertTrue(report_store.storage.exists(report_store.path_to(self.course1.id, manifest['cprofile'])))
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_incremental_report(self):
+        """
+        Test that an incremental report only stores the responses modified
+        since the previous report, and that compacting it gives back the full
+        report, without the students no longer enrolled.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            full_output = json.loads(self.make_report(mode='incremental').task_output)
+            self.assertEqual(full_output['mode'], 'full')
+
+            StudentModule.objects.get(student=self.users[0], module_state_key=self.items[0].location).save()
+            delta_output = json.loads(self.make_report(mode='incremental').task_output)
+            self.assertEqual(delta_output['mode'], 'incremental')
+            delta_manifest = report_store.read_manifest(self.course1.id, delta_output['manifest'])
+            self.assertEqual(delta_manifest['chain'], [full_output['manifest']])
+            blocks = report_store.read_json(self.course1.id, delta_manifest['sections'][0]['name'])
+            blocks = [block for block in blocks if not block['is_structural_item']]
+            self.assertEqual(len(blocks), 1)
+            self.assertEqual([response['username'] for response in blocks[0]['responses']], [self.users[0].username])
+
+            CourseEnrollment.unenroll(self.users[1], self.course1.id)
+            compact_output = json.loads(self.make_report(mode='incremental', compact=True).task_output)
+            self.assertEqual(compact_output['mode'], 'full')
+            compact_manifest = report_store.read_manifest(self.course1.id, compact_output['manifest'])
+            self.assertTrue(compact_manifest['compacted'])
+            self.assertEqual(compact_manifest['chain'], [])
+            usernames = [row['username'] for row in report_store.read_json(self.course1.id, compact_manifest['student_profile']['name'])]
+            self.assertEqual(sorted(usernames), sorted(user.username for user in self.users if user != self.users[1]))
+            blocks = report_store.read_json(self.course1.id, compact_manifest['sections'][0]['name'])
+            blocks = [block for block in blocks if not block['is_structural_item']]
+            self.assertEqual(len(blocks), XBLOCK_COUNT - 1)
+            for block in blocks:
+                self.assertEqual(len(block['responses']), USER_COUNT)
+
+
+    def test_content_snapshot(self):
+        """
+        Test that the content snapshot of a course is reused by its user until
+        the course is published again.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        root = get_course_root(self.course1.id)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            snapshot = load_content_snapshot(self.user_staff.id, self.course1.id, root)
+            self.assertEqual(len(snapshot['blocks']), XBLOCK_COUNT - 1)
+            with mock.patch('cmmedu_seguimiento.utils.get_course_blocks') as mocked_get_course_blocks:
+                self.assertEqual(load_content_snapshot(self.user_staff.id, self.course1.id, root), snapshot)
+            mocked_get_course_blocks.assert_not_called()
+
+            # Other users do not get the blocks that the staff user can access
+            with mock.patch(
+                'cmmedu_seguimiento.utils.get_course_blocks', wraps=get_course_blocks
+            ) as mocked_get_course_blocks:
+                load_content_snapshot(self.users[0].id, self.course1.id, root)
+            mocked_get_course_blocks.assert_called_once()
+
+            item = self.store.get_item(self.items[0].location)
+            item.display_name = 'Republished problem'
+            self.store.update_item(item, self.user_staff.id)
+            self.store.publish(item.location, self.user_staff.id)
+            new_snapshot = load_content_snapshot(self.user_staff.id, self.course1.id, root)
+            self.assertNotEqual(new_snapshot['version'], snapshot['version'])
+            self.assertEqual(new_snapshot['blocks'][str(self.items[0].location)]['display_name'], 'Republished problem')
+
+
+    def test_iter_student_modules(self):
+        """
+        Test that the rows of a block are read lazily in a single query, in
+        student order and truncated to the limit.
+        """
+        location = self.items[0].location
+        with self.assertNumQueries(0):
+            rows = iter_student_modules(self.course1.id, location)
+        with self.assertNumQueries(1):
+            usernames = [row.student.username for row in rows]
+        self.assertEqual(usernames, [response['username'] for response in list_problem_responses(self.course1.id, location)])
+        self.assertEqual(len(list(iter_student_modules(self.course1.id, location, limit_responses=2))), 2)
+        self.assertEqual(list(iter_student_modules(self.course1.id, location, modified_since=datetime.now(UTC))), [])
+
+
+    def test_report_file_matches_json_dumps(self):
+        """
+        Test that a report file written item by item contains the same JSON as
+        the whole list dumped at once.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        report_store = DjangoStorageJsonReportStore(
+            storage_class='django.core.files.storage.FileSystemStorage',
+            storage_kwargs={'location': storage_dir},
+        )
+        data = [
+            {"path": ["Curso", "Capítulo"], "responses": [{"username": "user1", "timestamp": datetime(2020, 1, 1), "state": "{}"}]},
+            {"path": ["Curso", "Capítulo\nnuevo"], "responses": []},
+        ]
+        for items in (data, []):
+            filename = 'report_{}.tar.gz'.format(len(items))
+            with report_store.open_json(self.course1.id, filename) as report_file:
+                for item in items:
+                    report_file.append(item)
+            with tarfile.open(report_store.storage.path(report_store.path_to(self.course1.id, filename))) as tar:
+                contents = tar.extractfile(tar.getmembers()[0]).read().decode('utf-8')
+            self.assertEqual(contents, json.dumps(items, ensure_ascii=False, indent=4, cls=JsonReportEncoder))
+            self.assertEqual(report_file.item_count, len(items))
+
+
+    def test_json_lines_report_file(self):
+        """
+        Test that a report written in the JSON Lines format is smaller and
+        reads back as the same items as the classic format, whole or streamed.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        report_store = DjangoStorageJsonReportStore(
+            storage_class='django.core.files.storage.FileSystemStorage',
+            storage_kwargs={'location': storage_dir},
+        )
+        responses = [
+            {"username": "user{}".format(i), "timestamp": datetime(2020, 1, 1), "state": "{}"}
+            for i in range(USER_COUNT)
+        ]
+        data = [
+            {"path": ["Curso", "Capítulo"], "block_type": "chapter", "block_id": "1", "is_structural_item": True},
+            {"title": "P1", "path": ["Curso", "Capítulo", "P1"], "block_type": "problem", "responses": responses},
+            {"title": "P2", "path": ["Curso", "Capítulo", "P2"], "block_type": "problem", "responses": responses + [
+                {"username": "user0", "timestamp": datetime(2020, 1, 2), "state": "{}", "Answer": "foo"},
+            ]},
+            {"username": "user0", "email": "user0@example.com"},
+        ]
+        classic = report_store.store_json(self.course1.id, 'classic.tar.gz', data)
+        json_lines = report_store.store_json(self.course1.id, 'json_lines.tar.gz', data, report_format='jsonl')
+        self.assertLess(json_lines['size'], classic['size'])
+        self.assertEqual(json_lines['items'], len(data))
+        self.assertEqual(
+            report_store.read_json(self.course1.id, json_lines['name']),
+            report_store.read_json(self.course1.id, classic['name'])
+        )
+        classic_items = report_store.read_json(self.course1.id, classic['name'])
+        for name in (classic['name'], json_lines['name']):
+            self.assertEqual(list(report_store.iter_json(self.course1.id, name)), classic_items)
+
+
+    def test_report_compression(self):
+        """
+        Test that reports can be stored with every compression codec and read
+        back, with the archive extension of the codec.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        data = [{"path": ["Curso", "Capítulo"], "responses": [{"username": "user1", "state": "{}"}]}]
+        for compression, level in [('gz', 1), ('gz', None), ('bz2', 9), ('xz', 1), ('none', None)]:
+            report_store = DjangoStorageJsonReportStore(
+                storage_class='django.core.files.storage.FileSystemStorage',
+                storage_kwargs={'location': storage_dir},
+                compression=compression,
+                compression_level=level,
+            )
+            filename = 'report.' + report_store.archive_extension
+            stored = report_store.store_json(self.course1.id, filename, data)
+            self.assertTrue(stored['name'].endswith(report_store.archive_extension))
+            self.assertEqual(report_store.read_json(self.course1.id, stored['name']), data)
+        with self.assertRaises(ImproperlyConfigured):
+            DjangoStorageJsonReportStore(compression='rar')
+
+
+    def test_report_uploader(self):
+        """
+        Test that the report uploader stores files in the background, blocks
+        when too many are pending and raises the errors of the uploads.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        report_store = DjangoStorageJsonReportStore(
+            storage_class='cmmedu_seguimiento.tests.SlowFileSystemStorage',
+            storage_kwargs={'location': storage_dir},
+        )
+        data = [{"username": "user1", "state": "{}"}]
+        report_files = []
+        with ReportUploader(threads=1, max_pending=1) as uploader:
+            start = time()
+            for index in range(3):
+                with report_store.open_json(self.course1.id, 'report_{}.tar.gz'.format(index), uploader=uploader) as report_file:
+                    report_file.append(data[0])
+                report_files.append(report_file)
+            # The third file waits for the first two to be stored
+            self.assertGreaterEqual(time() - start, 2 * SLOW_STORAGE_DELAY)
+            self.assertFalse(report_files[-1].done())
+        for index, report_file in enumerate(report_files):
+            self.assertTrue(report_file.done())
+            self.assertEqual(report_file.describe()['items'], 1)
+            self.assertEqual(report_store.read_json(self.course1.id, report_file.name), data)
+
+        with mock.patch.object(SlowFileSystemStorage, '_save', side_effect=IOError):
+            with self.assertRaises(IOError):
+                with ReportUploader() as uploader:
+                    with report_store.open_json(self.course1.id, 'report_error.tar.gz', uploader=uploader) as report_file:
+                        report_file.append(data[0])
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_task_slow_storage(self):
+        """
+        Test that a report is complete when its sections are uploaded in the
+        background to a slow storage.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        grades_download = {
+            'STORAGE_CLASS': 'cmmedu_seguimiento.tests.SlowFileSystemStorage',
+            'STORAGE_KWARGS': {'location': storage_dir},
+        }
+        with self.settings(GRADES_DOWNLOAD=grades_download):
+            task = self.make_report()
+            self.assertEqual(task.task_state, 'SUCCESS')
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            for section in manifest['sections']:
+                self.assertTrue(report_store.storage.exists(report_store.path_to(self.course1.id, section['name'])))
+
+
+    def test_iter_block_responses(self):
+        """
+        Test that the responses of a block are merged with the states of its
+        generate_report_data in a single pass, in student order.
+        """
+        class ReportDataBlock(object):
+            def generate_report_data(self, user_state_iterator, limit_responses=None):
+                for index, user_state in enumerate(user_state_iterator):
+                    if index % 2 == 0:
+                        yield user_state.username, {'Answer': 'a1'}
+                        yield user_state.username, {'Answer': 'a2'}
+
+        location = self.items[0].location
+        StudentModule.objects.filter(module_state_key=location).update(state=json.dumps({'answer': 'foo'}))
+        student_modules = list(iter_student_modules(self.course1.id, location))
+        with self.assertNumQueries(0):
+            responses = list(iter_block_responses(ReportDataBlock(), location, student_modules))
+        expected = []
+        for index, response in enumerate(list_problem_responses(self.course1.id, location)):
+            if index % 2 == 0:
+                expected += [dict(response, Answer='a1'), dict(response, Answer='a2')]
+            else:
+                expected.append(response)
+        self.assertEqual(responses, expected)
+
+        # Rows streamed from a single query, as reports read them
+        with self.assertNumQueries(1):
+            responses = list(iter_block_responses(ReportDataBlock(), location, iter_student_modules(self.course1.id, location)))
+        self.assertEqual(responses, expected)
+
+
+    def test_user_state_iterator_null_state(self):
+        """
+        Test that the rows with a null or empty state are skipped by
+        `UserStateIterator` instead of failing.
+        """
+        location = self.items[0].location
+        StudentModule.objects.filter(module_state_key=location).update(state=None)
+        StudentModule.objects.filter(module_state_key=location, student=self.users[1]).update(state='{}')
+        StudentModule.objects.filter(module_state_key=location, student=self.users[2]).update(
+            state=json.dumps({'answer': 'foo'})
+        )
+        student_modules = StudentModule.objects.filter(module_state_key=location).order_by('student')
+        user_states = list(UserStateIterator(location, student_modules))
+        self.assertEqual([user_state.username for user_state in user_states], [self.users[2].username])
+        self.assertEqual(user_states[0].state, {'answer': 'foo'})
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_batch_report(self):
+        """
+        Test that a batch of reports runs the report of every course, at most
+        `concurrency` at once, and that its state lists every course.
+        """
+        response = self.auth_client.post(
+            reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_batch_report'),
+            content_type="application/json",
+            data=json.dumps({'course_keys': [str(self.course1.id), 'BAD_COURSE_KEY']}),
+        )
+        self.assertEqual(response.status_code, 400)
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            response = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_batch_report'),
+                content_type="application/json",
+                data=json.dumps({'course_keys': [str(self.course1.id), str(self.course2.id)], 'concurrency': 1}),
+            )
+            response_json = response.json()
+            self.assertEqual(response_json['status'], 1)
+            self.assertEqual(len(response_json['courses']), 2)
+
+            response = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_get_batch_report'),
+                content_type="application/json",
+                data=json.dumps({'batch_id': response_json['batch_id']}),
+            )
+            response_json = response.json()
+            self.assertEqual(response_json['status'], 1)
+            self.assertEqual(response_json['total'], 2)
+            self.assertEqual(response_json['states'], {'SUCCESS': 2})
+            self.assertEqual(
+                [course['course_key'] for course in response_json['courses']],
+                [str(self.course1.id), str(self.course2.id)]
+            )
+
+
+    @override_settings(
+        CELERY_ALWAYS_EAGER=True,
+        UCHILEEDXLOGIN_TASK_RUN_ENABLE=False,
+        CMMEDU_SEGUIMIENTO_UPLOAD_THREADS=0,
+        CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES=0,
+        CMMEDU_SEGUIMIENTO_REPORT_CHUNK_BYTES=0
+    )
+    def test_resume_report(self):
+        """
+        Test that a report task that hits its time limit in its second section
+        resumes from its checkpoint when retried, without storing the first
+        section again, and ends with the same files as a report run at once,
+        and that a task that fails for good leaves no checkpoint behind.
+        """
+        with self.store.bulk_operations(self.course1.id, emit_signals=False):
+            chapter = ItemFactory.create(parent_location=self.course1.location, category="chapter")
+            sequential = ItemFactory.create(parent_location=chapter.location, category="sequential")
+            ItemFactory.create(
+                parent_location=sequential.location,
+                category="problem",
+                data=StringResponseXMLFactory().build_xml(answer='foo')
+            )
+
+        sections_built = []
+        def build_section_until_killed(*args, **kwargs):
+            sections_built.append(args[3])
+            if args[3] == 2 and len(sections_built) == 2:
+                raise SoftTimeLimitExceeded()
+            return build_section_data(*args, **kwargs)
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            expected_task = self.make_report()
+            self.assertEqual(expected_task.task_state, 'SUCCESS')
+            expected = report_store.read_manifest(self.course1.id, json.loads(expected_task.task_output)['manifest'])
+
+            with mock.patch('cmmedu_seguimiento.utils.build_section_data', side_effect=build_section_until_killed):
+                task = self.make_report()
+                self.assertEqual(sections_built, [1, 2, 2])
+            self.assertEqual(task.task_state, 'SUCCESS')
+
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            self.assertEqual(len(manifest['sections']), 2)
+            for part in ('student_profile', 'ora_data'):
+                self.assertEqual(
+                    report_store.read_json(self.course1.id, manifest[part]['name']),
+                    report_store.read_json(self.course1.id, expected[part]['name'])
+                )
+            for section, expected_section in zip(manifest['sections'], expected['sections']):
+                for key in ('title', 'structure', 'blocks', 'responses'):
+                    self.assertEqual(section[key], expected_section[key])
+                self.assertEqual(
+                    report_store.read_json(self.course1.id, section['name']),
+                    report_store.read_json(self.course1.id, expected_section['name'])
+                )
+            checkpoints = [name for name, _ in report_store.links_for(self.course1.id) if '_checkpoint_' in name]
+            self.assertEqual(checkpoints, [])
+
+            with mock.patch('cmmedu_seguimiento.utils.build_section_data', side_effect=RuntimeError("Broken section")):
+                self.assertEqual(self.make_report().task_state, 'FAILURE')
+            checkpoints = [name for name, _ in report_store.links_for(self.course1.id) if '_checkpoint_' in name]
+            self.assertEqual(checkpoints, [])
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_reuse_unchanged_sections(self):
+        """
+        Test that a section with the same contents as in the previous report
+        references its archive and index instead of storing new ones, and
+        that a section with new activity is stored again.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            manifests = []
+            for _ in range(2):
+                task = self.make_report(index=True)
+                manifests.append(report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest']))
+            first_section, second_section = manifests[0]['sections'][0], manifests[1]['sections'][0]
+            self.assertFalse(first_section['reused'])
+            self.assertTrue(second_section['reused'])
+            for key in ('name', 'size', 'checksum', 'content_hash', 'index'):
+                self.assertEqual(second_section[key], first_section[key])
+
+            StudentModule.objects.filter(student=self.users[0], module_state_key=self.items[0].location).update(state=json.dumps({'attempts': 1}))
+            task = self.make_report(index=True)
+            third_section = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])['sections'][0]
+            self.assertFalse(third_section['reused'])
+            self.assertNotEqual(third_section['content_hash'], first_section['content_hash'])
+            self.assertNotEqual(third_section['name'], first_section['name'])
+            self.assertNotEqual(third_section['index'], first_section['index'])
+
+
+    @override_settings(
+        CELERY_ALWAYS_EAGER=True,
+        UCHILEEDXLOGIN_TASK_RUN_ENABLE=False,
+        CMMEDU_SEGUIMIENTO_INDEX_CHUNK_SIZE=2
+    )
+    def test_query_report(self):
+        """
+        Test that the query endpoint returns the responses of one student or
+        one block of the latest report, the same as in its archives, once a
+        report is requested with an index.
+        """
+        url = reverse('cmmedu_seguimiento:cmmedu_seguimiento_query_report')
+        response = self.auth_client.post(url, content_type="application/json", data=json.dumps({'course_key': str(self.course1.id)}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Missing username or block_id')
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            task = self.make_report()
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            self.assertNotIn('index', manifest['sections'][0])
+            block_id = self.items[0].location.block_id
+            response = self.auth_client.post(
+                url,
+                content_type="application/json",
+                data=json.dumps({'course_key': str(self.course1.id), 'block_id': block_id}),
+            )
+            self.assertEqual(response.json(), {"status": 0, "msg": "El reporte no está indexado para consultas."})
+
+            task = self.make_report(index=True)
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            archive_blocks = {
+                block['block_id']: block for block in report_store.read_json(self.course1.id, manifest['sections'][0]['name'])
+                if not block['is_structural_item']
+            }
+            self.assertEqual(manifest['sections'][0]['index']['chunk_count'], (XBLOCK_COUNT - 1) * 3)
+
+            response = self.auth_client.post(
+                url,
+                content_type="application/json",
+                data=json.dumps({'course_key': str(self.course1.id), 'block_id': block_id}),
+            )
+            response_json = response.json()
+            self.assertEqual(response_json['status'], 1)
+            self.assertEqual(response_json['task_id'], task.task_id)
+            self.assertEqual(len(response_json['blocks']), 1)
+            self.assertEqual(response_json['blocks'][0]['responses'], archive_blocks[block_id]['responses'])
+
+            username = self.users[0].username
+            response = self.auth_client.post(
+                url,
+                content_type="application/json",
+                data=json.dumps({'course_key': str(self.course1.id), 'username': username}),
+            )
+            blocks = response.json()['blocks']
+            self.assertEqual(len(blocks), XBLOCK_COUNT - 1)
+            for block in blocks:
+                self.assertEqual(
+                    block['responses'],
+                    [item for item in archive_blocks[block['block_id']]['responses'] if item['username'] == username]
+                )
+
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_report_chunks(self):
+        """
+        Test that small sections share a report file, and that a section with
+        more responses than a file can hold is split between its blocks.
+        """
+        with self.store.bulk_operations(self.course1.id, emit_signals=False):
+            chapter = ItemFactory.create(parent_location=self.course1.location, category="chapter", display_name="Small chapter")
+            sequential = ItemFactory.create(parent_location=chapter.location, category="sequential")
+            ItemFactory.create(parent_location=sequential.location, category="problem", data=StringResponseXMLFactory().build_xml(answer='foo'))
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            task = self.make_report()
+            sections = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])['sections']
+            self.assertEqual(len(sections), 1)
+            self.assertEqual(len(sections[0]['chapters']), 2)
+            self.assertEqual(sections[0]['blocks'], XBLOCK_COUNT)
+
+            # 5 responses per problem: 4 problems per file
+            with self.settings(CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES=USER_COUNT * 4):
+                task = self.make_report()
+            sections = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])['sections']
+            self.assertEqual([section['blocks'] for section in sections], [4, 4, 2])
+            self.assertEqual([section['responses'] for section in sections], [USER_COUNT * 4, USER_COUNT * 4, USER_COUNT])
+            self.assertEqual(sections[1]['first_block'], self.items[4].location.block_id)
+            self.assertEqual(sections[1]['last_block'], self.items[7].location.block_id)
+            self.assertEqual(len(sections[1]['chapters']), 1)
+            # The small chapter fits with the rest of the split section
+            self.assertEqual(sections[2]['chapters'][1:], ['Small chapter'])
+
+            # The second file of the split section starts with its structural items
+            blocks = report_store.read_json(self.course1.id, sections[1]['name'])
+            self.assertEqual([block['is_structural_item'] for block in blocks[:3]], [True, True, False])
+            self.assertEqual(blocks[2]['block_id'], self.items[4].location.block_id)
+
+
+    def test_student_profiles(self):
+        """
+        Test that the student profiles are read in batches with the same rows
+        as `enrolled_students_features`, and with a number of queries that
+        depends on the number of batches only, and that a batch of reports
+        shares the users it reads, even if some of them are gone.
+        """
+        features = [
+            'id', 'username', 'name', 'email', 'year_of_birth', 'enrollment_mode',
+            'verification_status', 'last_login', 'date_joined', 'cohort', 'city', 'country', 'meta.foo',
+        ]
+        expected = enrolled_students_features(self.course1.id, features)
+        for batch_size in (2, USER_COUNT, 100):
+            with self.settings(CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE=batch_size):
+                self.assertEqual([dict(row) for row in iter_student_profiles(self.course1.id, features)], expected)
+
+        user_ids = [self.users[0].id, self.users[3].id]
+        self.assertEqual(
+            [row['username'] for row in iter_student_profiles(self.course1.id, features, user_ids)],
+            sorted(user.username for user in self.users if user.id in user_ids)
+        )
+
+        # The reports of a batch read every user and profile once
+        with self.settings(CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE=2):
+            for _ in range(2):
+                with CaptureQueriesContext(connection) as queries:
+                    rows = [dict(row) for row in iter_student_profiles(self.course1.id, features, batch_id='batch')]
+                self.assertEqual(rows, expected)
+            self.assertFalse([query for query in queries if 'auth_userprofile' in query['sql']])
+
+            # A user that is gone when its page is read does not end the pages
+            with mock.patch(
+                'cmmedu_seguimiento.utils.load_batch_students',
+                side_effect=lambda batch_id, user_ids: load_batch_students(batch_id, user_ids)[1:]
+            ):
+                rows = [dict(row) for row in iter_student_profiles(self.course1.id, features, batch_id='other_batch')]
+            self.assertEqual(rows, [row for index, row in enumerate(expected) if index % 2])
+
+        with self.settings(CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE=100):
+            with CaptureQueriesContext(connection) as queries:
+                list(iter_student_profiles(self.course1.id, features))
+            for user in [UserFactory.create() for _ in range(USER_COUNT)]:
+                CourseEnrollmentFactory.create(user=user, course_id=self.course1.id)
+            with CaptureQueriesContext(connection) as more_queries:
+                list(iter_student_profiles(self.course1.id, features))
+        self.assertEqual(len(more_queries), len(queries))
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_ora_rows(self):
+        """
+        Test that the ORA rows are read in batches with the same rows as
+        `collect_ora2_data`, or by `collect_ora2_data` itself if a helper
+        they need is missing, and stored split by block on request.
+        """
+        item_ids = [str(self.course1.id.make_usage_key('openassessment', name)) for name in ('ora1', 'ora2')]
+        for index, user in enumerate(self.users):
+            student_item = {
+                'student_id': anonymous_id_for_user(user, self.course1.id),
+                'course_id': str(self.course1.id),
+                'item_id': item_ids[index % 2],
+                'item_type': 'openassessment',
+            }
+            sub_api.create_submission(student_item, {'parts': [{'text': 'answer {}'.format(index)}]})
+        header, datarows = OraAggregateData.collect_ora2_data(self.course1.id)
+        expected = [dict(zip(header, row)) for row in datarows]
+        self.assertEqual(len(expected), USER_COUNT)
+        with self.settings(CMMEDU_SEGUIMIENTO_ORA_BATCH_SIZE=2):
+            self.assertEqual([dict(row) for row in iter_ora_rows(self.course1.id)], expected)
+        with mock.patch('cmmedu_seguimiento.utils.ORA_CELL_BUILDERS', ('_missing_helper',)):
+            self.assertEqual([dict(row) for row in iter_ora_rows(self.course1.id)], expected)
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            task = self.make_report()
+            self.assertNotIn('blocks', report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])['ora_data'])
+            task = self.make_report(split_ora=True)
+            ora_report = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])['ora_data']
+            self.assertEqual(ora_report['items'], USER_COUNT)
+            self.assertEqual(set(ora_report['blocks']), set(item_ids))
+            for item_id, block_report in ora_report['blocks'].items():
+                rows = report_store.read_json(self.course1.id, block_report['name'])
+                self.assertEqual(block_report['items'], len(rows))
+                self.assertEqual({row['Item ID'] for row in rows}, {item_id})
+
+        # Only the submissions since `since` are read
+        since = datetime.now(UTC)
+        submission = sub_api.create_submission(student_item, {'parts': [{'text': 'new answer'}]})
+        self.assertEqual(
+            [row['Submission ID'] for row in iter_ora_rows(self.course1.id, since=since)],
+            [submission['uuid']]
+        )
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_schedule_stale_reports(self):
+        """
+        Test that only the courses with activity since their last report are
+        scheduled, largest first, and that their tasks are staggered.
+        """
+        CourseEnrollmentFactory.create(user=self.users[0], course_id=self.course2.id)
+        course_keys, batch = schedule_stale_reports(username=self.user_staff.username, dry_run=True)
+        self.assertEqual(course_keys, [self.course1.id, self.course2.id])
+        self.assertIsNone(batch)
+
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            self.assertEqual(self.make_report().task_state, 'SUCCESS')
+            course_keys, _ = schedule_stale_reports(username=self.user_staff.username, dry_run=True)
+            self.assertEqual(course_keys, [self.course2.id])
+
+            # Polls are run by hand, since eager tasks would not wait
+            with mock.patch.object(task_schedule_batch_report, 'apply_async') as poll:
+                with mock.patch.object(task_schedule_batch_report, 'delay'):
+                    StudentModule.objects.filter(student=self.users[0], course_id=self.course1.id).first().save()
+                    course_keys, batch = schedule_stale_reports(
+                        username=self.user_staff.username, window=3600, concurrency=1
+                    )
+                self.assertEqual(course_keys, [self.course1.id, self.course2.id])
+                task_schedule_batch_report(batch['id'])
+                self.assertEqual(poll.call_count, 1)
+            batch = get_report_batch(batch['id'])
+            self.assertEqual(InstructorTask.objects.get(pk=batch['courses'][0]['entry_id']).task_state, 'SUCCESS')
+            self.assertGreater(batch['courses'][1]['not_before'], batch['courses'][0]['not_before'])
+            # The task of a course is only reserved when it is submitted, so
+            # an expired batch blocks no report
+            self.assertIsNone(batch['courses'][1]['entry_id'])
+            cache.delete(get_batch_cache_key(batch['id']))
+            task_schedule_batch_report(batch['id'])
+            self.assertFalse(InstructorTask.objects.filter(course_id=self.course2.id).exists())
+
+
+    @override_settings(
+        CELERY_ALWAYS_EAGER=True,
+        UCHILEEDXLOGIN_TASK_RUN_ENABLE=False,
+        CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES=USER_COUNT * 4
+    )
+    def test_report_estimate(self):
+        """
+        Test that a dry run returns the work plan of a report without running
+        it, that a chunked report records its estimates next to its
+        measurements, and that a report that is not chunked is not
+        estimated.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            response = self.auth_client.post(
+                reverse('cmmedu_seguimiento:cmmedu_seguimiento_make_report'),
+                content_type="application/json",
+                data=json.dumps({'course_key': str(self.course1.id), 'dry_run': True}),
+            )
+            response_json = response.json()
+            self.assertEqual(response_json['status'], 1)
+            self.assertFalse(InstructorTask.objects.filter(course_id=self.course1.id).exists())
+            work = response_json['plan']
+            self.assertEqual(len(work['blocks']), len(self.items))
+            self.assertEqual(sum(block['responses'] for block in work['blocks']), len(self.items) * USER_COUNT)
+            self.assertEqual(sum(chapter['responses'] for chapter in work['chapters']), len(self.items) * USER_COUNT)
+            self.assertEqual(work['student_profile']['rows'], USER_COUNT)
+            self.assertEqual(len(work['subtasks']), len(work['sections']) + 2)
+            self.assertLessEqual(work['duration']['parallel'], work['duration']['sequential'])
+            self.assertEqual(work['calibration'], 1)
+
+            report_store = JsonReportStore.from_config('GRADES_DOWNLOAD')
+            task = self.make_report()
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            self.assertEqual(manifest['estimate']['sections'], work['sections'])
+            self.assertEqual(manifest['estimate']['actual']['responses'], len(self.items) * USER_COUNT)
+            for section in manifest['sections']:
+                self.assertEqual(section['estimate']['responses'], section['responses'])
+
+            # The next estimate is calibrated with the measurements of this report
+            task = self.make_report(parallel=True)
+            self.assertEqual(task.task_state, 'SUCCESS')
+            manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+            self.assertNotEqual(manifest['estimate']['calibration'], 1)
+            self.assertEqual(manifest['estimate']['actual']['responses'], len(self.items) * USER_COUNT)
+
+            with self.settings(CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES=0):
+                with mock.patch('cmmedu_seguimiento.utils.estimate_report_work') as estimate_report_work:
+                    for parallel in (False, True):
+                        task = self.make_report(parallel=parallel)
+                        self.assertEqual(task.task_state, 'SUCCESS')
+                        manifest = report_store.read_manifest(self.course1.id, json.loads(task.task_output)['manifest'])
+                        self.assertIsNone(manifest['estimate'])
+                self.assertFalse(estimate_report_work.called)
+
+        # Sections estimated with a null calibration are left out
+        sections = [{'estimate': {'seconds': 1, 'calibration': 0}, 'metrics': {'wall_time': 1}}]
+        with mock.patch.object(JsonReportStore, 'read_manifest', return_value={'sections': sections}):
+            self.assertEqual(get_estimate_calibration(self.course1.id, {'previous': 'previous'}), 1)
+            sections.append({'estimate': {'seconds': 1000, 'calibration': 1}, 'metrics': {'wall_time': 0.001}})
+            self.assertGreater(get_estimate_calibration(self.course1.id, {'previous': 'previous'}), 0)
+
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, UCHILEEDXLOGIN_TASK_RUN_ENABLE=False)
+    def test_report_database(self):
+        """
+        Test that the report reads go to `CMMEDU_SEGUIMIENTO_REPORT_DATABASE`
+        if it is configured, and to the default database otherwise, and that
+        incremental reports read from a replica go back its lag.
+        """
+        storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_dir)
+        with self.settings(GRADES_DOWNLOAD={'STORAGE_TYPE': 'localfs', 'ROOT_PATH': storage_dir}):
+            task = self.make_report()
+            with self.settings(CMMEDU_SEGUIMIENTO_REPORT_DATABASE='missing_replica'):
+                self.assertEqual(get_report_database(), 'default')
+                self.assertEqual(len(list_problem_responses(self.course1.id, self.items[0].location)), USER_COUNT)
+                plan = get_report_plan(self.course1.id, 'incremental')
+                self.assertEqual(datetime.fromisoformat(plan['since']), task.created)
+
+            # The replica (see settings/test.py) has only received the first students
+            replicated = sorted(self.users[:USER_COUNT // 2], key=lambda user: user.username)
+            user_ids = [user.id for user in replicated]
+            get_user_model().objects.using('report_replica').bulk_create(get_user_model().objects.filter(id__in=user_ids))
+            UserProfile.objects.using('report_replica').bulk_create(UserProfile.objects.filter(user_id__in=user_ids))
+            CourseEnrollment.objects.using('report_replica').bulk_create(CourseEnrollment.objects.filter(user_id__in=user_ids))
+            StudentModule.objects.using('report_replica').bulk_create(StudentModule.objects.filter(student_id__in=user_ids))
+            usernames = [user.username for user in replicated]
+            with self.settings(CMMEDU_SEGUIMIENTO_REPORT_DATABASE='report_replica'):
+                self.assertEqual(get_report_database(), 'report_replica')
+                with CaptureQueriesContext(connections['report_replica']) as queries:
+                    responses = list_problem_responses(self.course1.id, self.items[0].location)
+                    student_modules = [list(iter_student_modules(self.course1.id, item.location)) for item in self.items]
+                    profiles = list(iter_student_profiles(self.course1.id, ['id', 'username', 'name']))
+                self.assertTrue(queries.captured_queries)
+                self.assertEqual(sorted(response['username'] for response in responses), usernames)
+                for block_responses in student_modules:
+                    self.assertEqual(sorted(response.student.username for response in block_responses), usernames)
+                self.assertEqual([profile['username'] for profile in profiles], usernames)
+                self.assertEqual([profile['name'] for profile in profiles], [user.profile.name for user in replicated])
+
+                # Changes made just before the last report may have reached the
+                # replica after it
+                plan = get_report_plan(self.course1.id, 'incremental')
+                lag = timedelta(seconds=settings.CMMEDU_SEGUIMIENTO_REPORT_DATABASE_LAG)
+                self.assertEqual(datetime.fromisoformat(plan['since']), task.created - lag)
@@ -5,5 +5,8 @@ from .views import *
 
 urlpatterns = [
     url('cmmedu_seguimiento_make_report/', csrf_exempt(CMMEduSeguimientoMakeReport.as_view()), name='cmmedu_seguimiento_make_report'),
-    url('cmmedu_seguimiento_get_report/', csrf_exempt(CMMEduSeguimientoGetReport.as_view()), name='cmmedu_seguimiento_get_report')
+    url('cmmedu_seguimiento_get_report/', csrf_exempt(CMMEduSeguimientoGetReport.as_view()), name='cmmedu_seguimiento_get_report'),
+    url('cmmedu_seguimiento_make_batch_report/', csrf_exempt(CMMEduSeguimientoMakeBatchReport.as_view()), name='cmmedu_seguimiento_make_batch_report'),
+    url('cmmedu_seguimiento_get_batch_report/', csrf_exempt(CMMEduSeguimientoGetBatchReport.as_view()), name='cmmedu_seguimiento_get_batch_report'),
+    url('cmmedu_seguimiento_query_report/', csrf_exempt(CMMEduSeguimientoQueryReport.as_view()), name='cmmedu_seguimiento_query_report')
 ]
\ No newline at end of file
@@ -1,36 +1,113 @@
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager, ExitStack
+from common.djangoapps.course_modes.models import CourseMode
 from common.djangoapps.student.models import CourseEnrollment
 from common.djangoapps.util.file import course_filename_prefix_generator
-from datetime import datetime
+from celery.states import SUCCESS
+from dateutil.parser import parse as parse_date
+from datetime import datetime, timedelta
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Max, Prefetch, prefetch_related_objects, Q, Sum
+from django.db.models.functions import Length
+from edx_user_state_client.interface import XBlockUserState
 from eventtracking import tracker
 from lms.djangoapps.course_blocks.api import get_course_blocks
 from lms.djangoapps.courseware.courses import get_course_by_id
 from lms.djangoapps.courseware.models import StudentModule
-from lms.djangoapps.courseware.user_state_client import DjangoXBlockUserStateClient
-from lms.djangoapps.instructor_analytics.basic import enrolled_students_features, get_response_state
+from lms.djangoapps.instructor_analytics.basic import (
+    enrolled_students_features,
+    get_response_state,
+    PROFILE_FEATURES,
+    STUDENT_FEATURES,
+    UNAVAILABLE,
+)
+from lms.djangoapps.instructor_task.models import InstructorTask
 from lms.djangoapps.instructor_task.tasks_helper.runner import TaskProgress
+from lms.djangoapps.teams.models import CourseTeam
+from lms.djangoapps.verify_student.services import IDVerificationService
+import cProfile
+import hashlib
+from itertools import chain, islice, tee
+import json
 import logging
-from opaque_keys.edx.keys import UsageKey
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import CourseKey, UsageKey
+from openassessment.assessment.models import Assessment, AssessmentFeedback
 from openassessment.data import OraAggregateData
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
 from openedx.core.djangoapps.course_groups.cohorts import is_course_cohorted
+from openedx.core.djangoapps.course_groups.models import CourseUserGroup
 from openedx.core.djangoapps.site_configuration import helpers as configuration_helpers
 from pytz import UTC
+from submissions.models import Score, Submission
+from submissions.serializers import ScoreSerializer, StudentItemSerializer, SubmissionSerializer
+import tempfile
 from time import time
+from xblock.fields import Scope
 from xmodule.modulestore.django import modulestore
 
 import sys
 
-from .models import JsonReportStore
+from .models import JsonReportEncoder, JsonReportStore, ReportIndexFile, ReportUploader
+from .profiling import ReportMetrics
+
+try:
+    from uchileedxlogin.models import EdxLoginUser
+except ImportError:
+    EdxLoginUser = None
 
 
 logger = logging.getLogger(__name__)
 
 REPORT_REQUESTED_EVENT_NAME = u'edx.instructor.report.requested'
 
+# Task type of the `InstructorTask` of every report
+REPORT_TASK_TYPE = 'cmmedu_seguimiento_report'
+
+STRUCTURAL_BLOCK_TYPES = ('sequential', 'chapter', 'vertical')
+
+REPORT_MODES = ('full', 'incremental')
+
+REPORT_FORMATS = ('classic', 'jsonl')
+
+# Lowest calibration of the estimates (see `get_estimate_calibration`), so
+# that no estimate is null
+MIN_ESTIMATE_CALIBRATION = 0.001
+
+ORA_TIMESTAMP_COLUMNS = ('Date/Time Response Submitted', 'Date/Time Final Score Given')
+
+# Private helpers of `OraAggregateData` that `build_ora_rows` builds the cells
+# of `collect_ora2_data` with
+ORA_CELL_BUILDERS = (
+    '_use_read_replica',
+    '_build_assessments_cell',
+    '_build_assessments_parts_cell',
+    '_build_feedback_options_cell',
+    '_build_feedback_cell',
+)
+
+# Columns of `OraAggregateData.collect_ora2_data`
+ORA_COLUMNS = (
+    'Submission ID', 'Item ID', 'Anonymized Student ID', 'Date/Time Response Submitted', 'Response',
+    'Assessment Details', 'Assessment Scores', 'Date/Time Final Score Given', 'Final Score Points Earned',
+    'Final Score Points Possible', 'Feedback Statements Selected', 'Feedback on Peer Assessments',
+)
 
-def make_report(_xmodule_instance_args, _entry_id, course_id, task_input, action_name):
+# Profile features computed per student by `iter_student_profiles`, besides
+# the `meta.<key>` features of the profile meta
+STREAMED_PROFILE_FEATURES = set(STUDENT_FEATURES) | set(PROFILE_FEATURES) | {
+    'cohort', 'team', 'enrollment_mode', 'verification_status', 'run',
+}
+
+REPORT_PROGRESS_MAIN_PART = 'main'
+
+
+def make_report(_xmodule_instance_args, entry_id, course_id, task_input, action_name):
     """
     For a given `course_id`, generate a JSON file containing profile
     information, ORA data, blocks data and student state for all students 
@@ -39,17 +116,114 @@ def make_report(_xmodule_instance_args, _entry_id, course_id, task_input, action
     start_time = time()
     start_date = datetime.now(UTC)
 
-    enrolled_students = CourseEnrollment.objects.users_enrolled_in(course_id)
-    problem_locations = "block-v1:{}+type@course+block@course".format(course_id)
+    enrolled_students = CourseEnrollment.objects.users_enrolled_in(course_id).using(get_report_database())
     task_progress = TaskProgress(action_name, enrolled_students.count(), start_time)
 
     current_step = {'step': 'Generating report data...'}
     task_progress.update_task_state(extra_meta=current_step)
-    logger.info("Started data generation for course %s.", course_id)
+    checkpoint = ReportCheckpoint(entry_id, course_id)
+    if checkpoint.resumed:
+        # A retry of the task: keep the files of the parts already stored
+        start_date, plan = checkpoint.start_date, checkpoint.plan
+        logger.info("Resuming report of course %s from its checkpoint.", course_id)
+    else:
+        logger.info("Started data generation for course %s.", course_id)
+        plan = get_report_plan(
+            course_id,
+            task_input.get('mode', 'full'),
+            task_input.get('compact', False),
+            task_input.get('format', 'classic'),
+            task_input.get('index', False)
+        )
+        plan_report_files(task_input["user_id"], course_id, plan)
+        checkpoint.start(start_date, plan)
+    start_report_progress(entry_id, [REPORT_PROGRESS_MAIN_PART], start_time)
+    progress = ReportProgress(entry_id, task_progress=task_progress)
+    metrics = ReportMetrics()
+    profiler = cProfile.Profile() if task_input.get('profile') else None
+    if profiler is not None:
+        profiler.enable()
+
+    # Sections are stored in the background, and any error storing them is
+    # raised when the uploader is left, before the report is marked as ready.
+    with metrics.track(), open_report_uploader() as uploader:
+        # Student profile
+        progress.set_stage('student_profile')
+        student_profile_report = checkpoint.get_part('student_profile')
+        if student_profile_report is None:
+            with measure_report_part(metrics, 'student_profile') as part_metrics:
+                student_profile_report = upload_student_profile_data(
+                    course_id,
+                    start_date,
+                    plan,
+                    part_metrics,
+                    get_batch_profile_fields(task_input),
+                    task_input.get('batch_id')
+                )
+            student_profile_report['metrics'] = part_metrics.as_dict()
+            checkpoint.add_part('student_profile', student_profile_report)
+            logger.info("Stored student profile data.")
+        progress.add(bytes_uploaded=student_profile_report['size'])
+
+        # ORA data
+        progress.set_stage('ora_data')
+        ora_report = checkpoint.get_part('ora_data')
+        if ora_report is None:
+            with measure_report_part(metrics, 'ora_data') as part_metrics:
+                ora_report = upload_ora_data(course_id, start_date, plan, part_metrics, task_input.get('split_ora'))
+            ora_report['metrics'] = part_metrics.as_dict()
+            checkpoint.add_part('ora_data', ora_report)
+            logger.info("Stored ORA data.")
+        progress.add(bytes_uploaded=ora_report['size'])
+
+        # Blocks and student state
+        progress.set_stage('blocks_data')
+        sections = build_blocks_data(
+            user_id=task_input["user_id"],
+            course_key=course_id,
+            usage_key_str=get_course_root(course_id),
+            start_date=start_date,
+            plan=plan,
+            progress=progress,
+            metrics=metrics,
+            uploader=uploader,
+            checkpoint=checkpoint
+        )
+    progress.set_stage('done')
 
-    # Student profile
+    cprofile_name = None
+    if profiler is not None:
+        profiler.disable()
+        cprofile_name = upload_cprofile_stats(profiler, course_id, start_date)
+    log_report_metrics(course_id, metrics)
+    manifest_name = upload_report_manifest(course_id, start_date, plan, student_profile_report, ora_report, sections, metrics, cprofile_name)
+    checkpoint.remove()
+    current_step = {'step': 'Report ready.'}
+    current_step.update(get_report_metadata(course_id, start_date, len(sections), plan, manifest_name))
+    current_step['metrics'] = metrics.summary()
+
+    return task_progress.update_task_state(extra_meta=current_step)
+
+
+def upload_student_profile_data(course_id, start_date, plan=None, metrics=None, profile_fields=None, batch_id=None):
+    """
+    Store the profile information of the students enrolled in the course.
+    The rows are written to the report file as the students are read, in
+    batches (see `iter_student_profiles`). In an incremental `plan`, only the
+    students whose enrollment changed since the previous report are stored.
+    Returns the description of the stored file.
+
+    `profile_fields` is the `student_profile_download_fields` configuration,
+    looked up if not given (a batch of reports looks it up once), and
+    `batch_id` the batch of the report, whose reports share the users they
+    read (see `iter_student_profiles`).
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
     course = get_course_by_id(course_id)
-    query_features = list(configuration_helpers.get_value('student_profile_download_fields', []))
+    if profile_fields is None:
+        profile_fields = get_profile_fields()
+    query_features = list(profile_fields)
     if not query_features:
         query_features = [
             'id', 'username', 'name', 'email', 'language', 'location',
@@ -65,129 +239,1756 @@ def make_report(_xmodule_instance_args, _entry_id, course_id, task_input, action
     query_features.append('country')
     if settings.UCHILEEDXLOGIN_TASK_RUN_ENABLE:
         query_features.insert(0,'run')
-    student_profile_data = enrolled_students_features(course_id, query_features)
-    student_profile_report_name = upload_json_to_report_store(student_profile_data, 'student_profile', course_id, start_date)
-    logger.info("Stored student profile data.")
-
-    # ORA data
-    header, datarows = OraAggregateData.collect_ora2_data(course_id)
-    ora_data = [dict(zip(header, row)) for row in datarows]
-    ora_report_name = upload_json_to_report_store(ora_data, 'ora_data', course_id, start_date)
-    logger.info("Stored ORA data.")
-
-    # Blocks and student state
-    report_names = build_blocks_data(
-        user_id=task_input["user_id"],
-        course_key=course_id,
-        usage_key_str=problem_locations,
-        start_date=start_date
+    since = get_plan_since(plan)
+    if since is not None and 'username' not in query_features:
+        query_features.append('username')
+    user_ids = None
+    if since is not None:
+        changed_enrollments = CourseEnrollment.history.using(get_report_database()).filter(
+            course_id=course_id,
+            history_date__gte=since
+        )
+        user_ids = changed_enrollments.values('user_id')
+    student_profile_data = iter_student_profiles(course_id, query_features, user_ids, metrics, batch_id)
+    if since is not None and plan.get('compact'):
+        previous_reports = [manifest['student_profile']['name'] for manifest in read_plan_manifests(course_id, plan)]
+        # The students whose enrollment changed and are not enrolled anymore
+        # are dropped from the merged rows
+        changed_usernames = get_user_model().objects.using(get_report_database()).filter(
+            id__in=user_ids
+        ).values_list('username', flat=True)
+        student_profile_data = merge_report_rows(
+            course_id, previous_reports, student_profile_data, 'username', changed_usernames
+        )
+
+    with open_report_file(
+        'student_profile', course_id, start_date, metrics=metrics, report_format=get_plan_format(plan)
+    ) as report_file:
+        for row in student_profile_data:
+            report_file.append(row)
+    return report_file.describe()
+
+
+def iter_student_profiles(course_key, features, user_ids=None, metrics=None, batch_id=None):
+    """
+    Yield the same rows as `enrolled_students_features(course_key, features)`,
+    ordered by username, reading the enrolled students in batches of
+    `CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE` (paginated by username) with their
+    profile, cohort, team, enrollment mode and run fetched once per batch.
+    Only the verification status of students in a verified mode is queried
+    per student.
+
+    `user_ids` restricts the rows to those students (a list or a queryset of
+    ids). If a feature is not computed here (see `STREAMED_PROFILE_FEATURES`),
+    all rows are read at once with `enrolled_students_features`.
+
+    In a batch of reports (`batch_id`), the users and their profile are
+    shared through the cache by the reports of the batch (see
+    `load_batch_students`), so the students enrolled in several of its
+    courses are read once. Pages are then taken by the ids and usernames
+    read from the database, not from the cached users, which may be stale
+    or missing.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    unsupported = [
+        feature for feature in features
+        if feature not in STREAMED_PROFILE_FEATURES and 'meta.' not in feature
+    ]
+    if 'run' in features and EdxLoginUser is None:
+        unsupported.append('run')
+    if unsupported:
+        logger.info("Reading all student profiles at once for the features %s.", unsupported)
+        with metrics.phase('enrolled_students_features'):
+            rows = enrolled_students_features(course_key, features)
+        if user_ids is not None:
+            usernames = set(
+                get_user_model().objects.using(get_report_database()).filter(id__in=user_ids).values_list('username', flat=True)
+            )
+            rows = [row for row in rows if row['username'] in usernames]
+        for row in rows:
+            yield row
+        return
+
+    database = get_report_database()
+    students = get_user_model().objects.using(database).filter(
+        courseenrollment__course_id=course_key,
+        courseenrollment__is_active=1,
+    ).order_by('username').select_related('profile')
+    if user_ids is not None:
+        students = students.filter(id__in=user_ids)
+    # Prefetched on every page of students, since the users shared by a batch
+    # of reports come from the cache
+    lookups = []
+    if 'cohort' in features:
+        lookups.append(Prefetch('course_groups', queryset=CourseUserGroup.objects.filter(course_id=course_key)))
+    if 'team' in features:
+        lookups.append(Prefetch('teams', queryset=CourseTeam.objects.filter(course_id=course_key)))
+
+    batch_size = settings.CMMEDU_SEGUIMIENTO_PROFILE_BATCH_SIZE
+    last_username = None
+    while True:
+        with metrics.phase('enrolled_students_features'):
+            page = students if last_username is None else students.filter(username__gt=last_username)
+            if batch_id is None:
+                batch = list(page[:batch_size])
+                page_keys = [(student.id, student.username) for student in batch]
+            else:
+                page_keys = list(page.values_list('id', 'username')[:batch_size])
+                batch = load_batch_students(batch_id, [user_id for user_id, _ in page_keys])
+            prefetch_related_objects(batch, *lookups)
+            modes, runs = {}, {}
+            if batch and ('enrollment_mode' in features or 'verification_status' in features):
+                modes = dict(CourseEnrollment.objects.using(database).filter(
+                    course_id=course_key,
+                    user_id__in=[student.id for student in batch]
+                ).values_list('user_id', 'mode'))
+            if batch and 'run' in features:
+                runs = dict(EdxLoginUser.objects.using(database).filter(
+                    user_id__in=[student.id for student in batch]
+                ).values_list('user_id', 'run'))
+            rows = [extract_student_profile(student, course_key, features, modes, runs) for student in batch]
+        for row in rows:
+            yield row
+        if len(page_keys) < batch_size:
+            return
+        last_username = page_keys[-1][1]
+
+
+def load_batch_students(batch_id, user_ids):
+    """
+    Return the users with the given ids, in the same order and with their
+    profile, sharing them through the cache with the other reports of the
+    batch `batch_id` for `CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT` seconds: only the
+    users not read yet by a report of the batch are queried. Users that no
+    longer exist are left out.
+    """
+    cache_keys = {user_id: get_batch_student_cache_key(batch_id, user_id) for user_id in user_ids}
+    cached = cache.get_many(list(cache_keys.values()))
+    users = {user_id: cached[cache_key] for user_id, cache_key in cache_keys.items() if cache_key in cached}
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if missing:
+        read = get_user_model().objects.using(get_report_database()).filter(id__in=missing).select_related('profile')
+        read = {user.id: user for user in read}
+        cache.set_many(
+            {cache_keys[user_id]: user for user_id, user in read.items()},
+            settings.CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT
+        )
+        users.update(read)
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
+def extract_student_profile(student, course_key, features, modes, runs):
+    """
+    Return the row of `student` as `enrolled_students_features` does, given
+    the enrollment `modes` and `runs` of its batch, by user id.
+    """
+    row = OrderedDict(
+        (feature, extract_profile_attr(student, feature))
+        for feature in STUDENT_FEATURES if feature in features
     )
+    try:
+        profile = student.profile
+    except ObjectDoesNotExist:
+        profile = None
+    if profile is not None:
+        row.update(
+            (feature, extract_profile_attr(profile, feature))
+            for feature in PROFILE_FEATURES if feature in features
+        )
+        meta = json.loads(profile.meta) if profile.meta else {}
+        for feature in features:
+            if 'meta.' in feature:
+                row[feature] = meta.get(feature.split('.')[1])
+    if 'cohort' in features:
+        row['cohort'] = next((group.name for group in student.course_groups.all()), '[unassigned]')
+    if 'team' in features:
+        row['team'] = next((team.name for team in student.teams.all()), UNAVAILABLE)
+    if 'enrollment_mode' in features or 'verification_status' in features:
+        mode = modes.get(student.id)
+        if 'verification_status' in features:
+            # Students outside a verified mode are 'N/A' without a query
+            user_is_verified = None if mode in CourseMode.VERIFIED_MODES else False
+            row['verification_status'] = IDVerificationService.verification_status_for_user(
+                student, mode, user_is_verified
+            )
+        if 'enrollment_mode' in features:
+            row['enrollment_mode'] = mode
+    if 'run' in features:
+        row['run'] = runs.get(student.id, '')
+    return row
+
+
+def extract_profile_attr(obj, feature):
+    """
+    Return the attribute `feature` of `obj` if it can be serialized as JSON,
+    or else its text, as `enrolled_students_features` does.
+    """
+    value = getattr(obj, feature)
+    try:
+        DjangoJSONEncoder().default(value)
+        return value
+    except TypeError:
+        return str(value)
+
+
+def get_profile_fields():
+    """
+    Return the student profile fields configured for the current site.
+    """
+    return list(configuration_helpers.get_value('student_profile_download_fields', []))
+
+
+def upload_ora_data(course_id, start_date, plan=None, metrics=None, split_by_block=None):
+    """
+    Store the ORA data of the course. The rows are written to the report file
+    as the submissions are read, in batches (see `iter_ora_rows`). In an
+    incremental `plan`, only the submissions submitted or scored since the
+    previous report are stored.
+
+    If `split_by_block` (by default `CMMEDU_SEGUIMIENTO_ORA_SPLIT_BY_BLOCK`)
+    is set, the rows of every ORA block are also stored in a file of their
+    own, listed in the `blocks` of the description by item id. Returns the
+    description of the stored file.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    if split_by_block is None:
+        split_by_block = settings.CMMEDU_SEGUIMIENTO_ORA_SPLIT_BY_BLOCK
+    since = get_plan_since(plan)
+    ora_data = iter_ora_rows(course_id, metrics, since)
+
+    if since is not None:
+        # The query also returns the submissions whose latest score, given
+        # since then, belongs to a later submission
+        ora_data = (row for row in ora_data if is_modified_since(row, ORA_TIMESTAMP_COLUMNS, since))
+        if plan.get('compact'):
+            previous_reports = [manifest['ora_data']['name'] for manifest in read_plan_manifests(course_id, plan)]
+            ora_data = merge_report_rows(course_id, previous_reports, ora_data, 'Submission ID')
+
+    report_format = get_plan_format(plan)
+    block_files = OrderedDict()
+    # Every file is discarded if any row fails
+    with ExitStack() as stack:
+        report_file = stack.enter_context(
+            open_report_file('ora_data', course_id, start_date, metrics=metrics, report_format=report_format)
+        )
+        for row in ora_data:
+            report_file.append(row)
+            if split_by_block:
+                item_id = row['Item ID']
+                if item_id not in block_files:
+                    block_files[item_id] = stack.enter_context(open_report_file(
+                        'ora_data_{}'.format(len(block_files) + 1),
+                        course_id,
+                        start_date,
+                        metrics=metrics,
+                        report_format=report_format
+                    ))
+                block_files[item_id].append(row)
+    report = report_file.describe()
+    if split_by_block:
+        report['blocks'] = OrderedDict(
+            (item_id, block_file.describe()) for item_id, block_file in block_files.items()
+        )
+    return report
+
 
-    current_step = {
-        'step': 'Report ready.',
-        'course_key': student_profile_report_name.split("_student_profile")[0],
-        'timestamp': student_profile_report_name.split("_")[-1].split(".")[0],
-        'n_reports': len(report_names)
+def iter_ora_rows(course_id, metrics=None, since=None):
+    """
+    Yield the rows of `OraAggregateData.collect_ora2_data(course_id)` as
+    dicts by column, reading the submissions in batches of
+    `CMMEDU_SEGUIMIENTO_ORA_BATCH_SIZE` with their assessments and feedback
+    fetched once per batch, instead of once per submission.
+
+    If `since` is given, only the submissions submitted or scored since then
+    are read (see `iter_ora_submissions`).
+
+    The cells are built with private helpers of `OraAggregateData` (see
+    `ORA_CELL_BUILDERS`). If the installed ORA lacks any of them, the rows of
+    `collect_ora2_data` are yielded instead, all read at once.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    missing = [name for name in ORA_CELL_BUILDERS if not hasattr(OraAggregateData, name)]
+    if missing:
+        logger.warning("OraAggregateData has no %s, reading all ORA rows at once.", ', '.join(missing))
+        with metrics.phase('collect_ora2_data'):
+            header, datarows = OraAggregateData.collect_ora2_data(course_id)
+        for datarow in datarows:
+            yield OrderedDict(zip(header, datarow))
+        return
+    submissions = iter_ora_submissions(course_id, since)
+    batch_size = settings.CMMEDU_SEGUIMIENTO_ORA_BATCH_SIZE
+    while True:
+        with metrics.phase('collect_ora2_data'):
+            batch = list(islice(submissions, batch_size))
+            rows = build_ora_rows(batch)
+        for row in rows:
+            yield row
+        if len(batch) < batch_size:
+            return
+
+
+def iter_ora_submissions(course_id, since=None):
+    """
+    Yield the (student item, submission, score) of every ORA submission of
+    the course, as `submissions.api.get_all_course_submission_information`
+    does.
+
+    If `since` is given, the query only returns the submissions submitted
+    since then or whose student item got its latest score since then, so an
+    incremental report does not read every submission of the course.
+    """
+    submissions = Submission.objects.using(get_report_database()).select_related(
+        'student_item__scoresummary__latest__submission'
+    ).filter(student_item__course_id=str(course_id), student_item__item_type='openassessment')
+    if since is not None:
+        submissions = submissions.filter(
+            Q(submitted_at__gte=since) | Q(student_item__scoresummary__latest__created_at__gte=since)
+        )
+    for submission in submissions.iterator(chunk_size=settings.CMMEDU_SEGUIMIENTO_ORA_BATCH_SIZE):
+        student_item = submission.student_item
+        score = {}
+        if hasattr(student_item, 'scoresummary'):
+            latest_score = student_item.scoresummary.latest
+            # Only the score of the latest submission is exported
+            if not latest_score.is_hidden() and latest_score.submission.uuid == submission.uuid:
+                score = ScoreSerializer(latest_score).data
+        yield StudentItemSerializer(student_item).data, SubmissionSerializer(submission).data, score
+
+
+def build_ora_rows(batch):
+    """
+    Return the rows of a `batch` of (student item, submission, score), with
+    the cells built by `OraAggregateData` as in `collect_ora2_data`.
+    """
+    uuids = [submission['uuid'] for _, submission, _ in batch]
+    assessments = defaultdict(list)
+    if uuids:
+        queryset = Assessment.objects.prefetch_related('parts', 'rubric').filter(submission_uuid__in=uuids)
+        for assessment in OraAggregateData._use_read_replica(queryset):
+            assessments[assessment.submission_uuid].append(assessment)
+    feedback_uuids = set(
+        AssessmentFeedback.objects.filter(submission_uuid__in=uuids).values_list('submission_uuid', flat=True)
+    ) if uuids else set()
+
+    rows = []
+    for student_item, submission, score in batch:
+        submission_assessments = assessments[submission['uuid']]
+        rows.append(OrderedDict(zip(ORA_COLUMNS, [
+            submission['uuid'],
+            student_item['item_id'],
+            student_item['student_id'],
+            submission['submitted_at'],
+            submission['answer'],
+            OraAggregateData._build_assessments_cell(submission_assessments),
+            OraAggregateData._build_assessments_parts_cell(submission_assessments),
+            score.get('created_at', ''),
+            score.get('points_earned', ''),
+            score.get('points_possible', ''),
+            OraAggregateData._build_feedback_options_cell(submission_assessments),
+            # Only the submissions with feedback need a query
+            OraAggregateData._build_feedback_cell(submission['uuid']) if submission['uuid'] in feedback_uuids else '',
+        ])))
+    return rows
+
+
+def course_exists(course_key):
+    """
+    Return whether the course exists, without loading it from the modulestore.
+
+    The course overview table is checked first, and the modulestore course
+    index only for courses without an overview. The result is cached for
+    `CMMEDU_SEGUIMIENTO_COURSE_EXISTS_CACHE_TIMEOUT` seconds, since the report
+    endpoints are polled often for the same courses.
+    """
+    cache_key = 'cmmedu_seguimiento.course_exists.{}'.format(course_key)
+    exists = cache.get(cache_key)
+    if exists is None:
+        exists = CourseOverview.course_exists(course_key) or modulestore().has_course(course_key) is not None
+        cache.set(cache_key, exists, settings.CMMEDU_SEGUIMIENTO_COURSE_EXISTS_CACHE_TIMEOUT)
+    return exists
+
+
+def get_report_database():
+    """
+    Return the alias of the database that reports read student state,
+    enrollments and profiles from: `CMMEDU_SEGUIMIENTO_REPORT_DATABASE` (a
+    read replica) if it is configured, or else the default database. A
+    replica may lag behind the default database by up to
+    `CMMEDU_SEGUIMIENTO_REPORT_DATABASE_LAG` seconds.
+    """
+    alias = settings.CMMEDU_SEGUIMIENTO_REPORT_DATABASE
+    return alias if alias in settings.DATABASES else DEFAULT_DB_ALIAS
+
+
+def get_course_root(course_id):
+    """
+    Return the usage key string of the course block.
+    """
+    return "block-v1:{}+type@course+block@course".format(course_id)
+
+
+def get_report_metadata(course_id, start_date, n_reports, plan=None, manifest_name=None):
+    """
+    Return the values stored in the task output that `CMMEduSeguimientoGetReport`
+    uses to find the files of a report.
+    """
+    return {
+        'course_key': course_filename_prefix_generator(course_id),
+        'timestamp': start_date.strftime("%Y-%m-%d-%H%M"),
+        'n_reports': n_reports,
+        'mode': get_plan_output_mode(plan),
+        'manifest': manifest_name
     }
 
-    return task_progress.update_task_state(extra_meta=current_step)
 
+def count_report_blocks(user_id, course_key, usage_key_str, plan=None):
+    """
+    Return the number of non structural blocks of every `report_data_N`
+    section that `build_blocks_data` writes for the course.
+    """
+    snapshot = load_content_snapshot(user_id, course_key, usage_key_str)
+    return [count_section_blocks(entries) for _, entries in get_plan_sections(snapshot, plan)]
+
+
+def count_section_blocks(entries):
+    """
+    Return the number of non structural blocks of a section.
+    """
+    return sum(
+        1 for _, _, block_key in entries
+        if block_key.block_type not in STRUCTURAL_BLOCK_TYPES and block_key.block_type != 'course'
+    )
+
+
+def plan_report_chunks(user_id, course_key, usage_key_str, snapshot=None, sizes=None):
+    """
+    Split the sections of the course into the `report_data_N` files of a
+    report, so that every file has at most
+    `CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES` responses and
+    `CMMEDU_SEGUIMIENTO_REPORT_CHUNK_BYTES` bytes of student state (0 for no
+    limit), as estimated by `estimate_block_sizes`.
+
+    Sections are the preferred split points: consecutive sections share a
+    file while they fit in it, and only a section too large for a file of
+    its own is split between its blocks. A single block is never split.
+
+    Returns the `[start, end)` ranges of every file over the entries of all
+    the sections, as `plan['chunks']` (see `get_plan_sections`), or None if
+    there are no limits. The content `snapshot` and the block `sizes` are
+    loaded if not given.
+    """
+    max_responses = settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES
+    max_bytes = settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_BYTES
+    if not max_responses and not max_bytes:
+        return None
+    if snapshot is None:
+        snapshot = load_content_snapshot(user_id, course_key, usage_key_str)
+    if sizes is None:
+        sizes = estimate_block_sizes(course_key, settings.FEATURES.get('MAX_PROBLEM_RESPONSES_COUNT'), count_bytes=bool(max_bytes))
+
+    def exceeds(responses, size):
+        return (max_responses and responses > max_responses) or (max_bytes and size > max_bytes)
+
+    chunks = []
+    start = position = 0
+    responses = size = 0
+    for _, entries in get_snapshot_sections(snapshot):
+        entry_sizes = [sizes.get(block_key, (0, 0)) for _, _, block_key in entries]
+        if position > start and exceeds(responses + sum(r for r, _ in entry_sizes), size + sum(b for _, b in entry_sizes)):
+            chunks.append([start, position])
+            start = position
+            responses = size = 0
+        for block_responses, block_size in entry_sizes:
+            if position > start and exceeds(responses + block_responses, size + block_size):
+                chunks.append([start, position])
+                start = position
+                responses = size = 0
+            responses += block_responses
+            size += block_size
+            position += 1
+    if position > start:
+        chunks.append([start, position])
+    return chunks
+
+
+def estimate_block_sizes(course_key, max_count=None, count_bytes=True):
+    """
+    Return the number of responses and bytes of student state of every block
+    of the course with student state, in a single aggregate query. Blocks
+    with more than `max_count` responses are counted as that many, as they
+    are exported.
+    """
+    rows = StudentModule.objects.using(get_report_database()).filter(
+        course_id=course_key
+    ).order_by().values('module_state_key').annotate(responses=Count('id'))
+    if count_bytes:
+        rows = rows.annotate(size=Sum(Length('state')))
+    sizes = {}
+    for row in rows:
+        responses = row['responses'] if max_count is None else min(row['responses'], max_count)
+        size = row.get('size') or 0
+        if responses < row['responses']:
+            size = size * responses // row['responses']
+        sizes[row['module_state_key'].map_into_course(course_key)] = (responses, size)
+    return sizes
+
+
+def plan_report_work(user_id, course_key, plan):
+    """
+    Add to `plan` the `chunks` of its files and the `estimate` of its work
+    (see `estimate_report_work`, without the estimate of every block), and
+    return the whole estimate.
+    """
+    work = estimate_report_work(user_id, course_key, get_course_root(course_key), plan)
+    plan['chunks'] = work['chunks']
+    plan['estimate'] = {key: value for key, value in work.items() if key not in ('chunks', 'blocks')}
+    return work
+
+
+def is_report_chunked():
+    """
+    Return whether the blocks data of reports is split into chunks (see
+    `plan_report_chunks`).
+    """
+    return bool(settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_RESPONSES or settings.CMMEDU_SEGUIMIENTO_REPORT_CHUNK_BYTES)
+
+
+def plan_report_files(user_id, course_key, plan):
+    """
+    Add to `plan` the `chunks` of its files and the `estimate` of its work
+    (see `plan_report_work`) if reports are split into chunks, which needs
+    the same sizes of the blocks as the estimate. Otherwise every file is a
+    section and `plan` is left as is, without the queries of the estimate,
+    which are only run for chunked reports and dry runs.
+    """
+    if is_report_chunked():
+        plan_report_work(user_id, course_key, plan)
+    return plan
+
+
+def estimate_report_work(user_id, course_key, usage_key_str, plan=None):
+    """
+    Estimate the work of the report of the course before running it, from
+    the content snapshot and a single aggregate query of the responses and
+    bytes of student state of every block (see `estimate_block_sizes`), and
+    return the work plan:
+
+        chunks: the files the blocks data is split into (see
+            `plan_report_chunks`)
+        blocks, chapters, sections: the `responses`, `bytes` of student state
+            and `seconds` estimated for every block with student state, every
+            chapter and every `report_data_N` file
+        student_profile, ora_data: the rows and seconds of those files
+        subtasks: the parts of a parallel report, longest first, and the
+            `worker` each one is assigned to out of
+            `CMMEDU_SEGUIMIENTO_ESTIMATE_WORKERS`
+        duration: the seconds expected for a `sequential` and a `parallel`
+            report
+        calibration: the factor applied to `CMMEDU_SEGUIMIENTO_ESTIMATE_RATES`
+            (see `get_estimate_calibration`)
+
+    The responses of an incremental report are estimated as those of a full
+    one, so they are an upper bound.
+    """
+    snapshot = load_content_snapshot(user_id, course_key, usage_key_str)
+    sizes = estimate_block_sizes(course_key, settings.FEATURES.get('MAX_PROBLEM_RESPONSES_COUNT'))
+    chunks = plan_report_chunks(user_id, course_key, usage_key_str, snapshot, sizes)
+    calibration = get_estimate_calibration(course_key, plan)
+    rates = {name: rate * calibration for name, rate in settings.CMMEDU_SEGUIMIENTO_ESTIMATE_RATES.items()}
+
+    def estimate(entries):
+        blocks = responses = size = 0
+        for _, _, block_key in entries:
+            if block_key.block_type not in STRUCTURAL_BLOCK_TYPES and block_key.block_type != 'course':
+                blocks += 1
+                block_responses, block_size = sizes.get(block_key, (0, 0))
+                responses += block_responses
+                size += block_size
+        seconds = blocks * rates['block'] + responses * rates['response'] + size * rates['byte']
+        return {'blocks': blocks, 'responses': responses, 'bytes': size, 'seconds': round(seconds, 3)}
+
+    blocks = []
+    chapters = []
+    for title, entries in get_snapshot_sections(snapshot):
+        chapters.append(dict(estimate(entries), title=title))
+        for entry in entries:
+            if entry[2] in sizes:
+                blocks.append(dict(estimate([entry]), block_id=entry[2].block_id, block_type=entry[2].block_type))
+    sections = [
+        dict(estimate(entries), index=index, title=title)
+        for index, (title, entries) in enumerate(get_plan_sections(snapshot, {'chunks': chunks}), 1)
+    ]
+    profile_rows = CourseEnrollment.objects.users_enrolled_in(course_key).using(get_report_database()).count()
+    ora_rows = Submission.objects.using(get_report_database()).filter(
+        student_item__course_id=str(course_key),
+        student_item__item_type='openassessment'
+    ).count()
+    student_profile = {'rows': profile_rows, 'seconds': round(profile_rows * rates['profile_row'], 3)}
+    ora_data = {'rows': ora_rows, 'seconds': round(ora_rows * rates['ora_row'], 3)}
+
+    # Longest processing time first: every part goes to the least loaded worker
+    parts = [('student_profile', student_profile['seconds']), ('ora_data', ora_data['seconds'])]
+    parts += [('section_{}'.format(section['index']), section['seconds']) for section in sections]
+    loads = [0] * max(settings.CMMEDU_SEGUIMIENTO_ESTIMATE_WORKERS, 1)
+    subtasks = []
+    for part, seconds in sorted(parts, key=lambda part: -part[1]):
+        worker = loads.index(min(loads))
+        loads[worker] += seconds
+        subtasks.append({'part': part, 'seconds': seconds, 'worker': worker})
+
+    return {
+        'chunks': chunks,
+        'blocks': blocks,
+        'chapters': chapters,
+        'sections': sections,
+        'student_profile': student_profile,
+        'ora_data': ora_data,
+        'subtasks': subtasks,
+        'duration': {
+            'sequential': round(sum(seconds for _, seconds in parts), 3),
+            'parallel': round(max(loads), 3),
+        },
+        'calibration': calibration,
+    }
+
+
+def get_estimate_calibration(course_id, plan=None, config_name='GRADES_DOWNLOAD'):
+    """
+    Return the ratio of the time the sections of the `previous` report of
+    `plan` took to the time estimated for them without calibration, or 1 if
+    there is no previous report with an estimate. Estimates are made with
+    the rates multiplied by this ratio, so they follow the measurements of
+    the course. The ratio is at least `MIN_ESTIMATE_CALIBRATION`, and
+    sections estimated with a null calibration are left out.
+    """
+    if plan is None or not plan.get('previous'):
+        return 1
+    manifest = JsonReportStore.from_config(config_name).read_manifest(course_id, plan['previous'])
+    # Reused archives took no time to write
+    measured = [
+        section for section in manifest['sections']
+        if section.get('estimate') and section['estimate'].get('calibration')
+        and section.get('metrics') and not section.get('reused')
+    ]
+    estimated = sum(section['estimate']['seconds'] / section['estimate']['calibration'] for section in measured)
+    actual = sum(section['metrics']['wall_time'] for section in measured)
+    if not estimated or not actual:
+        return 1
+    return max(round(actual / estimated, 3), MIN_ESTIMATE_CALIBRATION)
+
+
+def get_report_plan(course_id, mode='full', compact=False, report_format='classic', index=False):
+    """
+    Return how the report of `course_id` has to be generated, as a JSON
+    serializable dict that can be passed to subtasks. Its files are written
+    in `report_format` (see `JsonLinesReportFile` for the `jsonl` format), and
+    its sections are indexed for queries if `index` is set (see
+    `ReportIndexFile`).
+
+    A `full` plan exports everything. An `incremental` plan exports only what
+    changed since the last successful report of the course (`since`), on top
+    of the chain of manifests that goes from the last full snapshot to that
+    report (both included). With `compact`, the changes are merged with that chain to write a
+    new full snapshot instead of a delta. If there is no previous report with
+    a manifest, a full plan is returned.
+
+    Any plan has the manifest of the last successful report as `previous`
+    (None if there is none), whose unchanged archives are reused.
+
+    If reports read from a replica, `since` goes back
+    `CMMEDU_SEGUIMIENTO_REPORT_DATABASE_LAG` seconds from the creation of
+    the last report, as the changes made just before it may not have
+    reached the replica when that report read it.
+    """
+    previous_task, manifest_name = get_previous_report(course_id)
+    if mode != 'incremental':
+        return {'mode': 'full', 'format': report_format, 'index': bool(index), 'previous': manifest_name}
+    if manifest_name is None:
+        logger.info("No previous report for course %s, generating a full report.", course_id)
+        return {'mode': 'full', 'format': report_format, 'index': bool(index), 'previous': None}
+
+    manifest = JsonReportStore.from_config('GRADES_DOWNLOAD').read_manifest(course_id, manifest_name)
+    since = previous_task.created
+    if get_report_database() != DEFAULT_DB_ALIAS:
+        since -= timedelta(seconds=settings.CMMEDU_SEGUIMIENTO_REPORT_DATABASE_LAG)
+    return {
+        'mode': 'incremental',
+        'compact': bool(compact),
+        'since': since.isoformat(),
+        'base_timestamp': manifest['base_timestamp'],
+        'chain': manifest['chain'] + [manifest_name],
+        'format': report_format,
+        'index': bool(index),
+        'previous': manifest_name,
+    }
+
+
+def get_previous_report(course_id):
+    """
+    Return the last successful report task of `course_id` with a manifest and
+    the name of its manifest, or `(None, None)` if there is none.
+    """
+    previous_tasks = InstructorTask.objects.filter(
+        task_type=REPORT_TASK_TYPE,
+        course_id=course_id,
+        task_state=SUCCESS
+    ).order_by('-created')
+    for previous_task in previous_tasks.iterator():
+        try:
+            manifest_name = json.loads(previous_task.task_output).get('manifest')
+        except (TypeError, ValueError):
+            continue
+        if manifest_name:
+            return previous_task, manifest_name
+    return None, None
+
+
+def get_previous_archives(course_id, plan, config_name='GRADES_DOWNLOAD'):
+    """
+    Return the section archives of the `previous` report of `plan` that have
+    a content hash, by content hash.
+    """
+    if plan is None or not plan.get('previous'):
+        return {}
+    manifest = JsonReportStore.from_config(config_name).read_manifest(course_id, plan['previous'])
+    return {
+        section['content_hash']: section
+        for section in manifest['sections']
+        if section.get('content_hash')
+    }
+
+
+def get_plan_since(plan):
+    """
+    Return the datetime since which an incremental `plan` exports changes, or
+    None if everything has to be exported.
+    """
+    if plan is None or plan['mode'] != 'incremental':
+        return None
+    return datetime.fromisoformat(plan['since'])
+
+
+def get_plan_format(plan):
+    """
+    Return the format in which the files of `plan` are written.
+    """
+    if plan is None:
+        return 'classic'
+    return plan.get('format', 'classic')
+
+
+def get_plan_output_mode(plan):
+    """
+    Return the mode of the report written for `plan`: `incremental` for a
+    delta and `full` for a full or compacted snapshot.
+    """
+    if plan is None or plan['mode'] != 'incremental' or plan.get('compact'):
+        return 'full'
+    return 'incremental'
+
+
+def read_plan_manifests(course_id, plan, config_name='GRADES_DOWNLOAD'):
+    """
+    Return the manifests of the chain of reports an incremental `plan` builds
+    on, from the full snapshot to the last delta.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    return [report_store.read_manifest(course_id, manifest_name) for manifest_name in plan['chain']]
+
+
+def upload_report_manifest(course_id, start_date, plan, student_profile_report, ora_report, sections, metrics=None, cprofile_name=None, config_name='GRADES_DOWNLOAD'):
+    """
+    Store the manifest of a report, a small JSON file next to its archives
+    with everything needed to find and check them:
+
+        mode, timestamp: the kind of report and its timestamp
+        format: the format of its files, `classic` or `jsonl`
+        base_timestamp, since, chain: for a delta, the base snapshot, the date
+            since which changes are exported and the manifests of the previous
+            reports it applies to (oldest first)
+        student_profile, ora_data: name, number of items, size and checksum of
+            those archives
+        sections: the same for every `report_data_N` archive, plus the section
+            `title`, number of `blocks` and `responses` and `structure` hash
+        metrics: the `ReportMetrics` of the whole report (every file also has
+            its own `metrics`)
+        estimate: the `estimate` of `plan` (see `estimate_report_work`) with
+            the `actual` responses and seconds of the report, and every
+            section with its own `estimate`
+        cprofile: the cProfile dump of the task, if one was requested
+
+    Returns the name of the manifest.
+    """
+    timestamp = start_date.strftime("%Y-%m-%d-%H%M")
+    mode = get_plan_output_mode(plan)
+    estimate = plan.get('estimate') if plan is not None else None
+    if estimate:
+        # Every section with its estimate, next to its measurements
+        section_estimates = {section['index']: section for section in estimate['sections']}
+        sections = [
+            dict(section, estimate=dict(section_estimates[index], calibration=estimate['calibration']))
+            if index in section_estimates else section
+            for index, section in enumerate(sections, 1)
+        ]
+        estimate = dict(estimate, actual={
+            'responses': sum(section['responses'] for section in sections),
+            'seconds': round(metrics.wall_time, 3) if metrics is not None else None,
+        })
+    if mode == 'incremental':
+        base_timestamp = plan['base_timestamp']
+        chain = plan['chain']
+    else:
+        base_timestamp = timestamp
+        chain = []
+    manifest = {
+        'course_id': str(course_id),
+        'timestamp': timestamp,
+        'mode': mode,
+        'format': get_plan_format(plan),
+        'compacted': bool(plan is not None and plan['mode'] == 'incremental' and plan.get('compact')),
+        'since': plan.get('since') if plan is not None else None,
+        'base_timestamp': base_timestamp,
+        'chain': chain,
+        'student_profile': student_profile_report,
+        'ora_data': ora_report,
+        'sections': sections,
+        'metrics': metrics.as_dict() if metrics is not None else None,
+        'estimate': estimate,
+        'cprofile': cprofile_name,
+    }
+    manifest_name = get_report_name('manifest', course_id, start_date, 'json')
+    return JsonReportStore.from_config(config_name).store_manifest(course_id, manifest_name, manifest)
+
+
+def is_modified_since(row, columns, since):
+    """
+    Return whether any of the date `columns` of `row` (datetimes or date
+    strings) is later than `since`.
+    """
+    for column in columns:
+        value = row.get(column)
+        if not value:
+            continue
+        if not isinstance(value, datetime):
+            try:
+                value = parse_date(str(value))
+            except (ValueError, OverflowError):
+                continue
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=UTC)
+        if value >= since:
+            return True
+    return False
 
-def build_blocks_data(user_id, course_key, usage_key_str, start_date):
-    usage_key = UsageKey.from_string(usage_key_str).map_into_course(course_key)
-    user = get_user_model().objects.get(pk=user_id)
+
+def merge_report_rows(course_id, previous_reports, rows, key, changed_keys=(), config_name='GRADES_DOWNLOAD'):
+    """
+    Yield the rows of the stored `previous_reports` (oldest first) merged
+    with the new `rows`, keeping only the latest row for every value of
+    `key`. A new row takes the place of the row it replaces, and the other
+    new rows go at the end. `changed_keys` are the values of `key` whose
+    rows were read again for `rows`: the previous rows of those missing
+    from `rows` (like students no longer enrolled) are dropped.
+
+    The previous reports are streamed (see `JsonReportStore.iter_json`), so
+    only the new rows and the keys of the rows of the later reports, read in
+    a first pass to skip the rows they replace, are held in memory.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    new_rows = OrderedDict((row.get(key), row) for row in rows)
+    removed_keys = set(changed_keys) - set(new_rows)
+    # The index of the last previous report with every key, but the first
+    latest_report = {}
+    for index, report_name in enumerate(previous_reports[1:], 1):
+        for row in report_store.iter_json(course_id, report_name):
+            latest_report[row.get(key)] = index
+    for index, report_name in enumerate(previous_reports):
+        for row in report_store.iter_json(course_id, report_name):
+            row_key = row.get(key)
+            if row_key in removed_keys or latest_report.get(row_key, 0) != index:
+                continue
+            yield new_rows.pop(row_key, row)
+    for row in new_rows.values():
+        yield row
+
+
+def merge_responses(previous_responses, responses):
+    """
+    Replace in `previous_responses` every response of the users that have a
+    response in `responses`, keeping the order of the previous responses and
+    adding the new users at the end.
+    """
+    new_responses = OrderedDict()
+    for response in responses:
+        new_responses.setdefault(response['username'], []).append(response)
+    merged = []
+    replaced = set()
+    for response in previous_responses:
+        username = response['username']
+        if username not in new_responses:
+            merged.append(response)
+        elif username not in replaced:
+            merged.extend(new_responses[username])
+            replaced.add(username)
+    for username, user_responses in new_responses.items():
+        if username not in replaced:
+            merged.extend(user_responses)
+    return merged
+
+
+def get_plan_sections(snapshot, plan=None):
+    """
+    Return the `(title, entries)` of every `report_data_N` file of a report:
+    the sections of the content snapshot, or, if `plan` has `chunks` (see
+    `plan_report_chunks`), the entries of the sections in every chunk. A
+    chunk that starts within a section begins with the structural items
+    above its first entry, and is titled after that section.
+    """
+    sections = get_snapshot_sections(snapshot)
+    if plan is None or not plan.get('chunks'):
+        return sections
+    entries = [entry for _, section_entries in sections for entry in section_entries]
+    titles = [title for title, section_entries in sections for _ in section_entries]
+    chunks = []
+    for start, end in plan['chunks']:
+        ancestors = []
+        first_path = entries[start][1]
+        depth = len(first_path)
+        position = start - 1
+        while position >= 0 and depth > 2 and titles[position] == titles[start]:
+            _, path, block_key = entries[position]
+            if len(path) < depth and path == first_path[:len(path)] and block_key.block_type in STRUCTURAL_BLOCK_TYPES:
+                ancestors.insert(0, entries[position])
+                depth = len(path)
+            position -= 1
+        chunks.append((titles[start], ancestors + entries[start:end]))
+    return chunks
+
+
+def get_section_coverage(entries):
+    """
+    Return the titles of the `chapters` a section covers, and the ids of its
+    `first_block` and `last_block` (not structural).
+    """
+    block_ids = [
+        str(block_key).split('@')[-1] for _, _, block_key in entries
+        if block_key.block_type not in STRUCTURAL_BLOCK_TYPES and block_key.block_type != 'course'
+    ]
+    return {
+        'chapters': list(OrderedDict.fromkeys(path[1] for _, path, _ in entries)),
+        'first_block': block_ids[0] if block_ids else None,
+        'last_block': block_ids[-1] if block_ids else None,
+    }
+
+
+def get_section_structure(entries):
+    """
+    Return a hash of the blocks of a section, used to check whether a stored
+    section has the same blocks as the current one.
+    """
+    return hashlib.sha1("\n".join(str(block_key) for _, _, block_key in entries).encode('utf-8')).hexdigest()
+
+
+def read_previous_section(course_key, manifests, index, structure, config_name='GRADES_DOWNLOAD'):
+    """
+    Merge the section `index` of the reports of `manifests` into a dict
+    mapping every block id to its latest block entry. Returns None if the
+    section of any of the reports has different blocks than `structure`.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    blocks = {}
+    for manifest in manifests:
+        sections = manifest['sections']
+        if len(sections) < index or sections[index - 1]['structure'] != structure:
+            return None
+        for block_item in report_store.read_json(course_key, sections[index - 1]['name']):
+            if block_item['is_structural_item']:
+                continue
+            previous_item = blocks.get(block_item['block_id'])
+            if previous_item is not None:
+                block_item['responses'] = merge_responses(previous_item['responses'], block_item['responses'])
+            blocks[block_item['block_id']] = block_item
+    return blocks
+
+
+def build_blocks_data(user_id, course_key, usage_key_str, start_date, section_indexes=None, plan=None, progress=None, metrics=None, uploader=None, checkpoint=None):
+    """
+    Store the blocks data and student state of the course, one `report_data_N`
+    file per section, or per chunk of sections if `plan` has `chunks` (see
+    `get_plan_sections`). If `section_indexes` is given, only the sections
+    with those (1-based) indexes are stored.
+
+    In an incremental `plan`, only the blocks with student state modified
+    since the previous report are stored (structural items are always
+    stored). With `compact`, those blocks are merged with the previous
+    reports; a section whose blocks changed since then is exported in full.
+
+    If a `ReportProgress` is given, the blocks and sections done, responses
+    exported and bytes uploaded are reported to it. If a `ReportMetrics` is
+    given, every section is measured apart and its phases added to it.
+
+    The course structure and the static data of the blocks are taken from
+    the content snapshot of the course (see `load_content_snapshot`). Every
+    section is stored in the background by `uploader` (or by an uploader of
+    its own, see `open_report_uploader`) while the next one is produced. A
+    section with the same contents as one of the `previous` report of `plan`
+    reuses its archive instead.
+
+    Every stored section is recorded in `checkpoint` if one is given, and
+    the sections it already records (with the same structure) are not
+    stored again.
+
+    Returns the manifest entry of every stored section: the description of
+    its archive plus its title, the `chapters` and the `first_block` and
+    `last_block` it covers, structure hash, block and response counts and
+    metrics.
+    """
     store = modulestore()
-    user_state_client = DjangoXBlockUserStateClient()
     max_count = settings.FEATURES.get('MAX_PROBLEM_RESPONSES_COUNT')
+    since = get_plan_since(plan)
+    compact = since is not None and plan.get('compact')
+    previous_manifests = read_plan_manifests(course_key, plan) if compact else []
+    previous_archives = get_previous_archives(course_key, plan)
+    if progress is None:
+        progress = ReportProgress(None)
+    if metrics is None:
+        metrics = ReportMetrics()
+    if checkpoint is None:
+        checkpoint = ReportCheckpoint(None, course_key)
     with store.bulk_operations(course_key):
-        course_blocks = get_course_blocks(user, usage_key)
-        current_section = ""
-        block_count = 0
-        response_count = 0
+        snapshot = load_content_snapshot(user_id, course_key, usage_key_str, metrics=metrics)
+        sections = get_plan_sections(snapshot, plan)
+        progress.update(total_blocks=sum(
+            count_section_blocks(entries)
+            for index, (_, entries) in enumerate(sections, 1)
+            if section_indexes is None or index in section_indexes
+        ))
         reports = []
-        blocks_data = []
-        for title, path, block_key in build_problem_list(course_blocks, usage_key):
-            if len(path) < 2:
-                continue
-            new_section = path[1]
-            if new_section != current_section:
-                if current_section != "":
-                    index = len(reports) + 1
-                    reports.append(upload_json_to_report_store(blocks_data, 'report_data_' + str(index), course_key, start_date))
-                    blocks_data = []
-                    logger.info("Stored %d blocks with %d responses for section %s.", block_count, response_count, current_section)
-                    block_count = 0
-                    response_count = 0
-                current_section = new_section
-            if block_key.block_type in ('sequential', 'chapter', 'vertical'):
+        pending = deque()
+        index = 0
+        with open_report_uploader(uploader) as uploader:
+            for section, entries in sections:
+                index += 1
+                if section_indexes is not None and index not in section_indexes:
+                    continue
+                progress.update(section=section)
+                structure = get_section_structure(entries)
+                section_report = checkpoint.get_section(index, structure)
+                if section_report is not None:
+                    # Stored by a previous run of the task
+                    while pending:
+                        reports.append(finish_pending_section(pending, progress, metrics, checkpoint))
+                    reports.append(section_report)
+                    progress.add(sections=1, blocks=count_section_blocks(entries), responses=section_report['responses'], bytes_uploaded=section_report['size'])
+                    continue
+                previous_blocks = None
+                section_since = since
+                if compact:
+                    previous_blocks = read_previous_section(course_key, previous_manifests, index, structure)
+                    if previous_blocks is None:
+                        section_since = None
+
+                with measure_report_part(metrics, 'section') as section_metrics:
+                    report_file, index_file, section_report = build_section_data(
+                        store, course_key, start_date, index, entries, max_count,
+                        since=section_since, previous_blocks=previous_blocks, progress=progress, metrics=section_metrics,
+                        static_blocks=snapshot['blocks'], report_format=get_plan_format(plan), uploader=uploader,
+                        previous_archives=previous_archives, indexed=bool(plan is not None and plan.get('index'))
+                    )
+                section_report.update({'title': section, 'structure': structure})
+                section_report.update(get_section_coverage(entries))
+                pending.append((index, report_file, index_file, section_report, section_metrics))
+                # Report the sections already stored, in order, and go on
+                while pending and pending[0][1].done() and (pending[0][2] is None or pending[0][2].done()):
+                    reports.append(finish_pending_section(pending, progress, metrics, checkpoint))
+            while pending:
+                reports.append(finish_pending_section(pending, progress, metrics, checkpoint))
+
+        if index == 0 and (section_indexes is None or 1 in section_indexes):
+            section_report = upload_json_to_report_store([], 'report_data_1', course_key, start_date, report_format=get_plan_format(plan))
+            section_report.update({'title': None, 'structure': get_section_structure([]), 'blocks': 0, 'responses': 0})
+            reports.append(section_report)
+
+    return reports
+
+
+def build_section_data(store, course_key, start_date, index, entries, max_count, since=None, previous_blocks=None, progress=None, metrics=None, static_blocks=None, report_format='classic', uploader=None, previous_archives=None, indexed=False):
+    """
+    Store the `report_data_{index}` file of a section, given its
+    `build_problem_list` entries. If `since` is given, only the blocks with
+    student state modified since then are stored, merged with their entry in
+    `previous_blocks` if there is one. Blocks without changes are taken as is
+    from `previous_blocks`. The static data of the blocks found in
+    `static_blocks` (see `get_block_static_data`) is not read again from the
+    modulestore. The file is written in `report_format`, or taken from
+    `previous_archives` if one of them has the same contents.
+
+    If `indexed` is set, the responses are also written to a
+    `ReportIndexFile`.
+
+    Returns the report file, which may still be being stored by `uploader`
+    if one is given, the index file (None if there is none), which is left
+    open, and a dict with the number of blocks and responses stored. The
+    index is stored by `finish_section_data`, unless the archive turns out
+    to be reused with its index.
+    """
+    if progress is None:
+        progress = ReportProgress(None)
+    if metrics is None:
+        metrics = ReportMetrics()
+    block_count = 0
+    response_count = 0
+
+    report_name = 'report_data_' + str(index)
+    index_file = None
+    if indexed:
+        index_file = open_report_index(index, course_key, start_date, metrics=metrics, uploader=uploader)
+    with open_report_file(report_name, course_key, start_date, metrics=metrics, report_format=report_format, uploader=uploader, previous_archives=previous_archives) as report_file:
+        for title, path, block_key in entries:
+            if block_key.block_type in STRUCTURAL_BLOCK_TYPES:
                 block_item = {
                     "path": path,
                     "block_type": block_key.block_type,
                     "block_id": str(block_key).split('@')[-1],
                     "is_structural_item": True
                 }
-                blocks_data.append(block_item)
+                report_file.append(block_item)
                 continue
             elif block_key.block_type == 'course':
                 continue
             else:
-                
-                # Store basic data from the block
-                block = store.get_item(block_key)
-                block_item = {
-                    "title": title,
-                    "path": path,
-                    "display_name": block.display_name,
-                    "block_type": block_key.block_type,
-                    "block_id": str(block_key).split('@')[-1],
-                    "is_structural_item": False
-                }
-
-                # Iterate over the dictionary and store key-value pairs after "source_file", depending of the block type
-                fields = block.fields
-                found_source_file = False
-                for key in fields.keys():
-                    if found_source_file:
-                        block_item[key] = block.fields[key].read_from(block)
-                    if key == "source_file":
-                        found_source_file = True
-
-                # Add students data
-                generated_report_data = defaultdict(list)
-                if hasattr(block, 'generate_report_data'):
-                    try:
-                        user_state_iterator = user_state_client.iter_all_for_block(block_key)
-                        for username, state in block.generate_report_data(user_state_iterator, max_count):
-                            generated_report_data[username].append(state)
-                    except NotImplementedError:
-                        pass
-                    except:
-                        logger.warning("Error generating report data for block %s using custom function.", block_key, exc_info=sys.exc_info())
-                responses = []
-                for response in list_problem_responses(course_key, block_key, max_count):
-                    user_states = generated_report_data.get(response['username'])
-                    if user_states:
-                        for user_state in user_states:
-                            user_response = response.copy()
-                            user_response.update(user_state)
-                            responses.append(user_response)
-                    else:
-                        responses.append(response)
-                    response_count += 1
-                block_item["responses"] = responses
-
-                # Append the block data to the list
-                blocks_data.append(block_item)
+                block_id = str(block_key).split('@')[-1]
+                # The rows of the block are streamed to the file as they are read
+                with metrics.phase('read_student_modules', block_key.block_type):
+                    block_student_modules = iter_student_modules(course_key, block_key, max_count, since)
+                    first_row = next(block_student_modules, None)
+                block_student_modules = chain([first_row], block_student_modules) if first_row is not None else []
+                previous_item = previous_blocks.pop(block_id, None) if previous_blocks is not None else None
+                if since is not None and not block_student_modules:
+                    # No activity since the previous report
+                    if previous_item is None:
+                        progress.add(blocks=1)
+                        continue
+                    block_item = previous_item
+                else:
+                    block_item = build_block_item(
+                        store, title, path, block_key, block_student_modules, max_count, metrics,
+                        static_data=static_blocks.get(str(block_key)) if static_blocks is not None else None
+                    )
+                    if previous_item is not None:
+                        block_item["responses"] = merge_responses(previous_item["responses"], list(block_item["responses"]))
+                responses = block_item["responses"]
+                if index_file is not None:
+                    responses = index_file.iter_block(block_id, path, block_key.block_type, responses)
+                responses = block_item["responses"] = CountingIterator(responses)
+                report_file.append(block_item)
                 block_count += 1
+                response_count += responses.count
+                progress.add(blocks=1, responses=responses.count)
+    section_report = {'blocks': block_count, 'responses': response_count}
+    return report_file, index_file, section_report
 
-        index = len(reports) + 1
-        reports.append(upload_json_to_report_store(blocks_data, 'report_data_' + str(index), course_key, start_date))
-        logger.info("Stored %d blocks with %d responses for section %s.", block_count, response_count, current_section)
 
-    return reports
+def finish_section_data(report_file, index_file, section_report, section_metrics, progress=None, metrics=None):
+    """
+    Wait until the report file of a section returned by `build_section_data`
+    is stored, store its index file, and return its manifest entry: the
+    description of the archive updated with `section_report`, the
+    description of the `index` and the `section_metrics`. The compression
+    and upload done in the background are added to `metrics` too.
+
+    The index is only stored if the archive is new or was reused without
+    one, which is only known once the archive is stored.
+    """
+    if progress is None:
+        progress = ReportProgress(None)
+    deferred_metrics = [report_file.wait()]
+    if index_file is not None:
+        previous = report_file.reused_archive
+        if previous is not None and previous.get('index'):
+            index_file.discard()
+            index_file = None
+            section_report = dict(section_report, index=previous['index'])
+        else:
+            index_file.close()
+            deferred_metrics.append(index_file.wait())
+    for stored_metrics in deferred_metrics:
+        if stored_metrics is not None and metrics is not None:
+            metrics.merge(stored_metrics)
+    report = report_file.describe()
+    report.update(section_report)
+    if index_file is not None:
+        report['index'] = index_file.describe()
+    report['metrics'] = section_metrics.as_dict()
+    progress.add(sections=1, bytes_uploaded=0 if report['reused'] else report['size'])
+    logger.info("Stored %d blocks with %d responses for section %s.", report['blocks'], report['responses'], report['title'])
+    return report
+
+
+def finish_pending_section(pending, progress, metrics, checkpoint):
+    """
+    Finish the first section of `pending`, a deque of `(index, report_file,
+    index_file, section_report, section_metrics)` tuples (see
+    `finish_section_data`), record it in `checkpoint` and return its manifest
+    entry.
+    """
+    index, report_file, index_file, section_report, section_metrics = pending.popleft()
+    report = finish_section_data(report_file, index_file, section_report, section_metrics, progress=progress, metrics=metrics)
+    checkpoint.add_section(index, report)
+    return report
+
+
+@contextmanager
+def open_report_uploader(uploader=None):
+    """
+    Yield `uploader` if given. Otherwise yield a new `ReportUploader`, that
+    stores every file submitted to it before the `with` block ends, or None
+    if `CMMEDU_SEGUIMIENTO_UPLOAD_THREADS` is 0.
+    """
+    if uploader is not None or not settings.CMMEDU_SEGUIMIENTO_UPLOAD_THREADS:
+        yield uploader
+        return
+    with ReportUploader.from_settings() as uploader:
+        yield uploader
+
+
+class ReportProgress(object):
+    """
+    Progress of a report task, or of one part of it (a subtask of a parallel
+    report), published in the cache so that `CMMEduSeguimientoGetReport` can
+    return it while the task runs.
+
+    Counters are published at most every `CMMEDU_SEGUIMIENTO_PROGRESS_INTERVAL`
+    seconds, and always when the stage changes, so that reporting progress
+    for every block stays cheap. If a `TaskProgress` is given, its task state
+    is updated with the same values. A progress without `entry_id` is not
+    published.
+    """
+    def __init__(self, entry_id, part=REPORT_PROGRESS_MAIN_PART, task_progress=None):
+        self.entry_id = entry_id
+        self.part = part
+        self.task_progress = task_progress
+        self.last_published = 0
+        self.state = {
+            'stage': None,
+            'section': None,
+            'sections_done': 0,
+            'blocks_done': 0,
+            'total_blocks': 0,
+            'responses': 0,
+            'bytes_uploaded': 0,
+        }
+
+    def set_stage(self, stage):
+        """
+        Set the current stage and publish the progress.
+        """
+        self.state['stage'] = stage
+        self.publish()
+
+    def update(self, **values):
+        """
+        Set some of the values of the progress.
+        """
+        self.state.update(values)
+        self.publish(force=False)
+
+    def add(self, sections=0, blocks=0, responses=0, bytes_uploaded=0):
+        """
+        Increment the counters of the progress.
+        """
+        self.state['sections_done'] += sections
+        self.state['blocks_done'] += blocks
+        self.state['responses'] += responses
+        self.state['bytes_uploaded'] += bytes_uploaded
+        self.publish(force=False)
+
+    def publish(self, force=True):
+        """
+        Store the progress in the cache, unless it was stored less than
+        `CMMEDU_SEGUIMIENTO_PROGRESS_INTERVAL` seconds ago and `force` is False.
+        """
+        if self.entry_id is None:
+            return
+        now = time()
+        if not force and now - self.last_published < settings.CMMEDU_SEGUIMIENTO_PROGRESS_INTERVAL:
+            return
+        self.last_published = now
+        self.state['updated'] = now
+        cache.set(get_progress_cache_key(self.entry_id, self.part), self.state, settings.CMMEDU_SEGUIMIENTO_PROGRESS_TIMEOUT)
+        if self.task_progress is not None:
+            current_step = {'step': 'Generating report data...'}
+            current_step.update(self.state)
+            self.task_progress.update_task_state(extra_meta=current_step)
+
+
+class ReportCheckpoint(object):
+    """
+    Parts of a report task already stored, saved next to its files after
+    every part so that a retry of the task (after its worker died or it hit
+    a time limit) resumes where it stopped instead of starting over. The
+    retry keeps the timestamp and plan of the first run, and skips the
+    student profile, ORA data and sections (`report_data_N`) recorded here
+    whose files still exist.
+
+    Storages cannot rename files, so the checkpoint is saved alternately in
+    two files, numbered by its `generation`: a save only replaces the older
+    file, and a task that dies while saving resumes from the newer one.
+
+    The checkpoint is removed once the manifest of the report is stored, or
+    once the task fails for good (see `ReportTask`). A checkpoint without
+    `entry_id` is not saved.
+    """
+    SLOTS = (0, 1)
+
+    def __init__(self, entry_id, course_id, config_name='GRADES_DOWNLOAD'):
+        self.entry_id = entry_id
+        self.course_id = course_id
+        self.report_store = JsonReportStore.from_config(config_name) if entry_id is not None else None
+        self.slot = self.SLOTS[-1]
+        self.state = self.read()
+        self.resumed = self.state is not None
+        if self.state is None:
+            self.state = {'generation': 0, 'start_date': None, 'plan': None, 'parts': {}, 'sections': {}}
+
+    def name_for(self, slot):
+        """
+        Name of the checkpoint file `slot` of the task.
+        """
+        return u"{}_checkpoint_{}_{}.json".format(course_filename_prefix_generator(self.course_id), self.entry_id, slot)
+
+    @property
+    def start_date(self):
+        return datetime.fromisoformat(self.state['start_date'])
+
+    @property
+    def plan(self):
+        return self.state['plan']
+
+    def read(self):
+        """
+        Return the newest saved state of the checkpoint, without the parts
+        whose files no longer exist, or None if there is none.
+        """
+        if self.report_store is None:
+            return None
+        state = None
+        for slot in self.SLOTS:
+            if not self.report_store.exists(self.course_id, self.name_for(slot)):
+                continue
+            try:
+                slot_state = self.report_store.read_manifest(self.course_id, self.name_for(slot))
+            except ValueError:
+                logger.warning("Ignoring the unreadable checkpoint %s.", self.name_for(slot))
+                continue
+            if state is None or slot_state['generation'] > state['generation']:
+                state, self.slot = slot_state, slot
+        if state is None:
+            return None
+        for key in ('parts', 'sections'):
+            state[key] = {
+                name: report for name, report in state[key].items()
+                if self.report_store.exists(self.course_id, report['name'])
+            }
+        return state
+
+    def save(self):
+        """
+        Save the current state of the checkpoint in place of the older one.
+        """
+        if self.report_store is None:
+            return
+        slot = self.SLOTS[(self.SLOTS.index(self.slot) + 1) % len(self.SLOTS)]
+        self.state['generation'] += 1
+        self.report_store.delete(self.course_id, self.name_for(slot))
+        self.report_store.store_manifest(self.course_id, self.name_for(slot), self.state)
+        self.slot = slot
+
+    def start(self, start_date, plan):
+        """
+        Save the timestamp and plan of a new report.
+        """
+        self.state.update({'start_date': start_date.isoformat(), 'plan': plan})
+        self.save()
+
+    def get_part(self, part):
+        """
+        Return the description of the stored file of `part`, or None.
+        """
+        return self.state['parts'].get(part)
+
+    def add_part(self, part, report):
+        """
+        Record that the file of `part` has been stored.
+        """
+        self.state['parts'][part] = report
+        self.save()
+
+    def get_section(self, index, structure):
+        """
+        Return the manifest entry of the section `index`, or None if it has
+        not been stored or its structure has changed since.
+        """
+        report = self.state['sections'].get(str(index))
+        if report is None or report['structure'] != structure:
+            return None
+        return report
+
+    def add_section(self, index, report):
+        """
+        Record that the section `index` has been stored.
+        """
+        self.state['sections'][str(index)] = report
+        self.save()
+
+    def remove(self):
+        """
+        Delete the saved states of the checkpoint.
+        """
+        if self.report_store is not None:
+            for slot in self.SLOTS:
+                self.report_store.delete(self.course_id, self.name_for(slot))
+
+
+def get_progress_cache_key(entry_id, part=None):
+    """
+    Return the cache key of the progress of a part of a report task, or of
+    the list of its parts.
+    """
+    if part is None:
+        return 'cmmedu_seguimiento.progress.{}'.format(entry_id)
+    return 'cmmedu_seguimiento.progress.{}.{}'.format(entry_id, part)
+
+
+def get_batch_cache_key(batch_id):
+    """
+    Return the cache key of a batch of reports.
+    """
+    return 'cmmedu_seguimiento.batch.{}'.format(batch_id)
+
+
+def get_batch_student_cache_key(batch_id, user_id):
+    """
+    Return the cache key of a user read by a report of a batch.
+    """
+    return 'cmmedu_seguimiento.batch.{}.student.{}'.format(batch_id, user_id)
+
+
+def get_work_plan_cache_key(course_key, features):
+    """
+    Return the cache key of the work plan of a report of the course with the
+    given features (see `task_plan_report`).
+    """
+    return 'cmmedu_seguimiento.work_plan.{}.{}.{}.{}.{}'.format(
+        course_key, features['user_id'], features['mode'], int(bool(features['compact'])), features['format']
+    )
+
+
+def get_report_batch(batch_id):
+    """
+    Return a batch of reports saved by `save_report_batch`, or None if it
+    does not exist or has expired.
+    """
+    return cache.get(get_batch_cache_key(batch_id))
+
+
+def save_report_batch(batch):
+    """
+    Save a batch of reports for `CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT` seconds.
+    """
+    cache.set(get_batch_cache_key(batch['id']), batch, settings.CMMEDU_SEGUIMIENTO_BATCH_TIMEOUT)
+
+
+def get_batch_profile_fields(task_input):
+    """
+    Return the student profile fields shared by the batch of a report task,
+    or None if the task is not part of a batch (or it has expired).
+    """
+    batch = get_report_batch(task_input['batch_id']) if task_input.get('batch_id') else None
+    return batch['profile_fields'] if batch is not None else None
+
+
+def get_org_course_keys(org):
+    """
+    Return the keys of the courses of an organization.
+    """
+    return list(CourseOverview.objects.filter(org=org).order_by('id').values_list('id', flat=True))
+
+
+def get_course_activity(since):
+    """
+    Return the time of the latest student state, enrollment or ORA activity
+    since `since` of every course with any, by course key.
+    """
+    activity = {}
+    database = get_report_database()
+    querysets = [
+        StudentModule.objects.using(database).filter(modified__gte=since).values_list('course_id').annotate(Max('modified')),
+        CourseEnrollment.history.using(database).filter(
+            history_date__gte=since
+        ).values_list('course_id').annotate(Max('history_date')),
+        Submission.objects.using(database).filter(
+            submitted_at__gte=since,
+            student_item__item_type='openassessment'
+        ).values_list('student_item__course_id').annotate(Max('submitted_at')),
+        Score.objects.using(database).filter(
+            created_at__gte=since,
+            student_item__item_type='openassessment'
+        ).values_list('student_item__course_id').annotate(Max('created_at')),
+    ]
+    for queryset in querysets:
+        for course_key, last_activity in queryset.order_by():
+            if isinstance(course_key, str):
+                try:
+                    course_key = CourseKey.from_string(course_key)
+                except InvalidKeyError:
+                    continue
+            if course_key not in activity or last_activity > activity[course_key]:
+                activity[course_key] = last_activity
+    return activity
+
+
+def get_stale_course_keys(since):
+    """
+    Return the keys of the courses with activity since `since` that is later
+    than their last successful report, largest first (by active enrollments)
+    so that the longest reports start first.
+    """
+    activity = get_course_activity(since)
+    last_reports = dict(
+        InstructorTask.objects.filter(
+            task_type=REPORT_TASK_TYPE,
+            task_state=SUCCESS,
+            course_id__in=list(activity)
+        ).values_list('course_id').annotate(Max('created')).order_by()
+    )
+    course_keys = [
+        course_key for course_key, last_activity in activity.items()
+        if course_key not in last_reports or last_activity > last_reports[course_key]
+    ]
+    enrollments = dict(
+        CourseEnrollment.objects.using(get_report_database()).filter(
+            course_id__in=course_keys,
+            is_active=True
+        ).values_list('course_id').annotate(Count('id')).order_by()
+    )
+    return sorted(course_keys, key=lambda course_key: (-enrollments.get(course_key, 0), str(course_key)))
+
+
+def start_report_progress(entry_id, parts, start_time, total_blocks=None):
+    """
+    Register the parts whose `ReportProgress` make up the progress of a report
+    task, the time the task started and, if known, its number of blocks.
+    """
+    cache.set(
+        get_progress_cache_key(entry_id),
+        {'parts': parts, 'start_time': start_time, 'total_blocks': total_blocks},
+        settings.CMMEDU_SEGUIMIENTO_PROGRESS_TIMEOUT
+    )
+
+
+def get_report_progress(entry_id):
+    """
+    Return the progress of a running report task, adding up its parts, with
+    an estimate of the seconds left computed from the blocks done so far.
+    Returns None if the task has not published any progress.
+    """
+    index = cache.get(get_progress_cache_key(entry_id))
+    if index is None:
+        return None
+    parts = cache.get_many([get_progress_cache_key(entry_id, part) for part in index['parts']])
+    progress = {
+        'stages': sorted(set(part['stage'] for part in parts.values() if part['stage'] not in (None, 'done'))),
+        'sections': [part['section'] for part in parts.values() if part['section'] and part['stage'] != 'done'],
+        'parts_done': sum(1 for part in parts.values() if part['stage'] == 'done'),
+        'parts': len(index['parts']),
+    }
+    for counter in ('sections_done', 'blocks_done', 'responses', 'bytes_uploaded'):
+        progress[counter] = sum(part[counter] for part in parts.values())
+    progress['total_blocks'] = index['total_blocks'] or sum(part['total_blocks'] for part in parts.values())
+    elapsed = time() - index['start_time']
+    progress['elapsed_seconds'] = elapsed
+    if progress['blocks_done'] and progress['total_blocks']:
+        progress['eta_seconds'] = elapsed * (progress['total_blocks'] - progress['blocks_done']) / progress['blocks_done']
+    else:
+        progress['eta_seconds'] = None
+    return progress
+
+
+def build_section_list(course_blocks, root):
+    """
+    Group the output of ``build_problem_list`` by section, where a section
+    starts every time the second element of the block path (the chapter)
+    changes. Blocks with a path shorter than two elements are skipped.
+    Yields:
+        Tuple[str, List[Tuple[str, List[str], UsageKey]]]: the section name and
+            the list of ``build_problem_list`` tuples that belong to it
+    """
+    current_section = None
+    entries = []
+    for title, path, block_key in build_problem_list(course_blocks, root):
+        if len(path) < 2:
+            continue
+        if path[1] != current_section:
+            if entries:
+                yield current_section, entries
+            current_section = path[1]
+            entries = []
+        entries.append((title, path, block_key))
+    if entries:
+        yield current_section, entries
+
 
+def build_block_item(store, title, path, block_key, student_modules, max_count, metrics=None, static_data=None):
+    """
+    Build the report entry of a non structural block: its basic data, the
+    fields that depend on the block type and the students responses, taken
+    from the ``student_modules`` rows of the block (see
+    ``iter_student_modules``), or an empty list if it has none.
+
+    If the ``get_block_static_data`` of the block is given as ``static_data``,
+    the block is only loaded from the modulestore when it has responses to
+    generate report data from.
 
-def upload_json_to_report_store(data, json_name, course_id, timestamp, config_name='GRADES_DOWNLOAD'):
+    The ``responses`` of the entry are an iterator (see
+    ``iter_block_responses``), meant to be streamed to a report file.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    block_type = block_key.block_type
+
+    block = None
+    if static_data is None:
+        with metrics.phase('get_item', block_type):
+            block = store.get_item(block_key)
+        with metrics.phase('block_fields', block_type):
+            static_data = get_block_static_data(block)
+    elif static_data['report_data'] and student_modules:
+        with metrics.phase('get_item', block_type):
+            block = store.get_item(block_key)
+
+    # Store basic data from the block
+    block_item = {
+        "title": title,
+        "path": path,
+        "display_name": static_data['display_name'],
+        "block_type": block_key.block_type,
+        "block_id": str(block_key).split('@')[-1],
+        "is_structural_item": False
+    }
+    block_item.update(static_data['fields'])
+
+    # Add students data, merged as they are written
+    block_item["responses"] = iter_block_responses(block, block_key, student_modules, max_count, metrics)
+    return block_item
+
+
+def get_block_static_data(block):
+    """
+    Return the data of a block that only changes when the course is
+    published: its display name, the fields after "source_file" (those that
+    depend on the block type) and whether it can generate report data from
+    the student state.
+    """
+    fields = OrderedDict()
+    found_source_file = False
+    for key in block.fields.keys():
+        if found_source_file:
+            fields[key] = block.fields[key].read_from(block)
+        if key == "source_file":
+            found_source_file = True
+    return {
+        'display_name': block.display_name,
+        'fields': fields,
+        'report_data': hasattr(block, 'generate_report_data'),
+    }
+
+
+def get_course_content_version(store, course_key):
+    """
+    Return a string that changes every time the course is published: the
+    version of the published course structure, or the date of its last
+    edition in modulestores without versions.
+    """
+    course = store.get_course(course_key, depth=0)
+    version = getattr(course, 'course_version', None) or course.subtree_edited_on
+    return str(version)
+
+
+def load_content_snapshot(user_id, course_key, usage_key_str, config_name='GRADES_DOWNLOAD', metrics=None):
+    """
+    Return the content snapshot of the course: its sections as returned by
+    `build_section_list` and the `get_block_static_data` of every non
+    structural block, keyed by block usage key.
+
+    The snapshot is stored next to the reports, named after the version of
+    the course content and the user, so it is built once per publish and
+    read back by every report of the user (and every subtask of a parallel
+    report) until the course is published again. The user is part of the
+    name since `get_course_blocks` only returns the blocks that the user can
+    access.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    report_store = JsonReportStore.from_config(config_name)
+    store = modulestore()
+    with metrics.phase('content_snapshot'):
+        version = get_course_content_version(store, course_key)
+        snapshot_name = u"{course_prefix}_content_snapshot_{user_id}_{version}.{extension}".format(
+            course_prefix=course_filename_prefix_generator(course_key),
+            user_id=user_id,
+            version=hashlib.sha1(version.encode('utf-8')).hexdigest(),
+            extension=report_store.archive_extension
+        )
+        if report_store.storage.exists(report_store.path_to(course_key, snapshot_name)):
+            return report_store.read_json(course_key, snapshot_name)
+
+        usage_key = UsageKey.from_string(usage_key_str).map_into_course(course_key)
+        user = get_user_model().objects.get(pk=user_id)
+        with store.bulk_operations(course_key):
+            with metrics.phase('get_course_blocks'):
+                course_blocks = get_course_blocks(user, usage_key)
+                sections = list(build_section_list(course_blocks, usage_key))
+            blocks = {}
+            for _, entries in sections:
+                for _, _, block_key in entries:
+                    if block_key.block_type in STRUCTURAL_BLOCK_TYPES or block_key.block_type == 'course':
+                        continue
+                    with metrics.phase('get_item', block_key.block_type):
+                        block = store.get_item(block_key)
+                    with metrics.phase('block_fields', block_key.block_type):
+                        blocks[str(block_key)] = get_block_static_data(block)
+        snapshot = {
+            'version': version,
+            'sections': [
+                [section, [[title, path, str(block_key)] for title, path, block_key in entries]]
+                for section, entries in sections
+            ],
+            'blocks': blocks,
+        }
+        # Round trip through JSON, so the snapshot is the same whether it was
+        # just built or read back from the report store
+        snapshot = json.loads(json.dumps(snapshot, cls=JsonReportEncoder))
+        report_store.store_json(course_key, snapshot_name, snapshot)
+        logger.info("Stored content snapshot of course %s for version %s.", course_key, version)
+    return snapshot
+
+
+def get_snapshot_sections(snapshot):
+    """
+    Return the sections of a content snapshot as `build_section_list` yields
+    them.
+    """
+    return [
+        (section, [(title, path, UsageKey.from_string(block_key)) for title, path, block_key in entries])
+        for section, entries in snapshot['sections']
+    ]
+
+
+def upload_json_to_report_store(data, json_name, course_id, timestamp, config_name='GRADES_DOWNLOAD', metrics=None, report_format='classic'):
     """
     Upload data as a JSON using ReportStore.
 
@@ -195,17 +1996,161 @@ def upload_json_to_report_store(data, json_name, course_id, timestamp, config_na
         data: JSON data
         json_name: Name of the resulting JSON
         course_id: ID of the course
+        report_format: `classic` or `jsonl` (lists only)
+
+    Returns a dict with the `name`, number of `items`, `size` and `checksum`
+    of the stored file.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    report_name = get_report_name(json_name, course_id, timestamp, report_store.archive_extension)
+    report = report_store.store_json(course_id, report_name, data, metrics, report_format)
+    tracker_emit(json_name)
+    return report
+
+
+@contextmanager
+def open_report_file(json_name, course_id, timestamp, config_name='GRADES_DOWNLOAD', metrics=None, report_format='classic', uploader=None, previous_archives=None):
+    """
+    Open a `JsonReportFile` in the ReportStore that can be appended to while
+    the data is being generated. The file is stored when the `with` block
+    ends, or discarded if it raises.
+
+    Arguments:
+        json_name: Name of the resulting JSON
+        course_id: ID of the course
+        report_format: `classic` or `jsonl`
+        uploader: `ReportUploader` that stores the file in the background
+        previous_archives: archives that are reused if they have the same
+            contents, by content hash
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    report_name = get_report_name(json_name, course_id, timestamp, report_store.archive_extension)
+    with report_store.open_json(course_id, report_name, metrics, report_format, uploader, previous_archives) as report_file:
+        yield report_file
+    tracker_emit(json_name)
+
+
+def open_report_index(index, course_id, timestamp, config_name='GRADES_DOWNLOAD', metrics=None, uploader=None):
+    """
+    Return a `ReportIndexFile` for the section `index` of a report, in
+    chunks of `CMMEDU_SEGUIMIENTO_INDEX_CHUNK_SIZE` responses.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    return ReportIndexFile(
+        report_store,
+        course_id,
+        get_report_name('report_chunks_' + str(index), course_id, timestamp, 'jsonl.gz'),
+        get_report_name('report_index_' + str(index), course_id, timestamp, 'json'),
+        settings.CMMEDU_SEGUIMIENTO_INDEX_CHUNK_SIZE,
+        metrics,
+        uploader
+    )
+
+
+def query_report(course_id, manifest, username=None, block_id=None, config_name='GRADES_DOWNLOAD'):
+    """
+    Return the blocks of a report, given its manifest, with only their
+    responses of the student `username`, or only the block `block_id` with
+    all its responses. Only the indexes of the sections (see
+    `ReportIndexFile`) and the chunks of the responses returned are read.
+
+    Every block is returned as a dict with its `block_id`, `path`,
+    `block_type` and `responses`.
     """
     report_store = JsonReportStore.from_config(config_name)
-    report_name = u"{course_prefix}_{json_name}_{timestamp_str}.tar.gz".format(
+    blocks = []
+    for section in manifest['sections']:
+        if not section.get('index'):
+            continue
+        index = report_store.read_manifest(course_id, section['index']['index'])
+        if block_id is not None:
+            if block_id not in index['blocks']:
+                continue
+            chunk_numbers = index['blocks'][block_id]['chunks']
+        else:
+            chunk_numbers = index['users'].get(username, [])
+        section_blocks = OrderedDict(
+            (found_id, dict(block_id=found_id, path=block['path'], block_type=block['block_type'], responses=[]))
+            for found_id, block in index['blocks'].items()
+            if found_id == block_id or (block_id is None and set(block['chunks']) & set(chunk_numbers))
+        )
+        chunk_ranges = [index['chunks'][number] for number in chunk_numbers]
+        for chunk in report_store.read_chunks(course_id, section['index']['chunks'], chunk_ranges):
+            section_blocks[chunk['block_id']]['responses'] += [
+                response for response in chunk['responses']
+                if username is None or response['username'] == username
+            ]
+        blocks += section_blocks.values()
+    return blocks
+
+
+def query_latest_report(course_id, username=None, block_id=None, config_name='GRADES_DOWNLOAD'):
+    """
+    Return the last successful report task of `course_id` and the result of
+    `query_report` on it, or `(None, None)` if there is none. The result of
+    a delta includes the responses of the reports of its chain, replaced by
+    the newer ones as `merge_responses` does. The result is None if the
+    report was not indexed.
+    """
+    task, manifest_name = get_previous_report(course_id)
+    if manifest_name is None:
+        return None, None
+    report_store = JsonReportStore.from_config(config_name)
+    manifest = report_store.read_manifest(course_id, manifest_name)
+    manifests = [report_store.read_manifest(course_id, name) for name in manifest['chain']] if manifest['mode'] == 'incremental' else []
+    if not any(section.get('index') for report_manifest in manifests + [manifest] for section in report_manifest['sections']):
+        return task, None
+    blocks = OrderedDict()
+    for report_manifest in manifests + [manifest]:
+        for block in query_report(course_id, report_manifest, username, block_id, config_name):
+            if block['block_id'] in blocks:
+                block['responses'] = merge_responses(blocks[block['block_id']]['responses'], block['responses'])
+            blocks[block['block_id']] = block
+    return task, list(blocks.values())
+
+
+def get_report_name(json_name, course_id, timestamp, extension='tar.gz'):
+    """
+    Return the name of a file of a report, by default a `.tar.gz` archive
+    (see `DjangoStorageJsonReportStore.archive_extension`).
+    """
+    return u"{course_prefix}_{json_name}_{timestamp_str}.{extension}".format(
         course_prefix=course_filename_prefix_generator(course_id),
         json_name=json_name,
-        timestamp_str=timestamp.strftime("%Y-%m-%d-%H%M")
+        timestamp_str=timestamp.strftime("%Y-%m-%d-%H%M"),
+        extension=extension
     )
 
-    report_store.store_json(course_id, report_name, data)
-    tracker_emit(json_name)
-    return report_name
+
+def upload_cprofile_stats(profiler, course_id, timestamp, config_name='GRADES_DOWNLOAD'):
+    """
+    Store the stats of a `cProfile.Profile`, readable with `pstats`.
+    Returns the name of the stored file.
+    """
+    report_store = JsonReportStore.from_config(config_name)
+    with tempfile.NamedTemporaryFile(suffix='.prof') as stats_file:
+        profiler.dump_stats(stats_file.name)
+        return report_store.store_raw(course_id, get_report_name('cprofile', course_id, timestamp, 'prof'), stats_file)
+
+
+@contextmanager
+def measure_report_part(metrics, name):
+    """
+    Track the metrics of a part of a report (a stage or a section) apart,
+    recording it as a call of the phase `name` of `metrics` and adding its
+    phases to `metrics` when it ends. Yields the `ReportMetrics` of the part.
+    """
+    part_metrics = ReportMetrics()
+    with metrics.phase(name), part_metrics.track():
+        yield part_metrics
+    metrics.merge(part_metrics)
+
+
+def log_report_metrics(course_id, metrics):
+    """
+    Log the metrics of a report as a single JSON line.
+    """
+    logger.info("Report metrics for course %s: %s", course_id, json.dumps(metrics.as_dict(), sort_keys=True))
 
 
 def tracker_emit(report_name):
@@ -240,6 +2185,132 @@ def build_problem_list(course_blocks, root, path=None):
             yield result
 
 
+def iter_student_modules(course_key, block_key, limit_responses=None, modified_since=None):
+    """
+    Yield the ``StudentModule`` rows of a block, with the student usernames
+    joined in, ordered by student and truncated to ``limit_responses`` rows
+    if given. If ``modified_since`` is given, only the rows modified since
+    then are read.
+
+    The rows are streamed from the report database (see
+    ``get_report_database``) in chunks of
+    ``CMMEDU_SEGUIMIENTO_PREFETCH_CHUNK_SIZE``: a block costs one query, and
+    only a chunk of its rows is held in memory at a time.
+    """
+    smdat = StudentModule.objects.using(get_report_database()).filter(
+        course_id=course_key,
+        module_state_key=block_key
+    )
+    if modified_since is not None:
+        smdat = smdat.filter(modified__gte=modified_since)
+    smdat = smdat.select_related('student').order_by('student')
+    if limit_responses is not None:
+        smdat = smdat[:limit_responses]
+    return smdat.iterator(chunk_size=settings.CMMEDU_SEGUIMIENTO_PREFETCH_CHUNK_SIZE)
+
+
+class UserStateIterator(object):
+    """
+    Iterator over ``XBlockUserState`` tuples for the ``student_modules`` rows
+    of a block (a list or an iterator), the same way
+    ``DjangoXBlockUserStateClient.iter_all_for_block`` does, but from rows
+    already read for the report instead of a query of its own. Rows without
+    state (an empty or null ``state``) are skipped.
+
+    ``position`` is the index of the last row read.
+    """
+    def __init__(self, block_key, student_modules):
+        self.block_key = block_key
+        self.position = -1
+        self._rows = enumerate(student_modules)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for self.position, response in self._rows:
+            state = json.loads(response.state) if response.state else {}
+            if state != {}:
+                return XBlockUserState(response.student.username, self.block_key, state, response.modified, Scope.user_state)
+        raise StopIteration
+
+
+def iter_block_responses(block, block_key, student_modules, max_count=None, metrics=None):
+    """
+    Yield the response of every student to a block, from its
+    ``student_modules`` rows (a list or an iterator, see
+    ``iter_student_modules``), merged with the output of the
+    ``generate_report_data`` of the block if it has one: a student with
+    several generated states gets one response per state.
+
+    ``generate_report_data`` is given the user states of those same rows
+    (see ``UserStateIterator``), not those of
+    ``DjangoXBlockUserStateClient.iter_all_for_block``, so the state of the
+    block is read once. Both come from the same rows in the same order, so
+    they are merged in a single pass: the generated states are read up to
+    those of the current row, and only the rows and states read ahead (those
+    of the next student) are kept in memory.
+    """
+    if metrics is None:
+        metrics = ReportMetrics()
+    if max_count is not None:
+        student_modules = islice(student_modules, max_count)
+    generated = None
+    if block is not None and hasattr(block, 'generate_report_data'):
+        student_modules, state_rows = tee(student_modules)
+        user_states = UserStateIterator(block_key, state_rows)
+        generated = block.generate_report_data(user_states, max_count)
+    generation_time = 0.0
+    pending = defaultdict(list)
+    for index, row in enumerate(student_modules):
+        response = {'username': row.student.username, 'timestamp': row.created, 'state': get_response_state(row)}
+        start = time()
+        while generated is not None and user_states.position <= index:
+            try:
+                username, state = next(generated)
+            except StopIteration:
+                generated = None
+            except NotImplementedError:
+                generated = None
+            except Exception:
+                logger.warning("Error generating report data for block %s using custom function.", block_key, exc_info=sys.exc_info())
+                generated = None
+            else:
+                pending[username].append(state)
+        generation_time += time() - start
+
+        states = pending.pop(response['username'], None)
+        if not states:
+            yield response
+        elif len(states) == 1:
+            response.update(states[0])
+            yield response
+        else:
+            for state in states:
+                user_response = response.copy()
+                user_response.update(state)
+                yield user_response
+    if block is not None and hasattr(block, 'generate_report_data'):
+        metrics.add_phase_time('generate_report_data', generation_time, block_key.block_type)
+
+
+class CountingIterator(object):
+    """
+    Iterator over ``items`` that counts the items it returned in ``count``.
+    """
+    def __init__(self, items):
+        self.count = 0
+        self._items = iter(items)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._items)
+        self.count += 1
+        return item
+
+
 def list_problem_responses(course_key, problem_location, limit_responses=None):
     """
     Return responses to a given problem as a dict.
@@ -253,7 +2324,8 @@ def list_problem_responses(course_key, problem_location, limit_responses=None):
     ]
 
     where `state` represents a student's response to the problem
-    identified by `problem_location`.
+    identified by `problem_location`. The rows are streamed from the report
+    database (see `get_report_database`).
     """
     if isinstance(problem_location, UsageKey):
         problem_key = problem_location
@@ -265,15 +2337,16 @@ def list_problem_responses(course_key, problem_location, limit_responses=None):
     if problem_key.course_key != course_key:
         return []
 
-    smdat = StudentModule.objects.filter(
+    smdat = StudentModule.objects.using(get_report_database()).filter(
         course_id=course_key,
         module_state_key=problem_key
-    )
+    ).select_related('student')
     smdat = smdat.order_by('student')
     if limit_responses is not None:
         smdat = smdat[:limit_responses]
+    smdat = smdat.iterator(chunk_size=settings.CMMEDU_SEGUIMIENTO_PREFETCH_CHUNK_SIZE)
 
     return [
         {'username': response.student.username, 'timestamp': response.created, 'state': get_response_state(response)}
         for response in smdat
-    ]
+    ]
\ No newline at end of file
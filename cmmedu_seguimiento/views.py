@@ -1,13 +1,12 @@
+from django.conf import settings
 from django.db import transaction
 from django.http import HttpResponseBadRequest, JsonResponse
-from django.http.response import Http404
 from edx_rest_framework_extensions import permissions
 from edx_rest_framework_extensions.auth.jwt.authentication import JwtAuthentication
 from edx_rest_framework_extensions.auth.session.authentication import SessionAuthenticationAllowInactiveUser
 import json
-from lms.djangoapps.courseware.courses import get_course_by_id
 from lms.djangoapps.instructor_task.api_helper import AlreadyRunningError
-from lms.djangoapps.instructor_task.models import InstructorTask
+from lms.djangoapps.instructor_task.models import InstructorTask, QUEUING
 import logging
 from opaque_keys import InvalidKeyError
 from opaque_keys.edx.keys import CourseKey
@@ -15,7 +14,16 @@ from openedx.core.lib.api.authentication import BearerAuthenticationAllowInactiv
 from rest_framework.views import APIView
 
 from .models import JsonReportStore
-from .tasks import submit_task_make_report
+from .tasks import REPORT_TASK_TYPE, request_report_work_plan, submit_batch_make_report, submit_task_make_report
+from .utils import (
+    course_exists,
+    get_org_course_keys,
+    get_report_batch,
+    get_report_progress,
+    query_latest_report,
+    REPORT_FORMATS,
+    REPORT_MODES,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -46,15 +54,20 @@ class CMMEduSeguimientoMakeReport(APIView):
         if not course_key:
             return HttpResponseBadRequest("Missing course_key")
         try:
-            _ = CourseKey.from_string(course_key)
-            __ = get_course_by_id(_)
+            key = CourseKey.from_string(course_key)
         except InvalidKeyError:
             return HttpResponseBadRequest("Invalid course_key")
-        except Http404:
+        if not course_exists(key):
             return HttpResponseBadRequest("Invalid course_key")
-        task_input = {
-            'user_id': request.user.pk
-        }
+        task_input, error = get_report_task_input(request, data)
+        if error:
+            return HttpResponseBadRequest(error)
+        if data.get('dry_run'):
+            # Only the work plan the report would follow, computed by a task
+            work_plan = request_report_work_plan(key, task_input)
+            if work_plan is None:
+                return JsonResponse({"status": 0, "msg": 'El plan del reporte aún no está listo.'})
+            return JsonResponse({"status": 1, "msg": 'Plan del reporte.', 'mode': work_plan['mode'], 'plan': work_plan['plan']})
         try:
             task = submit_task_make_report(request, course_key, task_input)
             return JsonResponse({"status": 1, "msg": 'Se ha iniciado la generación del reporte.', 'task_id': task.task_id})
@@ -62,6 +75,99 @@ class CMMEduSeguimientoMakeReport(APIView):
             return JsonResponse({"status": 0, "msg": "Esta tarea ya está en progreso."})
 
 
+class CMMEduSeguimientoMakeBatchReport(APIView):
+
+    authentication_classes = (
+        JwtAuthentication,
+        BearerAuthenticationAllowInactiveUser,
+        SessionAuthenticationAllowInactiveUser,
+    )
+
+    permission_classes = (permissions.JWT_RESTRICTED_APPLICATION_OR_USER_ACCESS,)
+
+
+    @transaction.non_atomic_requests
+    def dispatch(self, args, **kwargs):
+        return super(CMMEduSeguimientoMakeBatchReport, self).dispatch(args, **kwargs)
+
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+        if data.get('course_keys'):
+            if not isinstance(data['course_keys'], list):
+                return HttpResponseBadRequest("Invalid course_keys")
+            keys = []
+            for course_key in data['course_keys']:
+                try:
+                    key = CourseKey.from_string(course_key)
+                except (InvalidKeyError, TypeError):
+                    return HttpResponseBadRequest("Invalid course_key: {}".format(course_key))
+                if not course_exists(key):
+                    return HttpResponseBadRequest("Invalid course_key: {}".format(course_key))
+                if key not in keys:
+                    keys.append(key)
+        elif data.get('org'):
+            keys = get_org_course_keys(data['org'])
+            if not keys:
+                return HttpResponseBadRequest("Invalid org")
+        else:
+            return HttpResponseBadRequest("Missing course_keys or org")
+        concurrency = data.get('concurrency')
+        if concurrency is not None and (not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1):
+            return HttpResponseBadRequest("Invalid concurrency")
+        task_input, error = get_report_task_input(request, data)
+        if error:
+            return HttpResponseBadRequest(error)
+        batch = submit_batch_make_report(request, keys, task_input, concurrency)
+        return JsonResponse({
+            "status": 1,
+            "msg": 'Se ha iniciado la generación de los reportes.',
+            'batch_id': batch['id'],
+            'courses': get_batch_courses_output(batch),
+        })
+
+
+class CMMEduSeguimientoGetBatchReport(APIView):
+
+    authentication_classes = (
+        JwtAuthentication,
+        BearerAuthenticationAllowInactiveUser,
+        SessionAuthenticationAllowInactiveUser,
+    )
+
+    permission_classes = (permissions.JWT_RESTRICTED_APPLICATION_OR_USER_ACCESS,)
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+        batch_id = data.get('batch_id')
+        if not batch_id:
+            return HttpResponseBadRequest("Missing batch_id")
+        batch = get_report_batch(batch_id)
+        if batch is None:
+            return JsonResponse({"status": 0, "msg": "No existe el lote de reportes o ha expirado."})
+        courses = get_batch_courses_output(batch)
+        states = {}
+        for course in courses:
+            states[course['task_state']] = states.get(course['task_state'], 0) + 1
+        finished = all(course['task_state'] in ('SUCCESS', 'FAILURE', 'ERROR') for course in courses)
+        return JsonResponse({
+            "status": 1 if finished else 0,
+            "msg": "Los reportes del lote están listos." if finished else "Los reportes del lote aún no están listos.",
+            "batch_id": batch['id'],
+            "created": batch['created'],
+            "concurrency": batch['concurrency'],
+            "total": len(courses),
+            "states": states,
+            "courses": courses,
+        })
+
+
 class CMMEduSeguimientoGetReport(APIView):
 
     authentication_classes = (
@@ -82,46 +188,200 @@ class CMMEduSeguimientoGetReport(APIView):
             return HttpResponseBadRequest("Missing course_key")
         try:
             key = CourseKey.from_string(course_key)
-            _ = get_course_by_id(key)
         except InvalidKeyError:
             return HttpResponseBadRequest("Invalid course_key")
-        except Http404:
+        if not course_exists(key):
             return HttpResponseBadRequest("Invalid course_key")
-        course_tasks = InstructorTask.objects.filter(
-            task_type='cmmedu_seguimiento_report',
+        latest_task = InstructorTask.objects.filter(
+            task_type=REPORT_TASK_TYPE,
             course_id=course_key
-        ).order_by('-created').all()
-        if not course_tasks:
+        ).order_by('-created').first()
+        if latest_task is None:
             return JsonResponse({"status": 0, "msg": "No hay tareas de reportes asociadas a este curso."})
-        latest_task = course_tasks[0]
         if latest_task.task_state == 'PROGRESS':
-            return JsonResponse({"status": 0, "msg": "La tarea de reportes aún no está lista."})
+            response = {"status": 0, "msg": "La tarea de reportes aún no está lista."}
+            progress = get_report_progress(latest_task.id)
+            if progress is not None:
+                response["progress"] = progress
+            return JsonResponse(response)
         elif latest_task.task_state == 'FAILURE':
             return JsonResponse({"status": 0, "msg": "La tarea de reportes ha fallado.", "task_error": latest_task.task_output})
         elif latest_task.task_state == 'SUCCESS':
             task_output = json.loads(latest_task.task_output)
             logger.info("Task output: %s", task_output)
+            report_store = JsonReportStore.from_config(config_name='GRADES_DOWNLOAD')
             try:
-                report_names = [task_output['course_key'] + "_" + "report_data_" + str(i+1) + "_" + task_output["timestamp"] + ".tar.gz" for i in range(task_output['n_reports'])]
-                student_profile_report_name = task_output['course_key'] + "_student_profile_" + task_output["timestamp"] + ".tar.gz"
-                ora_report_name = task_output['course_key'] + "_ora_data_" + task_output["timestamp"] + ".tar.gz"
+                if task_output.get('manifest'):
+                    output = get_report_output(report_store, key, task_output['manifest'])
+                else:
+                    output = get_legacy_report_output(report_store, key, task_output)
             except:
+                logger.warning("Invalid report for course %s.", course_key, exc_info=True)
                 return JsonResponse({"status": 0, "msg": "Formato de output de tarea inválido."})
-            report_store = JsonReportStore.from_config(config_name='GRADES_DOWNLOAD')
-            desired_filenames = [student_profile_report_name, ora_report_name] + report_names
-            name_to_url = dict(report_store.links_for_names(key, desired_filenames))
-            output = {
-                'student_profile': name_to_url.get(student_profile_report_name),
-                'ora_data': name_to_url.get(ora_report_name),
-                'blocks_data': {
-                    name.split("report_data_")[1].split("_")[0]: name_to_url[name]
-                    for name in report_names if name in name_to_url
-                },
+            output.update({
                 'task_id': latest_task.task_id,
                 'task_started': latest_task.created.isoformat(),
                 'task_finished': latest_task.updated.isoformat(),
                 'task_duration_seconds': (latest_task.updated - latest_task.created).total_seconds()
-            }
+            })
             return JsonResponse({"status": 1, "msg": "Reporte encontrado.", "course_key": course_key, "output": output})
         else:
             return JsonResponse({"status": 0, "msg": "Estado de la tarea desconocido.", "task_state": latest_task.task_state})
+
+
+class CMMEduSeguimientoQueryReport(APIView):
+
+    authentication_classes = (
+        JwtAuthentication,
+        BearerAuthenticationAllowInactiveUser,
+        SessionAuthenticationAllowInactiveUser,
+    )
+
+    permission_classes = (permissions.JWT_RESTRICTED_APPLICATION_OR_USER_ACCESS,)
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return HttpResponseBadRequest("Invalid JSON")
+        course_key = data.get('course_key')
+        if not course_key:
+            return HttpResponseBadRequest("Missing course_key")
+        try:
+            key = CourseKey.from_string(course_key)
+        except InvalidKeyError:
+            return HttpResponseBadRequest("Invalid course_key")
+        if not course_exists(key):
+            return HttpResponseBadRequest("Invalid course_key")
+        username = data.get('username')
+        block_id = data.get('block_id')
+        if not username and not block_id:
+            return HttpResponseBadRequest("Missing username or block_id")
+        try:
+            task, blocks = query_latest_report(key, username or None, block_id or None)
+        except:
+            logger.warning("Invalid report index for course %s.", course_key, exc_info=True)
+            return JsonResponse({"status": 0, "msg": "Formato de output de tarea inválido."})
+        if task is None:
+            return JsonResponse({"status": 0, "msg": "No hay reportes asociados a este curso."})
+        if blocks is None:
+            return JsonResponse({"status": 0, "msg": "El reporte no está indexado para consultas."})
+        return JsonResponse({
+            "status": 1,
+            "msg": "Reporte encontrado.",
+            "course_key": course_key,
+            "task_id": task.task_id,
+            "task_finished": task.updated.isoformat(),
+            "blocks": blocks,
+        })
+
+
+def get_report_task_input(request, data):
+    """
+    Return the input of a report task with the options given in `data`, and
+    an error message if any of them is invalid. `split_ora` stores the ORA
+    data of every block in a file of its own too, by default if
+    `CMMEDU_SEGUIMIENTO_ORA_SPLIT_BY_BLOCK` is set, and `index` indexes the
+    report for the query endpoint, by default if
+    `CMMEDU_SEGUIMIENTO_REPORT_INDEX` is set.
+    """
+    mode = data.get('mode', 'full')
+    if mode not in REPORT_MODES:
+        return None, "Invalid mode"
+    report_format = data.get('format', 'classic')
+    if report_format not in REPORT_FORMATS:
+        return None, "Invalid format"
+    return {
+        'user_id': request.user.pk,
+        'parallel': bool(data.get('parallel', False)),
+        'mode': mode,
+        'compact': bool(data.get('compact', False)),
+        'format': report_format,
+        'profile': bool(data.get('profile', False)),
+        'split_ora': bool(data.get('split_ora', settings.CMMEDU_SEGUIMIENTO_ORA_SPLIT_BY_BLOCK)),
+        'index': bool(data.get('index', settings.CMMEDU_SEGUIMIENTO_REPORT_INDEX)),
+    }, None
+
+
+def get_batch_courses_output(batch):
+    """
+    Return the state of the report task of every course of a batch. A course
+    left out of the batch has the `ERROR` state and its error, and a course
+    not submitted yet the `QUEUING` state.
+    """
+    entries = InstructorTask.objects.in_bulk(
+        [course['entry_id'] for course in batch['courses'] if course['entry_id'] is not None]
+    )
+    courses = []
+    for course in batch['courses']:
+        output = {'course_key': course['course_key'], 'task_id': course['task_id']}
+        entry = entries.get(course['entry_id'])
+        if course['error'] is not None:
+            output.update({'task_state': 'ERROR', 'error': course['error']})
+        elif entry is None:
+            output['task_state'] = QUEUING
+        else:
+            output['task_state'] = entry.task_state
+            if entry.task_state == 'PROGRESS':
+                output['progress'] = get_report_progress(entry.id)
+            elif entry.task_state == 'FAILURE':
+                output['task_error'] = entry.task_output
+        courses.append(output)
+    return courses
+
+
+def get_report_output(report_store, course_key, manifest_name):
+    """
+    Return the urls and details of the files of a report, read from its
+    manifest only.
+    """
+    manifest = report_store.read_manifest(course_key, manifest_name)
+    sections = manifest['sections']
+    filenames = [manifest_name, manifest['student_profile']['name'], manifest['ora_data']['name']]
+    filenames += [section['name'] for section in sections]
+    ora_blocks = manifest['ora_data'].get('blocks', {})
+    filenames += [report['name'] for report in ora_blocks.values()]
+    if manifest.get('cprofile'):
+        filenames.append(manifest['cprofile'])
+    name_to_url = dict(report_store.links_for_names(course_key, filenames))
+    return {
+        'manifest': name_to_url[manifest_name],
+        'mode': manifest['mode'],
+        'format': manifest.get('format', 'classic'),
+        'base_timestamp': manifest['base_timestamp'],
+        'student_profile': name_to_url[manifest['student_profile']['name']],
+        'ora_data': name_to_url[manifest['ora_data']['name']],
+        'ora_blocks': {item_id: name_to_url[report['name']] for item_id, report in ora_blocks.items()},
+        'blocks_data': {
+            str(index): name_to_url[section['name']]
+            for index, section in enumerate(sections, 1)
+        },
+        'sections': [
+            dict(section, index=index, url=name_to_url[section['name']])
+            for index, section in enumerate(sections, 1)
+        ],
+        'metrics': manifest.get('metrics'),
+        'cprofile': name_to_url.get(manifest.get('cprofile')),
+    }
+
+
+def get_legacy_report_output(report_store, course_key, task_output):
+    """
+    Return the urls of the files of a report made before reports had a
+    manifest, rebuilding their names from the task output.
+    """
+    report_names = [task_output['course_key'] + "_" + "report_data_" + str(i+1) + "_" + task_output["timestamp"] + ".tar.gz" for i in range(task_output['n_reports'])]
+    student_profile_report_name = task_output['course_key'] + "_student_profile_" + task_output["timestamp"] + ".tar.gz"
+    ora_report_name = task_output['course_key'] + "_ora_data_" + task_output["timestamp"] + ".tar.gz"
+    desired_filenames = [student_profile_report_name, ora_report_name] + report_names
+    name_to_url = dict(report_store.links_for_names(course_key, desired_filenames))
+    return {
+        'mode': 'full',
+        'format': 'classic',
+        'student_profile': name_to_url.get(student_profile_report_name),
+        'ora_data': name_to_url.get(ora_report_name),
+        'blocks_data': {
+            name.split("report_data_")[1].split("_")[0]: name_to_url[name]
+            for name in report_names if name in name_to_url
+        },
+    }
\ No newline at end of file